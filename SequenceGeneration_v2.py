@@ -1,3 +1,4 @@
+import hashlib
 import logging
 from itertools import groupby
 from operator import attrgetter
@@ -6,6 +7,12 @@ import numpy as np
 
 log = logging.getLogger(__name__)
 
+# rows of the memory of a DAC: 8 samples, 2 triggers and a repetition number
+DAC_MEMORY_ROWS = 16384
+DAC_ROW_SIZE = 11
+# row written after a waveform, where the playback stops
+DAC_END_ROW = np.array([0] * 10 + [16383])
+
 
 class Pulse:
     """
@@ -15,9 +22,13 @@ class Pulse:
     # initializing the array storing instances of the class Pulse
     objs = []
 
-    def __init__(self, t_init, t_duration, channel, parent):
-        # adding the new instance to the objs array
-        Pulse.objs.append(self)
+    def __init__(self, t_init, t_duration, channel, parent, sequence=None):
+        # adding the new instance to the objs array, or only to its sequence
+        # (see Sequence)
+        if sequence is None:
+            Pulse.objs.append(self)
+        else:
+            sequence.add(self)
         # initializing the object attribute
         # initial time with respect to the parent pulse end #### ME: I think it actually defines the time with respect to the parent pulse beginning
         self.t_init = t_init
@@ -36,27 +47,7 @@ class Pulse:
         Pulse with respect to the beginning of the sequence (take adventage of
         the parent attribure).
         """
-        for obj in cls.objs:
-            # initialize absolute time and parent
-            t_abs = obj.t_init
-            parent = obj.parent
-
-            # going up the the hierarchy tree and incrementing the time
-            # untill we reach a root event (type(parent) : None)
-            while parent is not None:
-                # the initial time a child pulse is define with respect to the
-                # initial time of the parent pulse
-
-                # TODO : permit to define the child pulse with respect to the
-                # begining of the parent pulse
-                t_abs += parent.t_init + parent.t_duration
-                # defining from begining
-
-                # new parent
-                parent = parent.parent
-
-            # store the absolute time
-            obj._t_abs = t_abs
+        Sequence(cls.objs).absolute_init_time()
 
     @classmethod
     def sort_and_groupby_timewise(cls):
@@ -64,18 +55,7 @@ class Pulse:
         Method to sort ADC and DAC events timewise and grouping simultaneous
         events.
         """
-        cls.absolute_init_time()
-
-        # initializing the list containing groups of simultaneous events
-        groups = []
-
-        # sort the Pulse instances timewise
-        new = sorted(cls.objs, key=attrgetter("_t_abs"))
-        # group by absolute initial time
-        for _, g in groupby(new, key=attrgetter("_t_abs")):
-            groups.append(list(g))
-
-        return groups
+        return Sequence(cls.objs).sort_and_groupby_timewise()
 
     @classmethod
     def generate_sequence_and_DAC_memory(cls, nb_loop, acq_mode, mix_freq):
@@ -86,181 +66,19 @@ class Pulse:
         TODO : account for simultaneous events.
         """
 
-        sorted_seq = np.array(cls.sort_and_groupby_timewise())
-        # print(sorted_seq)
-
-        Tseq = max(
-            [
-                max([p[i]._t_abs + p[i].t_duration for i in range(len(p))])
-                for p in sorted_seq
-            ]
+        return Sequence(cls.objs).generate_sequence_and_DAC_memory(
+            nb_loop, acq_mode, mix_freq
         )
 
-        print("Tseq={}".format(Tseq))
-
-        # initialize the scpi command (memory adress 0 wait 44 ns and set all
-        # beginiing DAC memories to 0)
-
-        # storing the time of play of the sequence to adjust for sync with LO
-        # and adjust for letting time for DAC playing all memory before starting again
-        # the sequence
-        N_seq_loop = 1
-        N_data_transfer = 0
-
-        if acq_mode == "SUM":
-            acq_mode_val = 286331153
-            # for now we turn all ADCs to the same acquisition mode
-        else:
-            acq_mode_val = 0
-
-        if nb_loop == 0:
-            scpi_str = "SEQ 0,1,10,4106," + str(acq_mode_val) + ",257,0,4105,0"
-        else:
-            scpi_str = (
-                "SEQ 0,1,10,4106,"
-                + str(acq_mode_val)
-                + ",257,"
-                + str(nb_loop)
-                + ",4105,0"
-            )
-
-        # array storing previous DAC pulses for each DAC channel to manage
-        # the momort adress
-        last_DAC_channel_event = [None, None, None, None, None, None, None, None]
-
-        # TODO : get rid of the groupy method and directly loop through groupby
-        # (sorted listn key)
-
-        # go through sorted events (the sequence is ... sequential)
-        for gp in sorted_seq:
-            # print(last_DAC_channel_event)
-            N_wait = int(round(gp[0].t_init / (4.0e-9)))
-            ctrl_dac_adc = 0
-            N_adc_duration = 0
-
-            if N_wait != 0.0:
-                scpi_str = scpi_str + ",1,{}".format(N_wait - 1)
-                N_seq_loop += N_wait
-
-            for obj in gp:
-                # looking if the pulse is DAC or ADC
-                if type(obj) == PulseGeneration:
-                    N_duration = int(round(obj.t_duration / (4.0e-9)))
-                    ctrl_dac_adc += DAC_status([int(obj.channel[2])])
-
-                    # managing DAC memory adress
-                    if last_DAC_channel_event[int(obj.channel[2]) - 1] == None:
-                        obj._DAC_2D_memory = obj.send_DAC_2D_memory()
-                        print("adress=0")
-
-                    else:
-                        # computing new start adress for the new wform of the DAC
-                        new_adress = (
-                            int(
-                                round(
-                                    last_DAC_channel_event[
-                                        int(obj.channel[2]) - 1
-                                    ].t_duration
-                                    / (4.0e-9)
-                                )
-                            )
-                            + 1
-                        )
-                        print("new_adress = {}".format(new_adress))
-
-                        # adding delay or not
-                        scpi_str = scpi_str + ",{},{}".format(
-                            4096 + int(obj.channel[2]), new_adress
-                        )
-                        N_seq_loop += 1
-
-                        # storing the filling DAC memory SCPI instruction as an
-                        # attribute of the PulseGeneration object
-                        obj._DAC_2D_memory = obj.send_DAC_2D_memory(new_adress)
-
-                    # updating last event of the DAC
-                    last_DAC_channel_event[int(obj.channel[2]) - 1] = obj
-
-                elif type(obj) == PulseReadout:
-                    ctrl_dac_adc += ADC_status([int(obj.channel[2])])
-
-                    # header 8 point of 2 bytes
-                    # data transfer speed is 100 Mo/s max (doc specify to verify)
-                    t_data_transfer = 16.0 / (100.0e6)
-                    N_data_transfer += int(round(t_data_transfer / (4.0e-9)))
-
-                    # TODO : take decimation into account
-                    #       if deficamtion divide N_acq by decimation facotr
-                    N_acq = int(round(obj.t_duration / (0.5e-9)))
-
-                    N_temp = int(round(obj.t_duration / (4e-9)))
-                    if N_temp > N_adc_duration:
-                        N_adc_duration = N_temp
-
-                    # data is 2 octet per point in raw mode
-                    if acq_mode is "RAW":
-                        t_data_transfer = 2.0 * N_acq / 100.0e6
-                        N_data_transfer += int(round(t_data_transfer / (4.0e-9)))
-
-                    if acq_mode is "SUM":
-                        # in sum mode 64 bits for I and 64 bits for Q
-                        # ie 4*2 bytes I 4*2 bytes Q
-                        t_data_transfer = 16.0 / (100.0e6)
-                        N_data_transfer += int(round(t_data_transfer / (4.0e-9)))
-
-                    scpi_str = scpi_str + ",{},{}".format(
-                        4106 + int(obj.channel[2]), N_acq
-                    )
-
-                    N_seq_loop += 1
-
-            if N_adc_duration != 0:
-                scpi_str = scpi_str + ",4096,{},1,{}".format(
-                    ctrl_dac_adc, N_adc_duration - 1
-                )
-                N_seq_loop += 1 + N_adc_duration
-
-            else:
-                scpi_str = scpi_str + ",4096,{}".format(ctrl_dac_adc)
-                N_seq_loop += 1
-
-        N_add = 0
-        N_seq_loop += 3  # end of loop and wait at the end for adjustment
-        # print('N_seq_loop={}'.format(N_seq_loop))
-
-        if N_seq_loop * 4.0e-9 < Tseq:
-            N_add = int(round((Tseq - N_seq_loop * 4.0e-9) / 4.0e-9))
-            N_seq_loop += N_add
-
-        # print('N_add={}'.format(N_add))
-
-        N_data_transfer = N_data_transfer * 10
-        N_seq_loop = N_seq_loop + N_data_transfer * 10
-
-        # print('N_seq_loop={}'.format(N_seq_loop))
-        # N_seq_loop = N_seq_loop
-
-        # print('N_data_transfer={}'.format(N_data_transfer))
-
-        if mix_freq != 0.0:
-            N_mix = int(round(1.0 / (4.0e-9 * mix_freq)))
-            N_add += (
-                N_mix - N_seq_loop % N_mix
-            )  # + N_mix*1000  #### 25 points of wait correspond to 1 us acquisition time
-            N_seq_loop += N_mix - N_seq_loop % N_mix  # + N_mix*1000
-
-        # print('N_add={}'.format(N_add))
-
-        # 16 working
-        scpi_str = scpi_str + ",1,{},513,0,0,0".format(N_add + N_data_transfer)
-
-        # scpi_str=scpi_str+',1,{},513,0'.format(1000000-5)
-
-        # print('N_seq_loop={}'.format(N_seq_loop))
-        # print('t_seq_loop={} s'.format(N_seq_loop*4.e-9))
-
-        # print(scpi_str)
-        return scpi_str
+    @classmethod
+    def reset_objs(cls):
+        """
+        Empty the objs arrays of the Pulse, PulseGeneration and PulseReadout
+        classes.
+        """
+        Pulse.objs.clear()
+        PulseGeneration.objs.clear()
+        PulseReadout.objs.clear()
 
 
 class PulseGeneration(Pulse):
@@ -280,9 +98,11 @@ class PulseGeneration(Pulse):
         CW_mode=False,
         DC_offset=0,
         parent=None,
+        sequence=None,
     ):
-        super().__init__(t_init, t_duration, channel, parent)
-        PulseGeneration.objs.append(self)
+        super().__init__(t_init, t_duration, channel, parent, sequence)
+        if sequence is None:
+            PulseGeneration.objs.append(self)
         self.wform = wform
         self.params = params
         self.CW_mode = CW_mode
@@ -367,11 +187,7 @@ class PulseGeneration(Pulse):
             # reshaping +andadding initialized values for trigger and repetition
             # number
 
-            table = table.reshape(int(round(table.shape[0] / 8.0)), 8)
-            memory_table = np.concatenate(
-                (table, np.zeros((table.shape[0], 1)), np.zeros((table.shape[0], 2))),
-                axis=1,
-            )
+            memory_table = DAC_rows(table)
 
             # the triggers of one channel are stored in a tuple
             # the tuple is composed of couples of string for the trigger val
@@ -473,11 +289,7 @@ class PulseGeneration(Pulse):
             # reshaping +andadding initialized values for trigger and repetition
             # number
 
-            table = table.reshape(int(round(table.shape[0] / 8.0)), 8)
-            memory_table = np.concatenate(
-                (table, np.zeros((table.shape[0], 1)), np.zeros((table.shape[0], 2))),
-                axis=1,
-            )
+            memory_table = DAC_rows(table)
 
             # the triggers of one channel are stored in a tuple
             # the tuple is composed of couples of string for the trigger val
@@ -516,45 +328,30 @@ class PulseGeneration(Pulse):
                     (1, memory_table.shape[0] * memory_table.shape[1])
                 )[0]
 
-    def send_DAC_2D_memory(self, adress=0):
+    def send_DAC_2D_memory(self, adress=0, table=None):
         """
         Send the waveform to the DAC memory
 
-        Input : beginning adress for the memory
+        Input : beginning adress for the memory, table returned by
+        fill_2D_memory (generated if None)
 
         Output : SCPI command
         """
-        # convert the element of table_bit to int and then to string for sending
-        # then forming a whole string with values separated by commas by using
-        # the join method
-
-        table = self.fill_2D_memory()
-        table_bit = (table.astype(int)).astype(str)
-        separator = ","
-        table_bit = separator.join(table_bit)
+        if table is None:
+            table = self.fill_2D_memory()
 
         # managing the beginning adress of the memory depending on the mode
         # (CW or pulse)
         if self.channel in ["CH1", "CH2", "CH3", "CH4", "CH5", "CH6", "CH7", "CH8"]:
             # fill the end of the memory for the CW mode
             if self.CW_mode == False:
-                return (
-                    "DAC:DATA:"
-                    + self.channel
-                    + " "
-                    + str(adress)
-                    + ","
-                    + table_bit
-                    + ","
-                    + "0,0,0,0,0,0,0,0,0,0,16383"
-                )
+                words = DAC_memory_words(table, adress)
 
             else:
                 new_adress = int(round(16384 - self.t_duration / (4.0e-9)))
+                words = DAC_memory_words(table, new_adress, end_row=False)
 
-                return (
-                    "DAC:DATA:" + self.channel + " " + str(new_adress) + "," + table_bit
-                )
+            return DAC_memory_command(self.channel, words)
 
         else:
             raise ValueError("Wrong channel value")
@@ -567,9 +364,10 @@ class PulseReadout(Pulse):
 
     objs = []
 
-    def __init__(self, t_init, t_duration, channel, parent=None):
-        super().__init__(t_init, t_duration, channel, parent)
-        PulseReadout.objs.append(self)
+    def __init__(self, t_init, t_duration, channel, parent=None, sequence=None):
+        super().__init__(t_init, t_duration, channel, parent, sequence)
+        if sequence is None:
+            PulseReadout.objs.append(self)
 
     def __repr__(self):
         return "Pulse(ADC {}, t_abs={} s,  t_init={} s, t_duration={} s".format(
@@ -577,6 +375,523 @@ class PulseReadout(Pulse):
         )
 
 
+class DACMemory:
+    """
+    Allocation of the rows of the memory of a DAC channel.
+    A waveform is stored once: the pulses with the same table (compared by a
+    hash of its content) share its rows. Every waveform is followed by the
+    row ending the playback, and placed in the first free rows large enough
+    (first fit). A ValueError is raised as soon as a waveform does not fit.
+    """
+
+    def __init__(self, channel, n_rows=DAC_MEMORY_ROWS):
+        self.channel = channel
+        self.n_rows = n_rows
+        # blocks by hash of the table (and address for a table placed at a
+        # given address): hash, address, rows, SCPI command, written
+        self.blocks = {}
+        # waveforms found in the memory since the last keep
+        self.hits = 0
+
+    @staticmethod
+    def key(table):
+        return hashlib.sha1(np.ascontiguousarray(table).tobytes()).hexdigest()
+
+    def keep(self, hashes):
+        """
+        Free the rows of the waveforms whose hash is not in hashes.
+        """
+        hashes = set(hashes)
+        for key, block in list(self.blocks.items()):
+            if block["hash"] not in hashes:
+                del self.blocks[key]
+        self.hits = 0
+
+    def free_blocks(self):
+        """
+        Output : list of (address, rows) of the free blocks of the memory
+        """
+        free = []
+        address = 0
+        for block in sorted(self.blocks.values(), key=lambda b: b["address"]):
+            if block["address"] > address:
+                free.append((address, block["address"] - address))
+            address = max(address, block["address"] + block["rows"])
+        if address < self.n_rows:
+            free.append((address, self.n_rows - address))
+        return free
+
+    def allocate(self, table, address=None, end_row=True):
+        """
+        Place a table in the memory, or find it there.
+
+        Input : table returned by fill_2D_memory, address of the table (first
+        fit if None), end_row if the table is followed by the row ending the
+        playback
+
+        Output : dict of the block (hash, address, rows, command, written)
+        """
+        table_hash = self.key(table)
+        key = table_hash if address is None else (table_hash, address)
+        block = self.blocks.get(key)
+        if block is not None:
+            self.hits += 1
+            return block
+
+        rows = len(table) // DAC_ROW_SIZE + (1 if end_row else 0)
+        free = self.free_blocks()
+        if address is None:
+            fits = [start for start, size in free if size >= rows]
+            if not fits:
+                raise ValueError(self._full_message(rows))
+            address = fits[0]
+        elif not any(
+            start <= address and address + rows <= start + size for start, size in free
+        ):
+            raise ValueError(
+                "Rows {} to {} of the memory of DAC CH{} are not free".format(
+                    address, address + rows - 1, self.channel
+                )
+            )
+
+        block = dict(
+            hash=table_hash, address=address, rows=rows, command=None, written=False
+        )
+        self.blocks[key] = block
+        return block
+
+    def _full_message(self, rows):
+        report = self.report()
+        return (
+            "The memory of DAC CH{} is full: a waveform of {} rows does not fit, "
+            "{} of {} rows are used by {} waveforms, the largest free block is "
+            "{} rows (fragmentation {:.0%})".format(
+                self.channel,
+                rows,
+                report["used_rows"],
+                self.n_rows,
+                report["waveforms"],
+                report["largest_free_rows"],
+                report["fragmentation"],
+            )
+        )
+
+    def report(self):
+        """
+        Output : dict with the channel, the number of waveforms and of pulses
+        which found their waveform in the memory (shared), the used and free
+        rows, the largest free block and the fragmentation (1 - largest free
+        block / free rows)
+        """
+        free = [size for _, size in self.free_blocks()]
+        free_rows = sum(free)
+        largest = max(free, default=0)
+        return dict(
+            channel=self.channel,
+            waveforms=len(self.blocks),
+            shared=self.hits,
+            used_rows=self.n_rows - free_rows,
+            free_rows=free_rows,
+            largest_free_rows=largest,
+            fragmentation=1 - largest / free_rows if free_rows else 0.0,
+        )
+
+
+class Sequence:
+    """
+    Container of the DAC and ADC events of a sequence.
+    Unlike the objs arrays of the Pulse classes, which keep every pulse ever
+    created, a sequence only holds the pulses created with sequence=self (or
+    added to it) and can be emptied between two sweep points.
+    """
+
+    def __init__(self, pulses=()):
+        self.pulses = []
+        # memories of the DAC channels, kept from one generation to the next so
+        # that unchanged waveforms keep their address, and tables of the last
+        # generation by waveform parameters
+        self.memories = {}
+        self._tables = {}
+        for pulse in pulses:
+            self.add(pulse)
+
+    def __len__(self):
+        return len(self.pulses)
+
+    def __iter__(self):
+        return iter(self.pulses)
+
+    def add(self, pulse):
+        """
+        Add a pulse to the sequence, and return it.
+        """
+        self.pulses.append(pulse)
+        return pulse
+
+    def clear(self):
+        """
+        Remove all the pulses of the sequence.
+        """
+        self.pulses = []
+
+    def absolute_init_time(self):
+        """
+        Initial time of every pulse with respect to the beginning of the
+        sequence, stored in the _t_abs attribute of the pulses. Every pulse is
+        resolved once: the chain of unresolved parents is followed upwards and
+        resolved on the way back.
+
+        Output : dict of the initial times by id of the pulses (parents
+        outside of the sequence included)
+        """
+        t_abs = {}
+
+        for pulse in self.pulses:
+            chain = []
+            on_chain = set()
+            obj = pulse
+            while id(obj) not in t_abs and obj.parent is not None:
+                if id(obj) in on_chain:
+                    raise ValueError(
+                        "Circular pulse hierarchy: "
+                        + " -> ".join(repr(p) for p in chain + [obj])
+                    )
+                chain.append(obj)
+                on_chain.add(id(obj))
+                obj = obj.parent
+
+            if id(obj) not in t_abs:
+                t_abs[id(obj)] = obj.t_init
+                obj._t_abs = obj.t_init
+
+            # the initial time a child pulse is defined with respect to the
+            # end of the parent pulse
+            for obj in reversed(chain):
+                parent = obj.parent
+                t_abs[id(obj)] = obj.t_init + t_abs[id(parent)] + parent.t_duration
+                obj._t_abs = t_abs[id(obj)]
+
+        return t_abs
+
+    def sort_and_groupby_timewise(self):
+        """
+        Method to sort ADC and DAC events timewise and grouping simultaneous
+        events.
+        """
+        self.absolute_init_time()
+
+        # initializing the list containing groups of simultaneous events
+        groups = []
+
+        # sort the Pulse instances timewise
+        new = sorted(self.pulses, key=attrgetter("_t_abs"))
+        # group by absolute initial time
+        for _, g in groupby(new, key=attrgetter("_t_abs")):
+            groups.append(list(g))
+
+        return groups
+
+    def DAC_tables(self, groups):
+        """
+        Tables of the DAC pulses, generated once for identical waveforms
+        (same waveform, parameters, duration and DC offset) and reused from
+        the previous generation.
+
+        Input : groups returned by sort_and_groupby_timewise
+
+        Output : dict of the tables by id of the pulses
+        """
+        tables = {}
+        by_waveform = {}
+        for gp in groups:
+            for obj in gp:
+                if type(obj) != PulseGeneration:
+                    continue
+                waveform = (
+                    obj.wform,
+                    repr(obj.params),
+                    obj.t_duration,
+                    obj.DC_offset,
+                )
+                if waveform not in by_waveform:
+                    table = self._tables.get(waveform)
+                    by_waveform[waveform] = (
+                        obj.fill_2D_memory() if table is None else table
+                    )
+                tables[id(obj)] = by_waveform[waveform]
+        self._tables = by_waveform
+        return tables
+
+    def DAC_memory_commands(self, new_only=True):
+        """
+        SCPI commands filling the DAC memories with the waveforms of the last
+        generation.
+
+        Input : new_only, only the waveforms which were not returned before
+        (the others are already in the memories)
+
+        Output : list of SCPI commands
+        """
+        commands = []
+        for channel in sorted(self.memories):
+            for block in self.memories[channel].blocks.values():
+                if not (new_only and block["written"]):
+                    commands.append(block["command"])
+                    block["written"] = True
+        return commands
+
+    def DAC_memory_report(self):
+        """
+        Occupation of the memory of every DAC channel used, see DACMemory.report
+        """
+        return [self.memories[channel].report() for channel in sorted(self.memories)]
+
+    def forget_DAC_memory(self):
+        """
+        Forget the content of the DAC memories (e.g. after a reset of the
+        instrument): the next generation places and writes all the waveforms.
+        """
+        self.memories = {}
+
+    def generate_sequence_and_DAC_memory(self, nb_loop, acq_mode, mix_freq):
+        """
+        Method to generate the SCPI command for filling the DAC memory and
+        the sequence memory based on the pulses of the sequence.
+        The commands filling the DAC memories are stored in the _DAC_2D_memory
+        attribute of the pulses, see also DAC_memory_commands.
+
+        TODO : account for simultaneous events.
+        """
+
+        sorted_seq = self.sort_and_groupby_timewise()
+        # print(sorted_seq)
+
+        Tseq = max(
+            [
+                max([p[i]._t_abs + p[i].t_duration for i in range(len(p))])
+                for p in sorted_seq
+            ]
+        )
+
+        print("Tseq={}".format(Tseq))
+
+        # initialize the scpi command (memory adress 0 wait 44 ns and set all
+        # beginiing DAC memories to 0)
+
+        # storing the time of play of the sequence to adjust for sync with LO
+        # and adjust for letting time for DAC playing all memory before starting again
+        # the sequence
+        N_seq_loop = 1
+        N_data_transfer = 0
+
+        if acq_mode == "SUM":
+            acq_mode_val = 286331153
+            # for now we turn all ADCs to the same acquisition mode
+        else:
+            acq_mode_val = 0
+
+        if nb_loop == 0:
+            scpi_str = "SEQ 0,1,10,4106," + str(acq_mode_val) + ",257,0,4105,0"
+        else:
+            scpi_str = (
+                "SEQ 0,1,10,4106,"
+                + str(acq_mode_val)
+                + ",257,"
+                + str(nb_loop)
+                + ",4105,0"
+            )
+
+        # the DAC tables are generated once per waveform, and the waveforms
+        # which are not in the sequence any more are removed from the memories
+        tables = self.DAC_tables(sorted_seq)
+        for channel, memory in self.memories.items():
+            memory.keep(
+                memory.key(tables[id(obj)])
+                for gp in sorted_seq
+                for obj in gp
+                if type(obj) == PulseGeneration and int(obj.channel[2]) == channel
+            )
+
+        # DAC channels which already played a pulse
+        DAC_channel_used = set()
+
+        # TODO : get rid of the groupy method and directly loop through groupby
+        # (sorted listn key)
+
+        # go through sorted events (the sequence is ... sequential)
+        for gp in sorted_seq:
+            # print(last_DAC_channel_event)
+            N_wait = int(round(gp[0].t_init / (4.0e-9)))
+            ctrl_dac_adc = 0
+            N_adc_duration = 0
+
+            if N_wait != 0.0:
+                scpi_str = scpi_str + ",1,{}".format(N_wait - 1)
+                N_seq_loop += N_wait
+
+            for obj in gp:
+                # looking if the pulse is DAC or ADC
+                if type(obj) == PulseGeneration:
+                    N_duration = int(round(obj.t_duration / (4.0e-9)))
+                    ctrl_dac_adc += DAC_status([int(obj.channel[2])])
+
+                    # managing DAC memory adress: identical waveforms share
+                    # their rows
+                    channel = int(obj.channel[2])
+                    memory = self.memories.setdefault(channel, DACMemory(channel))
+                    table = tables[id(obj)]
+                    if obj.CW_mode:
+                        # played from the end of the memory
+                        new_adress = int(round(16384 - obj.t_duration / (4.0e-9)))
+                        block = memory.allocate(table, new_adress, end_row=False)
+                    else:
+                        block = memory.allocate(table)
+                    new_adress = block["address"]
+                    if block["command"] is None:
+                        block["command"] = obj.send_DAC_2D_memory(new_adress, table)
+
+                    if channel in DAC_channel_used or new_adress != 0:
+                        print("new_adress = {}".format(new_adress))
+
+                        # adding delay or not
+                        scpi_str = scpi_str + ",{},{}".format(
+                            4096 + channel, new_adress
+                        )
+                        N_seq_loop += 1
+                    else:
+                        print("adress=0")
+
+                    # storing the filling DAC memory SCPI instruction as an
+                    # attribute of the PulseGeneration object
+                    obj._DAC_2D_memory = block["command"]
+                    obj._DAC_adress = new_adress
+                    DAC_channel_used.add(channel)
+
+                elif type(obj) == PulseReadout:
+                    ctrl_dac_adc += ADC_status([int(obj.channel[2])])
+
+                    # header 8 point of 2 bytes
+                    # data transfer speed is 100 Mo/s max (doc specify to verify)
+                    t_data_transfer = 16.0 / (100.0e6)
+                    N_data_transfer += int(round(t_data_transfer / (4.0e-9)))
+
+                    # TODO : take decimation into account
+                    #       if deficamtion divide N_acq by decimation facotr
+                    N_acq = int(round(obj.t_duration / (0.5e-9)))
+
+                    N_temp = int(round(obj.t_duration / (4e-9)))
+                    if N_temp > N_adc_duration:
+                        N_adc_duration = N_temp
+
+                    # data is 2 octet per point in raw mode
+                    if acq_mode == "RAW":
+                        t_data_transfer = 2.0 * N_acq / 100.0e6
+                        N_data_transfer += int(round(t_data_transfer / (4.0e-9)))
+
+                    if acq_mode == "SUM":
+                        # in sum mode 64 bits for I and 64 bits for Q
+                        # ie 4*2 bytes I 4*2 bytes Q
+                        t_data_transfer = 16.0 / (100.0e6)
+                        N_data_transfer += int(round(t_data_transfer / (4.0e-9)))
+
+                    scpi_str = scpi_str + ",{},{}".format(
+                        4106 + int(obj.channel[2]), N_acq
+                    )
+
+                    N_seq_loop += 1
+
+            if N_adc_duration != 0:
+                scpi_str = scpi_str + ",4096,{},1,{}".format(
+                    ctrl_dac_adc, N_adc_duration - 1
+                )
+                N_seq_loop += 1 + N_adc_duration
+
+            else:
+                scpi_str = scpi_str + ",4096,{}".format(ctrl_dac_adc)
+                N_seq_loop += 1
+
+        N_add = 0
+        N_seq_loop += 3  # end of loop and wait at the end for adjustment
+        # print('N_seq_loop={}'.format(N_seq_loop))
+
+        if N_seq_loop * 4.0e-9 < Tseq:
+            N_add = int(round((Tseq - N_seq_loop * 4.0e-9) / 4.0e-9))
+            N_seq_loop += N_add
+
+        # print('N_add={}'.format(N_add))
+
+        N_data_transfer = N_data_transfer * 10
+        N_seq_loop = N_seq_loop + N_data_transfer * 10
+
+        # print('N_seq_loop={}'.format(N_seq_loop))
+        # N_seq_loop = N_seq_loop
+
+        # print('N_data_transfer={}'.format(N_data_transfer))
+
+        if mix_freq != 0.0:
+            N_mix = int(round(1.0 / (4.0e-9 * mix_freq)))
+            N_add += (
+                N_mix - N_seq_loop % N_mix
+            )  # + N_mix*1000  #### 25 points of wait correspond to 1 us acquisition time
+            N_seq_loop += N_mix - N_seq_loop % N_mix  # + N_mix*1000
+
+        # print('N_add={}'.format(N_add))
+
+        # 16 working
+        scpi_str = scpi_str + ",1,{},513,0,0,0".format(N_add + N_data_transfer)
+
+        # scpi_str=scpi_str+',1,{},513,0'.format(1000000-5)
+
+        # print('N_seq_loop={}'.format(N_seq_loop))
+        # print('t_seq_loop={} s'.format(N_seq_loop*4.e-9))
+
+        # print(scpi_str)
+        return scpi_str
+
+
+def DAC_rows(samples):
+    """
+    Rows of the DAC memory playing samples once, with the triggers down.
+
+    Input : samples, padded with zeros to a multiple of 8
+
+    Output : array of shape (number of rows, DAC_ROW_SIZE)
+    """
+    samples = np.asarray(samples, dtype=float)
+    rows = np.zeros((len(samples) // 8, DAC_ROW_SIZE))
+    rows[:, :8] = samples.reshape(-1, 8)
+    return rows
+
+
+def DAC_memory_words(table, adress=0, end_row=True):
+    """
+    Words of a DAC:DATA command: the beginning adress, the values of the table
+    (truncated to integers) and the row ending the playback.
+
+    Output : int64 array
+    """
+    table = np.asarray(table)
+    words = np.empty(1 + len(table) + (DAC_ROW_SIZE if end_row else 0), dtype=np.int64)
+    words[0] = adress
+    words[1 : 1 + len(table)] = table.astype(int)
+    if end_row:
+        words[-DAC_ROW_SIZE:] = DAC_END_ROW
+    return words
+
+
+def DAC_memory_command(channel, words):
+    """
+    DAC:DATA command writing words in the memory of a DAC channel, as comma
+    separated values. The words are formatted as Python ints, 2.5 times
+    faster than as numpy strings.
+
+    Input : channel ('CH1' to 'CH8'), words returned by DAC_memory_words
+
+    Output : SCPI command
+    """
+    return "DAC:DATA:" + channel + " " + ",".join(map(str, words.tolist()))
+
+
 def ADC_status(ADC_list):
     """
     Convert the ADC channel numbers to the CTRL_DAC&ADC data value of the
@@ -31,8 +31,12 @@ from IPython.display import display, HTML
 from ipywidgets import IntProgress
 import matplotlib.pyplot as plt
 
+import contextlib
 import functools
+import hashlib
+import json
 import operator
+from collections import OrderedDict
 from itertools import chain
 
 sys.path.append('C:\\Experiment\\Drivers')
@@ -43,6 +47,386 @@ log = logging.getLogger(__name__)
 
 
 
+def resolve_hierarchy(labels, starts, lengths, parents):
+	'''
+	Absolute start of every pulse of a pulse table: a pulse with a parent starts
+	'start' after the end of its parent. Every pulse is resolved once: the chain
+	of unresolved parents is followed upwards and resolved on the way back.
+	Input:
+		labels, starts, lengths, parents(list): columns of the pulse table,
+		parent is None for a pulse starting from the beginning of the sequence
+	Output:
+		list of the absolute starts, in the order of the table
+	'''
+	index = {label: i for i, label in enumerate(labels)}
+	resolved = [None] * len(labels)
+
+	for i in range(len(labels)):
+
+		chain = []
+		on_chain = set()
+		j = i
+		while resolved[j] is None and not _is_root(parents[j]):
+			if j in on_chain:
+				raise ValueError('Circular pulse hierarchy: ' + ' -> '.join(str(labels[k]) for k in chain + [j]))
+			chain.append(j)
+			on_chain.add(j)
+			if parents[j] not in index:
+				raise ValueError('Unknown parent ' + str(parents[j]) + ' of pulse ' + str(labels[j]))
+			j = index[parents[j]]
+
+		if resolved[j] is None:
+			resolved[j] = starts[j]
+
+		for k in reversed(chain):
+			parent = index[parents[k]]
+			resolved[k] = starts[k] + resolved[parent] + lengths[parent]
+
+	return resolved
+
+
+def _is_root(parent):
+
+	return parent is None or (isinstance(parent, float) and np.isnan(parent))
+
+
+def _canonical(value):
+	'''
+	Pulse table or settings as plain python values, to be hashed
+	'''
+	if isinstance(value, dict):
+		return {str(k): _canonical(v) for k, v in value.items()}
+	if isinstance(value, (list, tuple, np.ndarray)):
+		return [_canonical(v) for v in value]
+	if isinstance(value, np.generic):
+		value = value.item()
+	if isinstance(value, float) and np.isnan(value):
+		return None
+	if value is None or isinstance(value, (bool, int, float, str)):
+		return value
+	return repr(value)
+
+# Header of the packets sent by the ADCs: 8 int16 words
+HEADER_DTYPE = np.dtype([('channel', 'u1'),		# from 1 to 8
+						 ('dsp_type', 'u1'),
+						 ('N', '<u4'),			# meaning depends on dsp_type
+						 ('np_cont', '<u2'),	# number of points in continuous acquisition
+						 ('timestamp', '<u8')])
+
+
+def walk_packets(data):
+	'''
+	Position of the header of every packet of a stream
+	Input:
+		data(int16 array): words sent by the ADCs
+	Output:
+		(positions, sizes): int arrays of the position of every header and of
+		the number of data words following it
+	'''
+	words = data.view(np.uint16)
+	positions = []
+	sizes = []
+	i = 0
+	Np = None
+	while i + 8 <= len(words):
+		DSPTYPE = words.item(i) >> 8
+		if (DSPTYPE & 0x2) != 2:
+			if (DSPTYPE & 0x1) == 0:
+				Np = words.item(i+1) | (words.item(i+2) << 16)
+			else:
+				Np = 8
+		elif (DSPTYPE & 0x3) == 0x3:
+			Np = words.item(i+3)
+		elif Np is None:
+			raise ValueError('Unknown packet type {} at the start of the data'.format(DSPTYPE))
+		# otherwise the packet has the size of the previous one
+		positions.append(i)
+		sizes.append(Np)
+		i += 8 + Np
+	return np.array(positions, dtype=int), np.array(sizes, dtype=int)
+
+
+def fixed_stride_packets(data, n_rep, stride):
+	'''
+	Position of the headers when every repetition of the sequence sends the
+	same packets: the first repetition is walked and repeated n_rep times
+	Output:
+		int array of the header positions, None if the layout is not regular
+	'''
+	if stride is None or n_rep is None or stride <= 0 or len(data) != n_rep*stride:
+		return None
+	try:
+		first, sizes = walk_packets(data[:stride])
+	except ValueError:
+		return None
+	if len(first) == 0 or first[-1] + 8 + sizes[-1] != stride:
+		return None
+	positions = (stride*np.arange(n_rep))[:,None] + first[None,:]
+	# channel, type and sizes of every repetition (the timestamps differ)
+	headers = data[positions[:,:,None] + np.arange(4)]
+	if not np.array_equal(headers, np.broadcast_to(headers[:1], headers.shape)):
+		return None
+	return positions.ravel()
+
+
+def decode_packets(data, n_rep=None, stride=None):
+	'''
+	Decode the packets sent by the ADCs, in the same way as the packet by packet
+	loop of get_readout_pulse did
+	Input:
+		data(int array): words sent by the ADCs, int16 values
+		n_rep(int), stride(int): number of repetitions of the sequence and number
+		of words sent per repetition, to take the fixed stride fast path
+	Output:
+		(adcdataI, adcdataQ): data of the 8 channels, in volts
+	'''
+	data = np.asarray(data, dtype=np.int16)
+	positions = fixed_stride_packets(data, n_rep, stride)
+	if positions is None:
+		positions = walk_packets(data)[0]
+
+	headers = np.ascontiguousarray(data[positions[:,None] + np.arange(8)]).view(HEADER_DTYPE)[:,0]
+	V = headers['channel'].astype(int) - 1
+	if np.any((V < -8) | (V > 7)):
+		raise IndexError('Wrong channel in the header of a packet')
+	V = V % 8	# a channel 0 is stored as channel 8, as with list indexing
+	DSPTYPE = headers['dsp_type']
+	N = headers['N'].astype(np.int64)
+	iStart = positions + 8
+
+	raw = (DSPTYPE & 0x3) == 0x0
+	iq = (DSPTYPE & 0x3) == 0x1
+	cont = (DSPTYPE & 0x3) == 0x3
+
+	# number of I and Q points of every packet
+	count_I = np.zeros(len(positions), dtype=int)
+	count_Q = np.zeros(len(positions), dtype=int)
+	count_I[raw] = np.minimum(N[raw], len(data) - iStart[raw])
+	count_I[iq] = 1
+	count_Q[iq] = 1
+	cont_I, cont_Q = {}, {}
+	for k in np.flatnonzero(cont):
+		# continuous acquisition, not used for now: sliced as in the loop
+		Np = int(headers['np_cont'][k])
+		if (DSPTYPE[k] & 0x20) == 0x0:
+			cont_I[k] = np.right_shift(data[iStart[k]:iStart[k]+Np].astype(int),4)*0.3838e-3
+		else:
+			cont_I[k] = np.right_shift(data[iStart[k]:Np:2].astype(int),4)*0.3838e-3
+			cont_Q[k] = np.right_shift(data[iStart[k]+1:Np:2].astype(int),4)*0.3838e-3
+			count_Q[k] = len(cont_Q[k])
+		count_I[k] = len(cont_I[k])
+
+	offset_I = np.cumsum(count_I) - count_I
+	offset_Q = np.cumsum(count_Q) - count_Q
+	values_I = np.empty(count_I.sum())
+	values_Q = np.empty(count_Q.sum())
+
+	# raw adcdata: Np = N points per packet
+	index = _ranges(iStart[raw], count_I[raw])
+	values_I[_ranges(offset_I[raw], count_I[raw])] = np.right_shift(data[index].astype(int),4)*0.3838e-3
+
+	# accumulation: one I and one Q point per packet, signed 64 bits
+	IQ = np.ascontiguousarray(data[iStart[iq][:,None] + np.arange(8)]).view(np.int64)
+	values_I[offset_I[iq]] = IQ[:,0]*(0.3838e-3)/(N[iq]*2*4)
+	values_Q[offset_Q[iq]] = IQ[:,1]*(0.3838e-3)/(N[iq]*2*4)
+
+	for k in cont_I:
+		values_I[offset_I[k]:offset_I[k]+count_I[k]] = cont_I[k]
+	for k in cont_Q:
+		values_Q[offset_Q[k]:offset_Q[k]+count_Q[k]] = cont_Q[k]
+
+	adcdataI = [[],[],[],[],[],[],[],[]]
+	adcdataQ = [[],[],[],[],[],[],[],[]]
+	channel_I = np.repeat(V, count_I)
+	channel_Q = np.repeat(V, count_Q)
+	for v in set(V[raw | iq | cont]):
+		adcdataI[v] = values_I[channel_I == v]
+	for v in set(V[iq | (cont & ((DSPTYPE & 0x20) == 0x20))]):
+		adcdataQ[v] = values_Q[channel_Q == v]
+	return adcdataI, adcdataQ
+
+
+def valid_repetitions(data, stride, channels=None):
+	'''
+	Number of repetitions at the start of a stream which can be kept: every
+	repetition is complete, has the packets of the first one (channel, type and
+	size in the header) and its timestamps follow the previous packets
+	Input:
+		data(int16 array): words received since the start of the sequencer
+		stride(int): number of words sent per repetition
+		channels(list): sorted channels (1 to 8) of the packets of a repetition,
+		not checked if None
+	Output:
+		number of valid repetitions
+	'''
+	data = np.asarray(data, dtype=np.int16)
+	n = len(data)//stride if stride > 0 else 0
+	if n == 0:
+		return 0
+	try:
+		first, sizes = walk_packets(data[:stride])
+	except ValueError:
+		return 0
+	if len(first) == 0 or first[-1] + 8 + sizes[-1] != stride:
+		return 0
+	positions = (stride*np.arange(n))[:,None] + first[None,:]
+	headers = np.ascontiguousarray(data[positions[:,:,None] + np.arange(8)]).view(HEADER_DTYPE)[...,0]
+	if channels is not None and sorted(headers['channel'][0].tolist()) != list(channels):
+		return 0
+	same = np.all(data[positions[:,:,None] + np.arange(4)] == data[first[:,None] + np.arange(4)], axis=(1,2))
+	timestamps = headers['timestamp'].ravel()
+	ordered = np.ones(n*len(first), dtype=bool)
+	ordered[1:] = timestamps[1:] >= timestamps[:-1]
+	valid = same & ordered.reshape(n, len(first)).all(axis=1)
+	return n if valid.all() else int(np.argmin(valid))
+
+
+def repeat_sequence(sequence_str, n_rep):
+	'''
+	SEQ command of a compiled sequence, run n_rep times instead
+	'''
+	words = sequence_str.split(',')
+	if len(words) < 7 or words[5] != '257':
+		raise ValueError('No repetition loop at the start of the sequence')
+	words[6] = str(int(n_rep-1))
+	return ','.join(words)
+
+
+def DAC_command(ch, waveform):
+	'''
+	SCPI command writing the memory of a DAC channel, None for an empty waveform
+	'''
+	if len(waveform) == 0:
+		return None
+	return 'DAC:DATA:CH' + str(ch) + ' 0,' + ','.join(map(str, waveform.astype(int).tolist())) + ',0,0,0,0,0,0,0,0,0,0,16383'
+
+
+def is_empty_reply(r):
+	'''
+	True for an OUTPUT:DATA? reply without data: the termination read as a
+	single int16 word
+	'''
+	return not isinstance(r, str) and len(r) == 1 and r[0] in (3338, 2573)
+
+
+def _ranges(starts, counts):
+	'''
+	Concatenation of the ranges [start, start+count)
+	'''
+	offsets = np.cumsum(counts) - counts
+	return np.repeat(starts - offsets, counts) + np.arange(counts.sum())
+
+
+class ReadoutPoller:
+	'''
+	Interval between two OUTPUT:DATA? queries of a readout, tuned from the fill
+	rate of the instrument buffer, and log of the queries.
+	After a reply with data, the next query waits for the time the instrument
+	needs to produce target_words at the rate observed so far, or is sent at
+	once if the reply was as large as the largest one seen (the buffer most
+	likely holds more). After an empty reply the interval doubles, from
+	interval_min up to interval_max.
+	Input:
+		interval_min, interval_max(float): bounds of the interval (s)
+		target_words(int): size of the replies aimed at (words)
+	'''
+	def __init__(self, interval_min=1e-3, interval_max=0.1, target_words=2**16):
+
+		self.interval_min = interval_min
+		self.interval_max = interval_max
+		self.target_words = target_words
+		self.t_start = time.perf_counter()
+		self.latencies = []		# duration of every query (s)
+		self.sizes = []			# words of every reply, 0 for an empty reply or ERR
+		self.restart()
+
+	def restart(self):
+		'''
+		Forget the fill rate, when the sequence is started again
+		'''
+		self.rate = None		# fill rate (words/s)
+		self.largest = 0
+		self.idle = 0.			# time since the last reply with data (s)
+		self._t_data = time.perf_counter()
+		self._interval_empty = self.interval_min
+
+	def query(self, ask, cmd='OUTPUT:DATA?'):
+		'''
+		Send cmd with ask and log the duration and the size of the reply
+		'''
+		t0 = time.perf_counter()
+		r = ask(cmd)
+		self.latencies.append(time.perf_counter() - t0)
+		self.sizes.append(0 if isinstance(r, str) or is_empty_reply(r) else len(r))
+		return r
+
+	def after_data(self, n_words):
+		'''
+		Output:
+			interval before the next query (s), after a reply of n_words words
+		'''
+		now = time.perf_counter()
+		rate = n_words/max(now - self._t_data, 1e-9)
+		self.rate = rate if self.rate is None else 0.5*(self.rate + rate)
+		self._t_data = now
+		self.idle = 0.
+		self._interval_empty = self.interval_min
+		if n_words >= self.largest:
+			self.largest = n_words
+			return self.interval_min
+		interval = self.target_words/self.rate - self.latencies[-1]
+		return min(max(interval, self.interval_min), self.interval_max)
+
+	def after_empty(self):
+		'''
+		Output:
+			interval before the next query (s), after an empty reply
+		'''
+		interval = self._interval_empty
+		self._interval_empty = min(2*interval, self.interval_max)
+		self.idle = time.perf_counter() - self._t_data
+		return interval
+
+	def stats(self):
+		'''
+		Output:
+			transfer_stats of the queries logged since the creation
+		'''
+		return transfer_stats(self.latencies, self.sizes, time.perf_counter() - self.t_start)
+
+
+def transfer_stats(latencies, sizes, duration, word_size=2):
+	'''
+	Throughput of a series of queries
+	Input:
+		latencies(list): duration of every query (s)
+		sizes(list): number of words of every reply, 0 for an empty reply
+		duration(float): wall time of the series, waits included (s)
+		word_size(int): bytes per word
+	Output:
+		dict with the number of queries and of packets (replies with data), the
+		bytes received, MBps over the wall time, link_MBps over the time spent
+		in the queries with data, packets_per_s, and the latency percentiles
+		of the queries in ms
+	'''
+	latencies = np.asarray(latencies, dtype=float)
+	sizes = np.asarray(sizes, dtype=int)
+	full = sizes > 0
+	n_bytes = int(sizes.sum())*word_size
+	t_link = latencies[full].sum()
+	stats = dict(queries=len(sizes), packets=int(full.sum()), bytes=n_bytes, duration=duration,
+				MBps=n_bytes/duration/1e6 if duration > 0 else 0.,
+				link_MBps=n_bytes/t_link/1e6 if t_link > 0 else 0.,
+				packets_per_s=full.sum()/duration if duration > 0 else 0.)
+	if len(latencies):
+		for q in (50, 90, 99):
+			stats['latency_p{}_ms'.format(q)] = 1e3*np.percentile(latencies, q)
+		stats['latency_max_ms'] = 1e3*latencies.max()
+	return stats
+
+
+
+
 
 
 class GeneratedSetPoints(Parameter):
@@ -61,19 +445,74 @@ class GeneratedSetPoints(Parameter):
 							  self._numpointsparam())
 
 
+class Acquisition:
+	'''
+	Result of one readout: the data returned by get_readout_pulse, and the power
+	of every ADC pulse, computed once for the 8 channels. It is shared by the
+	parameters read inside a shared_acquisition block (see RFSoC.acquire).
+	Input:
+		I, Q: data returned by get_readout_pulse
+		mode_arr(array): acquisition mode of the 8 channels, 0=RAW; 1=IQ
+		complete(bool): False for a partial readout
+	'''
+	def __init__(self, I, Q, mode_arr, complete=True):
+
+		self.I = I
+		self.Q = Q
+		self.mode_arr = np.array(mode_arr)
+		self.complete = complete
+		self._power = None
+
+	@property
+	def power(self):
+		'''
+		RMS power (W) of every pulse of the 8 channels, (I**2 + Q**2)/(2*50)
+		averaged over the repetitions in IQ mode, I**2/(2*50) averaged over the
+		averaged trace in RAW mode (over every repetition without average_RAW)
+		'''
+		if self._power is None:
+			self._power = self._compute_power()
+		return self._power
+
+	@property
+	def power_dBm(self):
+
+		return [10*np.log10(1e3*p) for p in self.power]
+
+	def _compute_power(self):
+
+		power = [np.array([]) for v in range(8)]
+		# IQ mode: a row per pulse, a column per repetition, for all the channels
+		rows_I, rows_Q, channels = [], [], []
+		for v in range(8):
+			if self.mode_arr[v] and np.size(self.I[v]) > 0:
+				I = np.asarray(self.I[v])
+				n_pulses, n_rep = I.shape
+				rows_I.append(I)
+				rows_Q.append(np.reshape(self.Q[v], (n_rep, n_pulses)).T)
+				channels.append((v, n_pulses))
+		if channels:
+			square = (np.concatenate(rows_I)**2).mean(axis=1) + (np.concatenate(rows_Q)**2).mean(axis=1)
+			split = np.split(square/(50*2), np.cumsum([n for v, n in channels])[:-1])
+			for (v, n), p in zip(channels, split):
+				power[v] = p
+		# RAW mode: a trace per pulse, of any length
+		for v in range(8):
+			if not self.mode_arr[v] and len(self.I[v]) > 0:
+				power[v] = np.array([np.mean(trace**2)/(50*2) for trace in self.I[v] if len(trace) > 0])
+		return power
+
+
 class BUFFER_DATA(Parameter):
 
 	def __init__(self, *args, **kwargs):
 		super().__init__(*args, **kwargs)
 
 	def get_raw(self):
-		time.sleep(0.2)
-
-		data_ret_I, data_ret_Q = self._instrument.get_readout_pulse()
 
-		self._instrument.buffer_readout_data = data_ret_I, data_ret_Q
+		result = self._instrument.acquire(self)
 
-		return data_ret_I, data_ret_Q
+		return result.I, result.Q
 
 
 class ADC_DATA(Parameter):
@@ -83,23 +522,14 @@ class ADC_DATA(Parameter):
 		self._channel = channel
 
 	def get_raw(self):
-		time.sleep(0.2)
 
-		buffer_data = self._instrument._parent.buffer_readout_data
-
-		if not buffer_data:
-			print("Buffer hasn't been read yet.\n")
+		if self._channel not in np.arange(1,9):
+			log.warning('Wrong parameter.')
 			return [[], []]
 
-		dataI, dataQ = buffer_data
-
-		if self._channel in np.arange(1,9):
-			data_ret_I = dataI[self._channel-1]
-			data_ret_Q = dataI[self._channel-1]
-		else:
-			log.warning('Wrong parameter.')
+		result = self._instrument._parent.acquire(self)
 
-		return data_ret_I, data_ret_Q
+		return result.I[self._channel-1], result.Q[self._channel-1]
 
 
 class ADC_power(Parameter):
@@ -109,30 +539,7 @@ class ADC_power(Parameter):
 
 	def get_raw(self):
 
-		time.sleep(0.2)
-
-		data_retI, data_retQ = self._instrument.get_readout_pulse()#.get_readout_pulse() ###### Martina 08/11/2020
-
-		Sq_I_list = [[],[],[],[],[],[],[],[]]
-		Sq_Q_list = [[],[],[],[],[],[],[],[]]
-		Pow = [[],[],[],[],[],[],[],[]]
-
-		for i in range(8):
-
-			if len(data_retI[i])>0:
-
-				for j in range(len(data_retI[i])):
-
-					if len(data_retI[i][j])>0:
-
-						Sq_I_list[i].append(np.mean(data_retI[i][j]**2))
-						Sq_Q_list[i].append(np.mean(data_retQ[i][j]**2))
-
-		for i in range(8):
-
-			Pow[i] = (np.array(Sq_I_list[i]) + np.array(Sq_Q_list[i]))/(50*2)	# RMS power
-
-		return Pow
+		return self._instrument.acquire(self).power
 
 
 class ADC_power_dBm(Parameter):
@@ -142,30 +549,7 @@ class ADC_power_dBm(Parameter):
 
 	def get_raw(self):
 
-		time.sleep(0.2)
-
-		data_retI, data_retQ = self._instrument.get_readout_pulse()#.get_readout_pulse() ###### Martina 08/11/2020
-
-		Sq_I_list = [[],[],[],[],[],[],[],[]]
-		Sq_Q_list = [[],[],[],[],[],[],[],[]]
-		Pow = [[],[],[],[],[],[],[],[]]
-
-		for i in range(8):
-
-			if len(data_retI[i])>0:
-
-				for j in range(len(data_retI[i])):
-
-					if len(data_retI[i][j])>0:
-
-						Sq_I_list[i].append(np.mean(data_retI[i][j]**2))
-						Sq_Q_list[i].append(np.mean(data_retQ[i][j]**2))
-
-		for i in range(8):
-
-			Pow[i] = 10*np.log10(1e3*(np.array(Sq_I_list[i]) + np.array(Sq_Q_list[i]))/(50*2))		# RMS power
-
-		return Pow
+		return self._instrument.acquire(self).power_dBm
 
 
 
@@ -272,6 +656,9 @@ class RFSoC(VisaInstrument):
 		self.length_vec = [[],[],[],[],[],[],[],[]] 	# length of points to be acquired on each channel
 		self.ch_vec = []
 		self.adc_mode_arr = np.array([1] * 8, dtype=int) # 0=RAW; 1=IQ (default)
+		# RAW traces averaged over the repetitions; False keeps every repetition:
+		# a trace is then an array (repetitions, points)
+		self.average_RAW = True
 
 		self.display_sequence = True
 		self.display_IQ_progress = True
@@ -282,6 +669,39 @@ class RFSoC(VisaInstrument):
 		self.buffer_readout_data = []
 		self.raw_dump_location = "C:/Data_tmp"
 
+		# last readout, made acquisition_delay seconds after the request. It is
+		# shared by BUFFER_DATA, ADC_DATA, ADC_power and ADC_power_dBm inside a
+		# shared_acquisition block only (see acquire)
+		self.acquisition = None
+		self.acquisition_delay = 0.2
+		self._shared_depth = 0
+
+		# polling of OUTPUT:DATA? during a readout, see ReadoutPoller; the
+		# readout is restarted after readout_timeout seconds without data
+		self.poll_interval_min = 1e-3
+		self.poll_interval_max = 0.1
+		self.poll_target_words = 2**16
+		self.readout_timeout = 2.
+		self.readout_poller = None
+
+		# after a glitch, the valid repetitions are kept and the missing ones
+		# acquired again, readout_retries times at most: then the readout returns
+		# the valid repetitions only, with readout_complete False. recovery_stats
+		# counts the glitches by cause, the repetitions kept at the glitches and
+		# recovered after them, the partial readouts and the words drained
+		self.readout_retries = 5
+		self.drain_time = 0.2
+		self.readout_complete = True
+		self.recovery_stats = {'readouts': 0, 'ERR': 0, 'timeout': 0, 'invalid': 0,
+							   'kept': 0, 'recovered': 0, 'partial': 0, 'discarded': 0}
+
+		# compiled sequences, by sequence_key, and last command sent to every
+		# DAC memory and to the sequencer
+		self.sequence_cache_size = 32
+		self._sequence_cache = OrderedDict()
+		self._uploaded = {}
+		self.sequence_stats = {'hit': 0, 'miss': 0, 'sent': 0, 'skipped': 0}
+
 		# Add the channels to the instrument in a channel list
 		channels = ChannelList(self, "AcqChannels", AcqChannel)
 		self.add_submodule("channels", channels)
@@ -374,187 +794,315 @@ class RFSoC(VisaInstrument):
 
 		log.info('Started sequence processing'+'  \n')
 
-		n_rep = self.n_rep()
-		pulses_raw_df = self.pulses
+		# a new sequence: the readout shared so far is dropped
+		self.acquisition = None
 
-		if len(set(pulses_raw_df['label'])) < len(pulses_raw_df['label']):
+		# the sequence is compiled once for a given table and settings
+		key = self.sequence_key()
+		compiled = self._sequence_cache.get(key)
+		if compiled is None:
 
-			log.error('Duplicate Labels: Labels need to be unique for consistent identification of pulse hierarchy.')
+			self.sequence_stats['miss'] += 1
+			global_sequence_str, DAC_pulses_array, pulses_list = self.compile_sequence()
+			DAC_SCPI_cmds = [DAC_command(i+1, DAC_pulses_array[i]) for i in range(8)]
+			compiled = dict(global_sequence_str=global_sequence_str, DAC_pulses_array=DAC_pulses_array, DAC_SCPI_cmds=DAC_SCPI_cmds, pulses_list=pulses_list, readout=self.readout_settings())
+			self._sequence_cache[key] = compiled
+			if len(self._sequence_cache) > self.sequence_cache_size:
+				self._sequence_cache.popitem(last=False)
 
-		pulses_raw_df.set_index('label', inplace = True)
+		else:
 
-		if self.debug_mode:
+			self.sequence_stats['hit'] += 1
+			self._sequence_cache.move_to_end(key)
+			self.restore_readout_settings(compiled['readout'])
+			log.info('Sequence already compiled'+'  \n')
+
+		if self.display_sequence:
+			self.plot_sequence(compiled['pulses_list'])
+
+		# just to keep in log
+		self.sequence_str = compiled['global_sequence_str']
 
-			display(pulses_raw_df)
+		for i in range(8):
 
-		resolve_hierarchy = True
-		while resolve_hierarchy:
+			DAC_SCPI_cmd = compiled['DAC_SCPI_cmds'][i]
 
-			for index, row in pulses_raw_df.iterrows():
+			if DAC_SCPI_cmd is not None:
 
-				if row['parent'] != None:
+				if self.debug_mode and self.debug_mode_plot_waveforms:
 
-					if pulses_raw_df.loc[row['parent']]['parent'] == None:
+					fig = plt.figure(figsize=(8,5))
+					plt.plot(range(len(compiled['DAC_pulses_array'][i])),compiled['DAC_pulses_array'][i])
+					plt.grid()
+					plt.legend(fontsize = 14)
+					plt.show()
 
-						pulses_raw_df.loc[index,'start'] = pulses_raw_df.loc[index,'start'] +  pulses_raw_df.loc[row['parent']]['start'] + pulses_raw_df.loc[row['parent']]['length']
-						pulses_raw_df.loc[index,'parent'] = None
+				if self.debug_mode and self.debug_mode_waveform_string:
 
-			resolve_hierarchy = False
-			for val in pulses_raw_df['parent']:
-				if val != None:
-					resolve_hierarchy = True
+					print('DAC sequence for CH '+str(i+1)+': ',DAC_SCPI_cmd)
+
+				log.info('Writing waveform for CH'+str(i+1)+'  \n')
+				self.upload('DAC:DATA:CH{}'.format(str(i+1)), DAC_SCPI_cmd)
+
+		log.info('Writing global sequence' + '\n')
+		self.upload('SEQ', compiled['global_sequence_str'])
+
+		log.info('Waveform and sequence processing complete' + '\n')
+
+
+	def sequence_key(self, pulses=None):
+		'''
+		Hash of everything the compiled sequence depends on: the content of the
+		pulse table, n_rep, freq_sync, the settings of the ADC channels and the
+		clocks and DAC calibration
+		Input:
+			pulses(DataFrame or list of dict): default is self.pulses
+		'''
+		if pulses is None:
+			pulses = self.pulses
+		if isinstance(pulses, pd.DataFrame):
+			if 'label' not in pulses.columns:	# indexed by label
+				pulses = pulses.reset_index()
+			pulses = pulses.to_dict('records')
+
+		# the acquisition mode of a channel with pulses is set by the table
+		ADC_pulses = set(int(pulse['channel']) for pulse in pulses if pulse['module'] == 'ADC')
+		ADC_settings = [[ch.parameters[name].cache.get(get_if_invalid=False) for name in ['status', 'decfact', 'fmixer']]
+						+ [None if ch._adc_channel in ADC_pulses else ch.acquisition_mode()] for ch in self.channels]
+		content = dict(pulses=pulses, n_rep=self.n_rep(), freq_sync=self.freq_sync(), ADC=ADC_settings,
+					   sampling_rate=self.sampling_rate, FPGA_clock=self.FPGA_clock, DAC_amplitude_calib=self.DAC_amplitude_calib)
+		return hashlib.sha1(json.dumps(_canonical(content), sort_keys=True).encode()).hexdigest()
+
+
+	def readout_settings(self):
+		'''
+		Settings of the readout set by compile_sequence
+		'''
+		return dict(length_vec=[list(v) for v in self.length_vec], ch_vec=list(self.ch_vec),
+					ADC_ch_active=np.array(self.ADC_ch_active), adc_mode_arr=np.array(self.adc_mode_arr),
+					acquisition_mode=[ch.acquisition_mode() for ch in self.channels])
+
+
+	def restore_readout_settings(self, settings):
+
+		self.length_vec = [list(v) for v in settings['length_vec']]
+		self.ch_vec = list(settings['ch_vec'])
+		self.ADC_ch_active = np.array(settings['ADC_ch_active'])
+		self.adc_mode_arr = np.array(settings['adc_mode_arr'])
+		for ch, mode in zip(self.channels, settings['acquisition_mode']):
+			if mode is not None:
+				ch.acquisition_mode(mode)
+
+
+	def upload(self, target, cmd):
+		'''
+		Write a DAC waveform or the sequence, unless the instrument already holds it
+		Input:
+			target(str): 'DAC:DATA:CH1'... or 'SEQ'
+			cmd(str): SCPI command
+		Output:
+			True if the command was sent
+		'''
+		if self._uploaded.get(target) == cmd:
+			self.sequence_stats['skipped'] += 1
+			log.info(target + ' unchanged'+'  \n')
+			return False
+
+		if target.startswith('DAC:DATA'):
+			self.write(target + ':CLEAR')
+		self.write(cmd)
+		self._uploaded[target] = cmd
+		self.sequence_stats['sent'] += 1
+		return True
+
+
+	def update_DAC_pulse(self, label, **param):
+		'''
+		Change waveform parameters of a DAC pulse of the sequence (amp,
+		phase_offset...) without compiling the sequence again: only the memory
+		of the channel of the pulse is written, the sequencer program is kept
+		Input:
+			label(str): label of the pulse in the pulse table
+			param: new values of the parameters, which must not change the
+			length of the waveform
+		Output:
+			True if a DAC memory was written
+		'''
+		key = self.sequence_key()
+		if key not in self._sequence_cache:
+			self.process_sequencing()
+		compiled = self._sequence_cache[key]
+
+		pulses_list = [dict(pulse) for pulse in compiled['pulses_list']]
+		matches = [pulse for pulse in pulses_list if pulse['label'] == label and pulse['module'] == 'DAC' and 'DAC_address' in pulse]
+		if len(matches) != 1:
+			raise ValueError('No DAC pulse labeled ' + str(label) + ' in the sequence')
+		pulse = matches[0]
+		ch = int(pulse['ch_num'])
+		new_param = dict(pulse['param'], **param)
+
+		waveform = self.pulse_gen_SCPI(pulse['mode'], new_param, pulse['time'], ch)
+		if len(waveform) != pulse['DAC_length']:
+			raise ValueError('The new parameters change the length of the waveform of ' + str(label) + ': process_sequencing is needed')
+		DAC_pulses_array = list(compiled['DAC_pulses_array'])
+		memory = DAC_pulses_array[ch-1].copy()
+		start = 11*pulse['DAC_address']
+		memory[start:start+len(waveform)] = waveform
+		DAC_pulses_array[ch-1] = memory
+		pulse['param'] = new_param
+
+		# the pulse table and the cache follow, so that process_sequencing with
+		# the new table finds the sequence loaded
+		pulses = self.pulses.copy() if isinstance(self.pulses, pd.DataFrame) else pd.DataFrame(self.pulses)
+		for index in pulses.index[pulses['label'] == label]:
+			pulses.at[index, 'param'] = new_param
+		self.pulses = pulses
+
+		DAC_SCPI_cmds = list(compiled['DAC_SCPI_cmds'])
+		DAC_SCPI_cmds[ch-1] = DAC_command(ch, memory)
+		updated = dict(compiled, DAC_pulses_array=DAC_pulses_array, DAC_SCPI_cmds=DAC_SCPI_cmds, pulses_list=pulses_list)
+		self._sequence_cache[self.sequence_key()] = updated
+		if len(self._sequence_cache) > self.sequence_cache_size:
+			self._sequence_cache.popitem(last=False)
+
+		# the other memories and the sequencer program are only written if the
+		# instrument does not hold them already
+		self.acquisition = None
+		sent = False
+		for i in range(8):
+			if DAC_SCPI_cmds[i] is not None:
+				sent |= self.upload('DAC:DATA:CH{}'.format(i+1), DAC_SCPI_cmds[i])
+		self.upload('SEQ', compiled['global_sequence_str'])
+		return sent
+
+
+	def forget_sequence(self):
+		'''
+		Forget the waveforms and the sequence held by the instrument (e.g. after a
+		reboot): the next process_sequencing writes them all
+		'''
+		self._uploaded = {}
+
+
+	def plot_sequence(self, pulses_list):
+
+		color_dict = {pulse['color']: '#{0:06X}'.format(int(pulse['color'])) for pulse in pulses_list}
+		fig = px.bar(pd.DataFrame(pulses_list), x="time", y="Channel", color='color', orientation='h', text="label",
+					 color_discrete_map=color_dict,
+					 hover_data=["start","stop"],
+					 height=300,
+					 title='pulse sequence')
+		fig.update_layout(showlegend=False)
+		fig.show()
+
+
+	def compile_sequence(self, pulses=None):
+		'''
+		Compile a pulse table into the sequencer program and the DAC waveforms,
+		without writing them to the instrument. The readout settings (length_vec,
+		ch_vec, ADC_ch_active, adc_mode_arr and the acquisition mode of the
+		channels) are updated for the sequence.
+		Input:
+			pulses(DataFrame or list of dict): pulse table with the label, module,
+			channel, mode, start, length, param and parent of every pulse,
+			default is self.pulses
+		Output:
+			global_sequence_str(str): SEQ command of the sequencer
+			DAC_pulses_array(list): waveforms of the 8 DAC channels
+			pulses_list(list of dict): pulses and waits of every channel, as
+			displayed by plot_sequence
+		'''
+		n_rep = self.n_rep()
+		if pulses is None:
+			pulses = self.pulses
+		if isinstance(pulses, pd.DataFrame):
+			if 'label' not in pulses.columns:	# indexed by label
+				pulses = pulses.reset_index()
+			pulses = pulses.to_dict('records')
+
+		labels = [pulse['label'] for pulse in pulses]
+		if len(set(labels)) < len(labels):
+
+			log.error('Duplicate Labels: Labels need to be unique for consistent identification of pulse hierarchy.')
+
+		if self.debug_mode:
+
+			display(pd.DataFrame(pulses))
+
+		starts = resolve_hierarchy(labels, [pulse['start'] for pulse in pulses], [pulse['length'] for pulse in pulses], [pulse['parent'] for pulse in pulses])
 
 		if self.debug_mode:
 
 			print('Hierarchy resolution...')
-			display(pulses_raw_df)
+			display(pd.DataFrame(pulses).assign(start=starts))
 
-		pulses_df = pd.DataFrame()
-		time_ADC = [0,0,0,0,0,0,0,0]
-		time_DAC = [0,0,0,0,0,0,0,0]
+		'''
+			Pulses and waits of every channel
+		'''
+		pulses_list = []
+		time_channel = {'ADC': [0,0,0,0,0,0,0,0], 'DAC': [0,0,0,0,0,0,0,0]}
 		length_vec = [[],[],[],[],[],[],[],[]]
 		ch_vec = []
 		adc_pulse_mode_vec = np.zeros(8)
 		wait_color_count = int("D3D3D3", 16)
-		DAC_color_count = int("306cc7", 16)
-		ADC_color_count = int("db500b", 16)
-		color_dict = {}
+		color_count = {'ADC': int("db500b", 16), 'DAC': int("306cc7", 16)}
 		termination_time = 0
 
-		tmp_df = pulses_raw_df.loc[pulses_raw_df['module'] == 'ADC']
-		for index, row in tmp_df.iterrows():
-
-			if row['start'] > time_ADC[int(row['channel'])-1]:
-
-				label = 'wait' + str(wait_color_count-int("D3D3D3", 16)+1)
-				start = time_ADC[int(row['channel'])-1]
-				stop = row['start']
-				time = row['start'] - time_ADC[int(row['channel'])-1]
-				module = row['module']
-				Channel = 'ADC ch' + str(int(row['channel']))
-				mode = 'wait'
-				color = wait_color_count
-				wait_color_count += 1
-				color_dict[str(color)] = '#{0:06X}'.format(color)
-				param = row['param']
-				ch_num = row['channel']
-
-				pulses_df = pulses_df.append(dict(label=label, start=start, stop=stop, time=time, module=module , Channel=Channel, mode=mode, color=str(color), param=param, ch_num=ch_num), ignore_index=True)
-
-			label = index
-			start = row['start']
-			stop = row['start'] + row['length']
-			time = row['length']
-			module = row['module']
-			Channel = 'ADC ch' + str(int(row['channel']))
-			mode = row['mode']
-			color = ADC_color_count
-			ADC_color_count += 1
-			color_dict[str(color)] = '#{0:06X}'.format(color)
-			param = row['param']
-			ch_num = row['channel']
-
-			pulses_df = pulses_df.append(dict(label=label, start=start, stop=stop, time=time, module=module , Channel=Channel, mode=mode, color=str(color), param=param, ch_num=ch_num), ignore_index=True)
-
-			nb_points = int(time*1e-6*self.sampling_rate)
-			ch_vec.append(int(row['channel'])-1)
-
-			if mode == 'RAW':
-				length_vec[int(row['channel'])-1].append(nb_points)
-				self.channels[int(row['channel'])-1].acquisition_mode('RAW')
-			elif mode == 'IQ':
-				length_vec[int(row['channel'])-1].append(1)
-				self.channels[int(row['channel'])-1].acquisition_mode('IQ')
-				adc_pulse_mode_vec[int(row['channel'])-1] += 1
-			else:
-				log.error('Invalid acquisition mode on a pulse from ' + Channel + ', IQ mode will be used by default\n')
-				length_vec[int(row['channel'])-1].append(1)
-				self.channels[int(row['channel'])-1].acquisition_mode('IQ')
-
-			time_ADC[int(row['channel'])-1] = stop
-
-			if stop>termination_time:
+		def add_pulse(label, start, stop, time, module, ch, mode, color, param):
 
-				termination_time = stop
+			pulses_list.append(dict(label=label, start=start, stop=stop, time=time, module=module, Channel=module + ' ch' + str(ch), mode=mode, color=str(color), param=param, ch_num=ch))
 
-		tmp_df = pulses_raw_df.loc[pulses_raw_df['module'] == 'DAC']
-		for index, row in tmp_df.iterrows():
+		for module in ['ADC', 'DAC']:
 
-			if row['start'] > time_DAC[int(row['channel'])-1]:
+			time_ch = time_channel[module]
 
-				label = 'wait' + str(wait_color_count-int("D3D3D3", 16)+1)
-				start = time_DAC[int(row['channel'])-1]
-				stop = row['start']
-				time = row['start'] - time_DAC[int(row['channel'])-1]
-				module = row['module']
-				Channel = 'DAC ch' + str(int(row['channel']))
-				mode = 'wait'
-				color = wait_color_count
-				wait_color_count += 1
-				color_dict[str(color)] = '#{0:06X}'.format(color)
-				param = row['param']
-				ch_num = row['channel']
+			for pulse, start in zip(pulses, starts):
 
-				pulses_df = pulses_df.append(dict(label=label, start=start, stop=stop, time=time, module=module , Channel=Channel, mode=mode, color=str(color), param=param, ch_num=ch_num), ignore_index=True)
+				if pulse['module'] != module:
+					continue
 
-			label = index
-			start = row['start']
-			stop = row['start'] + row['length']
-			time = row['length']
-			module = row['module']
-			Channel = 'DAC ch' + str(int(row['channel']))
-			mode = row['mode']
-			color = DAC_color_count
-			DAC_color_count += 1
-			color_dict[str(color)] = '#{0:06X}'.format(color)
-			param = row['param']
-			ch_num = row['channel']
+				ch = int(pulse['channel'])
+				if start > time_ch[ch-1]:
 
-			pulses_df = pulses_df.append(dict(label=label, start=start, stop=stop, time=time, module=module , Channel=Channel, mode=mode, color=str(color), param=param, ch_num=ch_num), ignore_index=True)
+					add_pulse('wait' + str(wait_color_count-int("D3D3D3", 16)+1), time_ch[ch-1], start, start - time_ch[ch-1], module, ch, 'wait', wait_color_count, pulse['param'])
+					wait_color_count += 1
 
-			time_DAC[int(row['channel'])-1] = stop
+				stop = start + pulse['length']
+				add_pulse(pulse['label'], start, stop, pulse['length'], module, ch, pulse['mode'], color_count[module], pulse['param'])
+				color_count[module] += 1
 
-			if stop>termination_time:
+				if module == 'ADC':
 
-				termination_time = stop
+					nb_points = int(pulse['length']*1e-6*self.sampling_rate)
+					ch_vec.append(ch-1)
 
-		for ch in range(1,9):
+					if pulse['mode'] == 'RAW':
+						length_vec[ch-1].append(nb_points)
+						self.channels[ch-1].acquisition_mode('RAW')
+					elif pulse['mode'] == 'IQ':
+						length_vec[ch-1].append(1)
+						self.channels[ch-1].acquisition_mode('IQ')
+						adc_pulse_mode_vec[ch-1] += 1
+					else:
+						log.error('Invalid acquisition mode on a pulse from ADC ch' + str(ch) + ', IQ mode will be used by default\n')
+						length_vec[ch-1].append(1)
+						self.channels[ch-1].acquisition_mode('IQ')
 
-			if termination_time>time_ADC[ch-1] and time_ADC[ch-1]>0:
+				time_ch[ch-1] = stop
 
-				label = 'wait' + str(wait_color_count-int("D3D3D3", 16)+1)
-				start = time_ADC[ch-1]
-				stop = termination_time
-				time = stop - start
-				module = 'ADC'
-				Channel = 'ADC ch' + str(ch)
-				mode = 'wait'
-				color = wait_color_count
-				wait_color_count += 1
-				color_dict[str(color)] = '#{0:06X}'.format(color)
-				param = row['param']
-				ch_num = ch
+				if stop>termination_time:
 
-				pulses_df = pulses_df.append(dict(label=label, start=start, stop=stop, time=time, module=module , Channel=Channel, mode=mode, color=str(color), param=param, ch_num=ch_num), ignore_index=True)
+					termination_time = stop
 
-		for ch in range(1,9):
+		# waits until the end of the sequence
+		for module in ['ADC', 'DAC']:
 
-			if termination_time>time_DAC[ch-1] and time_DAC[ch-1]>0:
+			for ch in range(1,9):
 
-				label = 'wait' + str(wait_color_count-int("D3D3D3", 16)+1)
-				start = time_DAC[ch-1]
-				stop = termination_time
-				time = stop - start
-				module = 'DAC'
-				Channel = 'DAC ch' + str(ch)
-				mode = 'wait'
-				color = wait_color_count
-				wait_color_count += 1
-				color_dict[str(color)] = '#{0:06X}'.format(color)
-				param = row['param']
-				ch_num = ch
+				if termination_time>time_channel[module][ch-1] and time_channel[module][ch-1]>0:
 
-				pulses_df = pulses_df.append(dict(label=label, start=start, stop=stop, time=time, module=module , Channel=Channel, mode=mode, color=str(color), param=param, ch_num=ch_num), ignore_index=True)
+					add_pulse('wait' + str(wait_color_count-int("D3D3D3", 16)+1), time_channel[module][ch-1], termination_time, termination_time - time_channel[module][ch-1], module, ch, 'wait', wait_color_count, None)
+					wait_color_count += 1
 
 		# Check that no ADC channel was asked to change modes
 		for ch in range(1,9):
@@ -564,63 +1112,56 @@ class RFSoC(VisaInstrument):
 			if (adc_pulse_mode_vec[ch-1] != 0.) and (adc_pulse_mode_vec[ch-1] != 1.):
 				raise ValueError('ADCs cannot change acquisition mode mid-sequence. Please check the mode on all pulses from ADC' + str(ch) + '\n')
 
-		if self.display_sequence:
-			fig = px.bar(pulses_df, x="time", y="Channel", color='color', orientation='h', text="label",
-						 color_discrete_map=color_dict,
-						 hover_data=["start","stop"],
-						 height=300,
-						 title='pulse sequence')
-			fig.update_layout(showlegend=False)
-			fig.show()
-
 		self.length_vec = length_vec
 		self.ch_vec = ch_vec
 
-		event_time_list = list(dict.fromkeys(pulses_df['start']))
-		event_time_list.sort()
+		'''
+			Events: pulses and waits grouped by start time
+		'''
+		event_starts = np.array([pulse['start'] for pulse in pulses_list], dtype=float)
+		event_modules = np.array([pulse['module'] for pulse in pulses_list], dtype=object)
+		order = np.argsort(event_starts, kind='stable')
+		event_time_list, first_index = np.unique(event_starts[order], return_index=True)
+		events = np.split(order, first_index[1:])
 
-		termination_time = np.max(pulses_df['stop'])
+		termination_time = max(pulse['stop'] for pulse in pulses_list)
 
 		if self.debug_mode:
 
-			display(pulses_df)
-			display(pulses_df.sort_values('start'))
+			display(pd.DataFrame(pulses_list))
+			display(pd.DataFrame(pulses_list).sort_values('start'))
 
-			print('Events detected at: ',event_time_list)
+			print('Events detected at: ',list(event_time_list))
 
 			print('Termination of sequence detected at : ',termination_time)
 
-		global_sequence = np.array([])
+		'''
+			Sequencer program
+		'''
+		global_sequence = []
 		event_time_prev = 0
-		DAC_pulses_array = [np.array([]),np.array([]),np.array([]),np.array([]),np.array([]),np.array([]),np.array([]),np.array([])]
-		DAC_pulses_pointer = [[],[],[],[],[],[],[],[]]
-		ADC_state = np.array([0,0,0,0,0,0,0,0])
+		DAC_pulses_array = [[],[],[],[],[],[],[],[]]
+		DAC_pulses_size = [0,0,0,0,0,0,0,0]
+		ADC_state = 0	# bit ch-1 is set while ADC ch is acquiring
 		self.ADC_ch_active = np.array([0,0,0,0,0,0,0,0])
-		n_clock_cycles = 0
 		n_clock_cycles_global = 0
 
-
-		for event_time in event_time_list:
+		for event_time, event in zip(event_time_list, events):
 
 			# adding wait till this event
 			if event_time>0:
 
-				global_sequence = np.append(global_sequence,1)
-				global_sequence = np.append(global_sequence,int((event_time-event_time_prev)*250)-1)
-				n_clock_cycles_global = n_clock_cycles_global + int((event_time-event_time_prev)*250)
+				global_sequence += [1, int((event_time-event_time_prev)*250)-1]
+				n_clock_cycles_global += int((event_time-event_time_prev)*250)
 
-				if self.debug_mode:
-
-					print('adding wait till this event')
-					print(1,int((event_time-event_time_prev)*250)-1)
-
-			n_clock_cycles = 0
 			event_time_prev = event_time
-			tmp_df = pulses_df.loc[pulses_df['start'] == event_time]
-			tmp_df = tmp_df.sort_values(by='module', ascending=False)
 
+			# DAC before ADC, in the order of DataFrame.sort_values(by='module', ascending=False)
+			event = event[::-1][event_modules[event[::-1]].argsort(kind='quicksort')][::-1]
+
+			for index in event:
 
-			for index, row in tmp_df.iterrows():
+				row = pulses_list[index]
 
 				if self.debug_mode:
 
@@ -636,114 +1177,42 @@ class RFSoC(VisaInstrument):
 						SCPI_command = self.pulse_gen_SCPI(row['mode'],row['param'],row['time'],ch_num)
 
 						# adding pointer for this pulse
-						pulse_addr = int(len(DAC_pulses_array[ch_num-1])/11)
-						DAC_pulses_pointer[ch_num-1].append(pulse_addr)
-
-						# adding pulse to waveform
-						DAC_pulses_array[ch_num-1] = np.append(DAC_pulses_array[ch_num-1],SCPI_command)
-
-						# adding sequencer command to point to address of this pulse
-						n_clock_cycles += 1
-						global_sequence = np.append(global_sequence,4096+ch_num)
-						global_sequence = np.append(global_sequence,pulse_addr)
-
-						if self.debug_mode:
-
-							print('adding sequencer command to point to address of this pulse')
-							print(4096+ch_num,pulse_addr)
-
-						# adding sequencer command to start output
-						n_clock_cycles += 1
-						bin_trig_cmd = ''.join(ADC_state.astype(str))
-						for i in [8,7,6,5,4,3,2,1]:
-							if i == ch_num:
-								bin_trig_cmd += '011'
-							else:
-								bin_trig_cmd += '000'
-						global_sequence = np.append(global_sequence,4096)
-						global_sequence = np.append(global_sequence,int(bin_trig_cmd,2))
-
-						if self.debug_mode:
-
-							print('adding sequencer command to start output')
-							print(4096,int(bin_trig_cmd,2))
-
-					elif row['mode'] == 'wait':
-
-						# adding sequencer command to stop output
-						n_clock_cycles += 1
-						bin_trig_cmd = ''.join(ADC_state.astype(str))
-						for i in [8,7,6,5,4,3,2,1]:
-							if i == ch_num:
-								bin_trig_cmd += '001'
-							else:
-								bin_trig_cmd += '000'
-						global_sequence = np.append(global_sequence,4096)
-						global_sequence = np.append(global_sequence,int(bin_trig_cmd,2))
-
-						if self.debug_mode:
+						pulse_addr = int(DAC_pulses_size[ch_num-1]/11)
+						row['DAC_address'] = pulse_addr
+						row['DAC_length'] = len(SCPI_command)
+						DAC_pulses_array[ch_num-1].append(SCPI_command)
+						DAC_pulses_size[ch_num-1] += len(SCPI_command)
 
-							print('adding sequencer command to stop output')
-							print(4096,int(bin_trig_cmd,2))
+						# adding sequencer commands to point to address of this pulse and to start output
+						global_sequence += [4096+ch_num, pulse_addr, 4096, (ADC_state << 24) + (3 << 3*(ch_num-1))]
+						n_clock_cycles_global += 2
 
 					else:
 
-						log.error('Wrong pulse mode: ',event_time,row['mode'], row['label'])
+						# adding sequencer command to stop output
+						global_sequence += [4096, (ADC_state << 24) + (1 << 3*(ch_num-1))]
+						n_clock_cycles_global += 1
 
 				if row['module'] == 'ADC':
 
 					if row['mode'] != 'wait':
 
-						# adding sequencer command to set acq points
-						n_clock_cycles += 1
-						global_sequence = np.append(global_sequence,4106+ch_num)
-						global_sequence = np.append(global_sequence,int(row['time']*1e-6*self.sampling_rate))
-
-						if self.debug_mode:
-
-							print('adding sequencer command to set acq points')
-							print(4106+ch_num,int(row['time']*1e-6*self.sampling_rate))
-
-						# adding sequencer command to start acq
-						n_clock_cycles += 1
-						ADC_state[7-(ch_num-1)] = 1
+						# adding sequencer commands to set acq points and to start acq
+						ADC_state |= 1 << (ch_num-1)
 						self.ADC_ch_active[ch_num-1] = 1
-						bin_trig_cmd = ''.join(ADC_state.astype(str))+'000000000000000000000000'
-						global_sequence = np.append(global_sequence,4096)
-						global_sequence = np.append(global_sequence,int(bin_trig_cmd,2))
-
-						if self.debug_mode:
-
-							print('adding sequencer command to start acq')
-							print(4096,int(bin_trig_cmd,2))
-
-					elif row['mode'] == 'wait':
-
-						# adding sequencer command to stop acq
-						n_clock_cycles += 1
-						ADC_state[7-(ch_num-1)] = 0
-						bin_trig_cmd = ''.join(ADC_state.astype(str))+'000000000000000000000000'
-						global_sequence = np.append(global_sequence,4096)
-						global_sequence = np.append(global_sequence,int(bin_trig_cmd,2))
-
-						if self.debug_mode:
-
-							print('adding sequencer command to stop acq')
-							print(4096,int(bin_trig_cmd,2))
+						global_sequence += [4106+ch_num, int(row['time']*1e-6*self.sampling_rate), 4096, ADC_state << 24]
+						n_clock_cycles_global += 2
 
 					else:
 
-						log.error('Wrong pulse mode: ',event_time,row['mode'], row['label'])
-
-			n_clock_cycles_global += n_clock_cycles
+						# adding sequencer command to stop acq
+						ADC_state &= ~(1 << (ch_num-1))
+						global_sequence += [4096, ADC_state << 24]
+						n_clock_cycles_global += 1
 
 		#terminate the sequence
-		global_sequence = np.append(global_sequence,1)
-		global_sequence = np.append(global_sequence,int((termination_time-event_time_prev)*250)-1)
-		n_clock_cycles_global = n_clock_cycles_global + int((termination_time-event_time_prev)*250)
-		global_sequence = np.append(global_sequence,4096)
-		global_sequence = np.append(global_sequence,0)
-		n_clock_cycles_global += 1
+		global_sequence += [1, int((termination_time-event_time_prev)*250)-1, 4096, 0]
+		n_clock_cycles_global += int((termination_time-event_time_prev)*250) + 1
 
 		acq_mode_cmd = ''
 		for i in range(len(self.channels)):
@@ -763,42 +1232,15 @@ class RFSoC(VisaInstrument):
 		period_sync = int(self.FPGA_clock/self.freq_sync())
 		wait_sync = period_sync-(n_clock_cycles_global%period_sync)-1 -2 #(2 clock cycles for jump)
 
-		global_sequence_str = 'SEQ 0,1,9,4106,' + str(acq_mode) + ',257,' + str(int(n_rep-1)) + ',' + ','.join((global_sequence.astype(int)).astype(str)) + ',1,' + str(wait_sync) + ',513,0,0,0'
-
-		# just to keep in log
-		self.sequence_str = global_sequence_str
+		global_sequence_str = 'SEQ 0,1,9,4106,' + str(acq_mode) + ',257,' + str(int(n_rep-1)) + ',' + ','.join(map(str, global_sequence)) + ',1,' + str(wait_sync) + ',513,0,0,0'
 
 		if self.debug_mode:
 
 			print('Sequence programmer command: ',global_sequence_str)
 
-		for i in range(8):
-
-			if len(DAC_pulses_array[i])>0:
+		DAC_pulses_array = [np.concatenate([np.array([])] + waveforms) for waveforms in DAC_pulses_array]
 
-				self.write('DAC:DATA:CH{}:CLEAR'.format(str(i+1)))
-
-				if self.debug_mode and self.debug_mode_plot_waveforms:
-
-					fig = plt.figure(figsize=(8,5))
-					plt.plot(range(len(DAC_pulses_array[i])),DAC_pulses_array[i])
-					plt.grid()
-					plt.legend(fontsize = 14)
-					plt.show()
-
-				DAC_SCPI_cmd = 'DAC:DATA:CH' + str(i+1) + ' 0,' + ','.join((DAC_pulses_array[i].astype(int)).astype(str)) + ',0,0,0,0,0,0,0,0,0,0,16383'
-
-				if self.debug_mode and self.debug_mode_waveform_string:
-
-					print('DAC sequence for CH '+str(i+1)+': ',DAC_SCPI_cmd)
-
-				log.info('Writing waveform for CH'+str(i+1)+'  \n')
-				self.write(DAC_SCPI_cmd)
-
-		log.info('Writing global sequence' + '\n')
-		self.write(global_sequence_str)
-
-		log.info('Waveform and sequence processing complete' + '\n')
+		return global_sequence_str, DAC_pulses_array, pulses_list
 
 
 
@@ -935,6 +1377,7 @@ class RFSoC(VisaInstrument):
 		self.write("PLLINIT")
 		time.sleep(5)
 		self.write("DAC:RELAY:ALL 1")
+		self.forget_sequence()
 
 
 	def reset_output_data(self):
@@ -943,6 +1386,51 @@ class RFSoC(VisaInstrument):
 
 
 
+	@contextlib.contextmanager
+	def shared_acquisition(self):
+		'''
+		The parameters derived from the readout (BUFFER_DATA, ADC_DATA, ADC_power,
+		ADC_power_dBm) read inside the block share one readout, made by the
+		first of them. The block is meant to span one setpoint, entered once the
+		outside instruments (sources, attenuators, mixers) are set, e.g.
+
+			with rfsoc.shared_acquisition():
+				I, Q = rfsoc.ADC1.ADC_DATA()
+				power = rfsoc.ADC_power()
+
+		Outside of the block, every read makes a new readout.
+		'''
+		if self._shared_depth == 0:
+			self.acquisition = None
+		self._shared_depth += 1
+		try:
+			yield self
+		finally:
+			self._shared_depth -= 1
+			if self._shared_depth == 0:
+				self.acquisition = None
+
+
+	def acquire(self, reader=None):
+		'''
+		Readout for the parameters derived from it: a new one, made
+		acquisition_delay seconds after the request, unless a readout has already
+		been made inside the current shared_acquisition block
+		Input:
+			reader: parameter asking for the data
+		Output:
+			Acquisition
+		'''
+		if self._shared_depth and self.acquisition is not None:
+			return self.acquisition
+		time.sleep(self.acquisition_delay)
+		I, Q = self.get_readout_pulse()
+		result = Acquisition(I, Q, self.adc_mode_arr, self.readout_complete)
+		self.acquisition = result
+		self.buffer_readout_data = I, Q
+		return result
+
+
 	def get_readout_pulse(self):
 		'''
 		 This function reformat the data reading the header contents and stores it in buffer_readout_data
@@ -958,243 +1446,165 @@ class RFSoC(VisaInstrument):
 
 		ch_active = self.ADC_ch_active
 
-		points_expected = 0
-		for index in range(8):
-			points_expected += np.sum(length_vec[index],dtype=int)	# points expected per repetition
-		for ch in ch_vec:
-			if mode_arr[ch] & ch_active[ch]:
-				points_expected += 15 # added data size per point in IQ mode (header included)
-			elif (not mode_arr[ch]) & ch_active[ch]:
-				points_expected += 8 # header size for a pulse in RAW mode
+		points_expected = int(np.sum(self.words_per_repetition()))
 
 		'''
 			Get data
 		'''
 
-		data_unsorted = {}
-		count_meas = 0
-		empty_packet_count = 0
-		run_num = 0
-
-
-
-		getting_valid_dataset = True
+		# the replies are copied in a single buffer, allocated for all the words
+		# expected; after a glitch the repetitions validated are kept, and only
+		# the missing ones are acquired again
+		data_buffer = np.empty(points_expected*n_rep, dtype=np.int16)
+		n_valid = 0
+		attempts = 0
+		channels = sorted(ch+1 for ch in ch_vec if ch_active[ch])
+		full_sequence = self._uploaded.get('SEQ')
+		poller = ReadoutPoller(self.poll_interval_min, self.poll_interval_max, self.poll_target_words)
+		self.readout_poller = poller
+		self.recovery_stats['readouts'] += 1
 
 		if self.display_IQ_progress:
 
 			self.display_IQ_progress_bar = IntProgress(min=0, max=self.n_rep.get()) # instantiate the bar
 			display(self.display_IQ_progress_bar) # display the bar
 
-		self.write("SEQ:START")
-		time.sleep(0.1)
+		while True:
 
-		# self.reset_output_data()		## Unnecessary? 26/01/22
+			n_missing = n_rep - n_valid
+			if n_missing < n_rep and full_sequence is not None:
+				# the sequencer only runs the missing repetitions
+				self.upload('SEQ', repeat_sequence(full_sequence, n_missing))
 
-		while getting_valid_dataset:
-
-			while (count_meas//points_expected)<self.n_rep.get():
-
-				a = datetime.datetime.now()
-
-				r = self.ask('OUTPUT:DATA?')
-
-				b = datetime.datetime.now()
-				# print('\nget data: ',b-a)
-
-				if r == 'ERR':
-
-					log.error('rfSoC: Instrument returned ERR!')
+			self.write("SEQ:START")
+			time.sleep(0.1)
+			poller.restart()
 
-					# reset measurement
-					data_unsorted = {}
-					count_meas = 0
-					empty_packet_count = 0
-					run_num = 0
-					self.write("SEQ:STOP")
-					time.sleep(2)
-					while True:
-						junk = self.ask('OUTPUT:DATA?')
-						# print(junk)
-						time.sleep(0.1)
-						if junk == [3338] or junk == [2573]:
-							break
-					junk = []
-					self.write("SEQ:START")
-					time.sleep(0.1)
+			start = n_valid*points_expected
+			data_buffer, count_meas, error = self._collect(poller, data_buffer, start, n_rep*points_expected, points_expected)
 
-					continue
-
-				elif len(r)>1:
+			n_good = min(valid_repetitions(data_buffer[start:count_meas], points_expected, channels), n_missing)
+			n_valid += n_good
+			if attempts:
+				self.recovery_stats['recovered'] += n_good
 
-					a = datetime.datetime.now()
-					empty_packet_count = 0
-					data_unsorted['{}'.format(run_num)] = r
-					r_size = len(r)
-					count_meas += r_size
-					if self.display_IQ_progress:
-						self.display_IQ_progress_bar.value = count_meas//points_expected
-					run_num += 1
-					b = datetime.datetime.now()
-					# print('end storing: ',b-a)
-
-					time.sleep(0.01)
-
-
-				elif r == [3338] or r == [2573]: # new empty packet?
-
-					# log.warning('Received empty packet.')
-					empty_packet_count += 1
-					time.sleep(0.1)
-
-				if empty_packet_count>20:
-
-					log.error('Data corruption: rfSoC did not send all data points({}/'.format(count_meas//points_expected)+str(self.n_rep.get())+').')
-
-					# reset measurement
-					data_unsorted = {}
-					count_meas = 0
-					empty_packet_count = 0
-					run_num = 0
-					self.write("SEQ:STOP")
-					time.sleep(2)
-					while True:
-						junk = self.ask('OUTPUT:DATA?')
-						# print(junk)
-						time.sleep(0.1)
-						if junk == [3338] or junk == [2573]:
-							break
-					junk = []
-					self.write("SEQ:START")
-					time.sleep(0.1)
-
-					continue
-
-			if count_meas//points_expected == self.n_rep.get():
-
-				getting_valid_dataset = False
-
-			else:
-
-				log.error('Data corruption: rfSoC did not send all data points({}/'.format(count_meas//points_expected)+str(self.n_rep.get())+').')
-
-				# reset measurement
-				data_unsorted = []
-				count_meas = 0
-				empty_packet_count = 0
+			if n_valid == n_rep:
 				self.write("SEQ:STOP")
-				time.sleep(2)
-				while True:
-					junk = self.ask('OUTPUT:DATA?')
-					# print(junk)
-					time.sleep(0.1)
-					if junk == [3338] or junk == [2573]:
-						break
-				junk = []
-				self.write("SEQ:START")
-				time.sleep(0.1)
+				if n_missing < n_rep and full_sequence is None:
+					# the whole sequence was started again: the rest is dropped
+					self.drain_output()
+				break
 
-			self.write("SEQ:STOP")
+			error = error or 'invalid'
+			log.error('Data corruption ({}): rfSoC did not send all data points({}/'.format(error, n_valid)+str(n_rep)+').')
+			self.recovery_stats[error] += 1
+			self.recovery_stats['kept'] += n_valid
+			self.drain_output()
 
-			'''
-				Process data
-			'''
-			# data_unsorted = list(chain.from_iterable(data_unsorted.values()))
-			data_unsorted = functools.reduce(operator.iconcat, list(data_unsorted.values()), [])
-			data_unsorted = np.array(data_unsorted,dtype=int) ## keep it as a list for now 26/01/22
+			attempts += 1
+			if attempts > self.readout_retries:
+				break
 
-			adcdataI = [[],[],[],[],[],[],[],[]]
-			adcdataQ = [[],[],[],[],[],[],[],[]]
+		if full_sequence is not None:
+			self.upload('SEQ', full_sequence)
 
-			i=0
-			TSMEM=0
-			while (i + 8 )<= len(data_unsorted) : # at least one header left
+		self.readout_complete = n_valid == n_rep
+		if not self.readout_complete:
+			self.recovery_stats['partial'] += 1
+			log.error('rfSoC: partial readout, {}/{} repetitions after {} retries'.format(n_valid, n_rep, attempts-1))
 
-				entete = data_unsorted[i:i+8]
-				X =entete.astype('int16').tobytes()
-				V = X[0]-1 # channel (X[0] goes from 1 to 8)
-				DSPTYPE = X[1]
-				#N does not have the same meaning depending on DSTYPE
-				N = struct.unpack('I',X[2:6])[0]
-				#number of acquisition points in continuous
-				#depends on the point length
-				NpCont = X[7]*256 + X[6]
-				# timestamp
-				TS= struct.unpack('Q',X[8:16])[0]
+		'''
+			Process data
+		'''
+		# every repetition sends the same packets: points_expected words
+		adcdataI, adcdataQ = decode_packets(data_buffer[:n_valid*points_expected], n_valid, points_expected)
 
-				# print the header for each packet
-				# print("Channel={}; N={}; DSP_type={}; TimeStamp={}; Np_Cont={}; Delta_TimeStamp={}".format(V,N,DSPTYPE,TS,NpCont,TS-TSMEM))
+		for v in range(8):
 
-				TSMEM=TS
+			if mode_arr[v]:		# IQ mode: we keep every repetition as an separate point
 
-				iStart=i+8
-				# if not in continuous acq mode
-				if ((DSPTYPE &  0x2)!=2):
-					# raw adcdata for each Np points block
-					if ((DSPTYPE  &  0x1)==0):
-						Np=N
-						adcdataI[V]=np.concatenate((adcdataI[V], np.right_shift(data_unsorted[iStart:iStart+Np],4)*0.3838e-3))
+				adcdataI[v]=np.array(adcdataI[v]).reshape(n_valid*ch_active[v], np.sum(length_vec[v],dtype=int)).T
+				# adcdataI[v]=np.split(adcdataI[v],[sum(length_vec[v][0:i+1]) for i in range(len(length_vec[v]))])
 
-					#in the accumulation mode, only 1 I and Q point even w mixer OFF
-					#mixer ON or OFF
-					if ((DSPTYPE  & 0x01)==0x1):
-						Np=8
-						D=np.array(data_unsorted[iStart:iStart+Np])
-						X = D.astype('int16').tobytes()
+			else:		# RAW mode: points averaged over all repetitions
 
-						#I divided N and 2 bcse signed 63 bits aligned to the left
-						# mod div by 4 to fix amplitude -Arpit, Martina
-						I=  struct.unpack('q',X[0:8])[0]*(0.3838e-3)/(N*2*4)
-						Q=  struct.unpack('q',X[8:16])[0]*(0.3838e-3)/(N*2*4)
+				adcdataI[v]=np.array(adcdataI[v]).reshape(n_valid,np.sum(length_vec[v],dtype=int))
+				if self.average_RAW:
+					adcdataI[v]=np.mean(adcdataI[v],axis=0)
+				adcdataI[v]=np.split(adcdataI[v],[sum(length_vec[v][0:i+1]) for i in range(len(length_vec[v]))],axis=-1)
 
-						# print the point
-						# print("I/Q:",I,Q,"Amplitude:",np.sqrt(I*I+Q*Q),"Phase:",180*np.arctan2(I,Q)/np.pi)
+		I,Q = adcdataI,adcdataQ
 
-						adcdataI[V]=np.append(adcdataI[V], I)
-						adcdataQ[V]=np.append(adcdataQ[V], Q)
+		return I,Q
 
-				#in our case we dont need the continuous mode for now
-				# continuoous acquisition mode with accumulation (reduce the flow of data)
-				elif ((DSPTYPE &  0x3)==0x3):
-					# mixer OFF : onlyI @2Gs/s or 250Ms/s
-					if ((DSPTYPE  & 0x20)==0x0):
-						# points are already averaged in the PS part
-						# format : 16int
-						Np = NpCont
-						adcdataI[V]=np.concatenate((adcdataI[V], np.right_shift(data_unsorted[iStart:iStart+Np],4)*0.3838e-3))
 
-					# mixer ON : I and Q present
-					elif ((DSPTYPE  & 0x20)==0x20):
-						Np = NpCont
-						adcdataI[V]=np.concatenate((adcdataI[V],np.right_shift(data_unsorted[iStart:Np:2],4)*0.3838e-3))
-						adcdataQ[V]=np.concatenate((adcdataQ[V], np.right_shift(data_unsorted[iStart+1:Np:2],4)*0.3838e-3))
+	def _collect(self, poller, data_buffer, count_meas, stop, points_expected):
+		'''
+		Copy the OUTPUT:DATA? replies in data_buffer from count_meas, until stop
+		words are received, the instrument returns ERR or no data comes for
+		readout_timeout seconds
+		Output:
+			(data_buffer, count_meas, error): the buffer (reallocated if too
+			small), the end of the data, and None, 'ERR' or 'timeout'
+		'''
+		while count_meas < stop:
 
+			r = poller.query(self.ask)
 
-				i = iStart+Np # index of the new data block, new header
+			if isinstance(r, str):	# 'ERR'
 
-		if (count_meas//points_expected) == self.n_rep.get():
+				log.error('rfSoC: Instrument returned ERR!')
+				return data_buffer, count_meas, 'ERR'
 
-			getting_valid_dataset = False
+			elif len(r)>1:
 
-			for v in range(8):
+				r_size = len(r)
+				if count_meas + r_size > len(data_buffer):
+					# more words than expected
+					new_buffer = np.empty(max(2*len(data_buffer), count_meas + r_size), dtype=np.int16)
+					new_buffer[:count_meas] = data_buffer[:count_meas]
+					data_buffer = new_buffer
+				data_buffer[count_meas:count_meas+r_size] = r
+				count_meas += r_size
+				if self.display_IQ_progress:
+					self.display_IQ_progress_bar.value = count_meas//points_expected
 
-				if mode_arr[v]:		# IQ mode: we keep every repetition as an separate point
+				time.sleep(poller.after_data(r_size))
 
-					adcdataI[v]=np.array(adcdataI[v]).reshape(self.n_rep.get()*ch_active[v], np.sum(length_vec[v],dtype=int)).T
-					# adcdataI[v]=np.split(adcdataI[v],[sum(length_vec[v][0:i+1]) for i in range(len(length_vec[v]))])
+			elif is_empty_reply(r): # new empty packet?
 
-				else:		# RAW mode: points averaged over all repetitions
+				# log.warning('Received empty packet.')
+				time.sleep(poller.after_empty())
 
-					adcdataI[v]=np.array(adcdataI[v]).reshape(self.n_rep.get(),np.sum(length_vec[v],dtype=int))
-					adcdataI[v]=np.mean(adcdataI[v],axis=0)
-					adcdataI[v]=np.split(adcdataI[v],[sum(length_vec[v][0:i+1]) for i in range(len(length_vec[v]))])
+			if poller.idle > self.readout_timeout:
 
-			I,Q = adcdataI,adcdataQ
+				return data_buffer, count_meas, 'timeout'
 
-		else:
+		return data_buffer, count_meas, None
 
-			log.error('Data corruption: rfSoC did not send all data points({}/'.format(count_meas//points_expected)+str(self.n_rep.get())+').')
 
-		return I,Q
+	def drain_output(self):
+		'''
+		Stop the sequencer and read out the data left in the instrument, until no
+		data comes for drain_time seconds (readout_timeout at most)
+		Output:
+			number of words discarded
+		'''
+		self.write("SEQ:STOP")
+		poller = ReadoutPoller(self.poll_interval_min, self.poll_interval_max)
+		discarded = 0
+		t0 = time.perf_counter()
+		while time.perf_counter() - t0 < self.readout_timeout:
+			r = self.ask('OUTPUT:DATA?')
+			if not isinstance(r, str) and len(r) > 1:
+				discarded += len(r)
+				poller.after_data(len(r))
+			else:
+				time.sleep(poller.after_empty())
+				if poller.idle > self.drain_time:
+					break
+		self.recovery_stats['discarded'] += discarded
+		return discarded
 
 
 
@@ -1223,8 +1633,9 @@ class RFSoC(VisaInstrument):
 		'''
 
 		count_meas = 0
-		empty_packet_count = 0
 		run_num = 0
+		poller = ReadoutPoller(self.poll_interval_min, self.poll_interval_max, self.poll_target_words)
+		self.readout_poller = poller
 
 
 
@@ -1237,6 +1648,7 @@ class RFSoC(VisaInstrument):
 
 		self.write("SEQ:START")
 		time.sleep(0.1)
+		poller.restart()
 
 		# self.reset_output_data()		## Necessary? 26/01/22
 
@@ -1244,76 +1656,50 @@ class RFSoC(VisaInstrument):
 
 			while (count_meas//points_expected)<self.n_rep.get():
 
-				a = datetime.datetime.now()
-
-				r = self.ask('OUTPUT:DATA?')
+				r = poller.query(self.ask)
 
-				b = datetime.datetime.now()
-				# print('\nget data: ',b-a)
-
-				if r == 'ERR':
+				if isinstance(r, str):	# 'ERR'
 
 					log.error('rfSoC: Instrument returned ERR!')
 
 					# reset measurement
 					count_meas = 0
-					empty_packet_count = 0
 					run_num = 0
-					self.write("SEQ:STOP")
-					time.sleep(2)
-					while True:
-						junk = self.ask('OUTPUT:DATA?')
-						# print(junk)
-						time.sleep(0.1)
-						if junk == [3338] or junk == [2573]:
-							break
-					junk = []
+					self.drain_output()
 					self.write("SEQ:START")
 					time.sleep(0.1)
+					poller.restart()
 
 					continue
 
 				elif len(r)>1:
 
-					a = datetime.datetime.now()
-					empty_packet_count = 0
 					r_size = len(r)
 					pk.dump(r, open(location+"/raw_"+str(run_num)+".pkl","wb"))
 					count_meas += r_size
 					if self.display_IQ_progress:
 						self.display_IQ_progress_bar.value = count_meas//points_expected
 					run_num += 1
-					b = datetime.datetime.now()
-					# print('end storing: ',b-a)
 
-					time.sleep(0.01)
+					time.sleep(poller.after_data(r_size))
 
 
-				elif r == [3338] or r == [2573]: # new empty packet?
+				elif is_empty_reply(r): # new empty packet?
 
 					# log.warning('Received empty packet.')
-					empty_packet_count += 1
-					time.sleep(0.1)
+					time.sleep(poller.after_empty())
 
-				if empty_packet_count>20:
+				if poller.idle > self.readout_timeout:
 
 					log.error('Data corruption: rfSoC did not send all data points({}/'.format(count_meas//points_expected)+str(self.n_rep.get())+').')
 
 					# reset measurement
 					count_meas = 0
-					empty_packet_count = 0
 					run_num = 0
-					self.write("SEQ:STOP")
-					time.sleep(2)
-					while True:
-						junk = self.ask('OUTPUT:DATA?')
-						# print(junk)
-						time.sleep(0.1)
-						if junk == [3338] or junk == [2573]:
-							break
-					junk = []
+					self.drain_output()
 					self.write("SEQ:START")
 					time.sleep(0.1)
+					poller.restart()
 
 					continue
 
@@ -1327,40 +1713,104 @@ class RFSoC(VisaInstrument):
 
 				# reset measurement
 				count_meas = 0
-				empty_packet_count = 0
-				self.write("SEQ:STOP")
-				time.sleep(2)
-				while True:
-					junk = self.ask('OUTPUT:DATA?')
-					# print(junk)
-					time.sleep(0.1)
-					if junk == [3338] or junk == [2573]:
-						break
-				junk = []
+				self.drain_output()
 				self.write("SEQ:START")
 				time.sleep(0.1)
+				poller.restart()
 
 			self.write("SEQ:STOP")
 
 		return run_num
 
 
-	def transfer_speed(self, block_size=100):
+	def words_per_repetition(self):
+		'''
+		Number of words sent by every ADC channel for one repetition of the
+		compiled sequence, headers included
+		Output:
+			int array of 8 values
+		'''
+		words = np.array([np.sum(self.length_vec[v],dtype=int) for v in range(8)])
+		for ch in self.ch_vec:
+			if self.adc_mode_arr[ch] & self.ADC_ch_active[ch]:
+				words[ch] += 15 # added data size per point in IQ mode (header included)
+			elif (not self.adc_mode_arr[ch]) & self.ADC_ch_active[ch]:
+				words[ch] += 8 # header size for a pulse in RAW mode
+		return words
+
+
+	def event_rates(self, MBps):
+		'''
+		Maximum rate of ADC events that a transfer speed can sustain
+		Input:
+			MBps(float): transfer speed
+		Output:
+			dict of the events per second of every active channel, for the
+			compiled sequence; without ADC pulse in the sequence, the rate of
+			a single channel in IQ mode (16 words per event)
+		'''
+		words_per_s = MBps*1e6/2
+		if len(self.ch_vec) == 0:
+			return {'IQ': words_per_s/16}
+		repetitions = words_per_s/np.sum(self.words_per_repetition())
+		return {'ADC{}'.format(ch+1): repetitions*self.ch_vec.count(ch) for ch in sorted(set(self.ch_vec))}
+
+
+	def _report(self, stats, path):
+
+		stats['event_rate'] = self.event_rates(stats['link_MBps'])
+		stats['instrument'] = self.name
+		stats['date'] = datetime.datetime.now().isoformat()
+		if path is not None:
+			with open(path, 'w') as f:
+				json.dump(_canonical(stats), f, indent=1)
+		return stats
+
+
+	def readout_stats(self, path=None):
+		'''
+		Transfer statistics of the last readout, see transfer_stats
+		Input:
+			path(str): JSON file where the statistics are also written
+		Output:
+			dict of the statistics, with the maximum event rate of every
+			active channel (event_rate) at the measured link speed
+		'''
+		if self.readout_poller is None:
+			raise RuntimeError('No readout since the connection')
+		return self._report(self.readout_poller.stats(), path)
 
-		block_n = int(block_size/10)
-		a = datetime.datetime.now()
-		for i in bar(range(block_n)):
 
-			data = self.ask('OUTPUT:DATATEST?')
+	def benchmark_transfer(self, n_queries=10, cmd='OUTPUT:DATATEST?', path=None):
+		'''
+		Time n_queries queries of test data
+		Input:
+			n_queries(int): number of queries
+			cmd(str): query sending a block of test data
+			path(str): JSON file where the results are also written
+		Output:
+			dict of the statistics, see transfer_stats and readout_stats
+		'''
+		poller = ReadoutPoller()
+		for i in bar(range(n_queries)):
+			poller.query(self.ask, cmd)
+		return self._report(poller.stats(), path)
 
-		b = datetime.datetime.now()
-		del_t = (b-a).seconds
-		speed = round(10*block_n/del_t,2)
-		event_rate = round(1000*speed/32,2)
-		pulse_length = round(1000/event_rate,2)
+
+	def transfer_speed(self, block_size=100):
+		'''
+		Print the results of benchmark_transfer for block_size MB of test data
+		(10 MB per query)
+		'''
+		stats = self.benchmark_transfer(max(int(block_size/10), 1))
+		speed = round(stats['link_MBps'],2)
+		event_rate = round(stats['event_rate'].get('IQ', min(stats['event_rate'].values()))/1e3,2)
+		pulse_length = round(1000/event_rate,2) if event_rate > 0 else np.inf
 		print('Transfer speed: '+str(speed)+' MBps')
 		print('Event rate: '+str(event_rate)+' K/s')
 		print('Minimum size of one ADC pulse: '+str(pulse_length)+' us per active channel')
+		print('Query latency: {:.1f} ms median, {:.1f} ms (99%)'.format(stats['latency_p50_ms'], stats['latency_p99_ms']))
+		return stats
 
 
 
@@ -1381,16 +1831,16 @@ class RFSoC(VisaInstrument):
 					count += 1
 					self.visa_log.debug(f"Querying: {cmd}")
 					try:
-						response = self.visa_handle.query_binary_values(cmd, datatype="h", is_big_endian=False)
+						response = self.visa_handle.query_binary_values(cmd, datatype="h", is_big_endian=False, container=np.array)
 						self.visa_log.debug(f"Response: {response}")
 						if len(response) > 1:
 							i = 0
 					except:
 						try:		# try to read the data as a single point of data in case buffer is empty
-							response = self.visa_handle.query_binary_values(cmd, datatype="h", is_big_endian=False, data_points=1, header_fmt='ieee', expect_termination=False)
+							response = self.visa_handle.query_binary_values(cmd, datatype="h", is_big_endian=False, data_points=1, header_fmt='ieee', expect_termination=False, container=np.array)
 						except:
 							response = 'ERR'
-					if response != 'ERR' and response != [3338]:
+					if not isinstance(response, str) and not (len(response) == 1 and response[0] == 3338):
 						keep_trying = False
 					if count>10:
 						keep_trying = False
@@ -0,0 +1,1315 @@
+# -*- coding: utf-8 -*-
+# Benchmarks of the rfSoC driver (rfSoC_220127_cont_gen.py), without the board:
+# - run_compiler compiles random pulse tables of 10 to 1000 pulses with
+#   RFSoC.compile_sequence and with the DataFrame based loop it replaces, checks
+#   that both give the same SEQ command and DAC waveforms, and prints the times
+# - run_cache times process_sequencing with and without a hit of the cache of
+#   compiled sequences
+# - run_decoder decodes fake ADC packet streams with decode_packets and with the
+#   packet by packet loop of get_readout_pulse, checks that both give the same
+#   I and Q arrays and prints the times
+# - run_receive_buffer compares the memory used to gather the replies of a
+#   readout as lists and in a preallocated int16 buffer
+# - run_readout times get_readout_pulse with a fixed and an adaptive polling
+#   interval, and run_transfer prints RFSoC.benchmark_transfer
+# - run_recovery checks that a readout interrupted by a glitch keeps the valid
+#   repetitions and only acquires the missing ones
+# - run_acquisition checks that the ADC parameters read in a shared_acquisition
+#   block share one readout, that every read makes its own readout outside of
+#   it, and times the power computation
+# - run_hot_swap times a phase sweep with update_DAC_pulse instead of
+#   process_sequencing for every phase
+# - run_optimizers counts the acquisitions of the searches of
+#   rfSoC_support.minimize on a model of the pump cancellation
+# - run_frequency_batches times a check_freq scan end to end against
+#   rfSoC_simulator.py, with a sequence per frequency in IQ mode and with
+#   batches of RAW segments, over links of several rates, and checks that both
+#   give the same powers
+# - run_simulator times process_sequencing and get_readout_pulse against
+#   rfSoC_simulator.py, with latency, fragmented replies and injected ERR, and
+#   checks the amplitudes measured on the DAC pulses looped back on the ADCs
+# - run_DAC_encoding checks that the DAC:DATA commands of SequenceGeneration_v2
+#   are the former text commands, and prints their encoding times
+#
+# The driver is connected to a local socket which discards all the commands, or
+# which sends a stream of ADC words (StreamServer) for the readout benchmarks.
+#
+
+import functools
+import operator
+import socket
+import struct
+import threading
+import time
+import tracemalloc
+
+import numpy as np
+import pandas as pd
+from rfSoC_220127_cont_gen import HEADER_DTYPE, decode_packets
+
+
+class SinkServer:
+    """
+    TCP server accepting the connection of the driver and discarding everything
+    """
+
+    def __init__(self, host="127.0.0.1"):
+        self._socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self._socket.bind((host, 0))
+        self._socket.listen(1)
+        self.address = "TCPIP::{}::{}::SOCKET".format(*self._socket.getsockname())
+        threading.Thread(target=self._serve, daemon=True).start()
+
+    def _serve(self):
+        while True:
+            try:
+                connection, _ = self._socket.accept()
+            except OSError:
+                return
+            threading.Thread(
+                target=self._handle, args=(connection,), daemon=True
+            ).start()
+
+    @staticmethod
+    def _handle(connection):
+        with connection:
+            while connection.recv(1 << 16):
+                pass
+
+    def stop(self):
+        self._socket.close()
+
+
+class StreamServer(SinkServer):
+    """
+    TCP server sending a stream of ADC words like the board during a readout:
+    after SEQ:START the words of the repetitions set by the last SEQ command
+    become available at word_rate words per second, and every OUTPUT:DATA?
+    reply carries at most chunk_size of them
+    Input:
+        stream(int16 array): words sent for n_rep repetitions
+        n_rep(int): number of repetitions of the stream
+        word_rate(float): words produced per second, None for all at once
+        chunk_size(int): maximum number of words of a reply
+        test_words(int): number of words of an OUTPUT:DATATEST? reply
+        stall_after(int): the first run stops after this number of words
+        corrupt_at(int): the word at this position is wrong in the first run
+    """
+
+    EMPTY_REPLY = b"#12\r\n\r\n"  # read by the driver as [3338]
+
+    def __init__(
+        self,
+        stream,
+        n_rep=1,
+        word_rate=None,
+        chunk_size=50_000,
+        test_words=2**20,
+        stall_after=None,
+        corrupt_at=None,
+    ):
+        self.stream = np.asarray(stream, dtype="<i2")
+        self.stride = len(self.stream) // n_rep if n_rep else 0
+        self.repetitions = n_rep
+        self.word_rate = word_rate
+        self.chunk_size = chunk_size
+        self.test_words = test_words
+        self.stall_after = stall_after
+        self.corrupt_at = corrupt_at
+        self.runs = 0
+        self.data_queries = 0
+        self.words_sent = 0
+        self._words = self.stream
+        self._position = None
+        self._t_start = 0.0
+        super().__init__()
+
+    def _handle(self, connection):
+        buffer = b""
+        with connection:
+            while True:
+                data = connection.recv(1 << 16)
+                if not data:
+                    return
+                buffer += data
+                while b"\n" in buffer:
+                    line, buffer = buffer.split(b"\n", 1)
+                    reply = self.command(line.strip().decode())
+                    if reply is not None:
+                        connection.sendall(reply)
+
+    def command(self, cmd):
+        if cmd.startswith("SEQ "):
+            # SEQ 0,1,9,4106,<acquisition>,257,<repetitions - 1>,...
+            self.repetitions = int(cmd.split(",")[6]) + 1
+        elif cmd == "SEQ:START":
+            self._start()
+        elif cmd == "SEQ:STOP":
+            self._position = None
+        elif cmd == "OUTPUT:DATA?":
+            self.data_queries += 1
+            return self._block(self._next_words())
+        elif cmd == "OUTPUT:DATATEST?":
+            return self._block(np.zeros(self.test_words, dtype="<i2"))
+        return None
+
+    def _start(self):
+        self._words = self.stream[: self.repetitions * self.stride]
+        if self.runs == 0:
+            if self.corrupt_at is not None:
+                self._words = self._words.copy()
+                self._words[self.corrupt_at] ^= 0x0100
+            if self.stall_after is not None:
+                self._words = self._words[: self.stall_after]
+        self.runs += 1
+        self._position = 0
+        self._t_start = time.perf_counter()
+
+    def _next_words(self):
+        if self._position is None:
+            return self._words[:0]
+        available = len(self._words)
+        if self.word_rate is not None:
+            produced = int((time.perf_counter() - self._t_start) * self.word_rate)
+            available = min(available, produced)
+        stop = min(available, self._position + self.chunk_size)
+        words = self._words[self._position : max(stop, self._position)]
+        self._position += len(words)
+        self.words_sent += len(words)
+        return words
+
+    def _block(self, words):
+        if len(words) == 0:
+            return self.EMPTY_REPLY
+        payload = words.tobytes()
+        size = str(len(payload)).encode()
+        return b"#" + str(len(size)).encode() + size + payload + b"\r\n"
+
+
+def random_pulses(n_pulses, seed=0):
+    """
+    Pulse table of n_pulses pulses spread over the 8 DAC and 8 ADC channels:
+    about half of the pulses are placed after the previous pulse of their channel
+    with the parent mechanism, the other half at an absolute time
+    Output:
+        list of dict, as expected by RFSoC.compile_sequence
+    """
+    rng = np.random.default_rng(seed)
+    pulses = []
+    last = {}  # (module, channel): (label, stop)
+    for k in range(n_pulses):
+        module = "DAC" if rng.random() < 0.6 else "ADC"
+        channel = int(rng.integers(1, 9))
+        gap = int(rng.integers(0, 50)) * 0.004
+        length = int(rng.integers(2, 50)) * 0.004
+        if module == "DAC":
+            mode = ["sin", "trigger"][k % 2]
+            param = dict(
+                amp=0.1,
+                freq=float(rng.integers(10, 500)),
+                dc_offset=0,
+                phase_offset=0,
+            )
+        else:
+            # an ADC cannot change acquisition mode during the sequence
+            mode = "IQ" if channel <= 4 else "RAW"
+            param = None
+        label = "{}{}_{}".format(module, channel, k)
+        if (module, channel) in last and rng.random() < 0.5:
+            parent, parent_stop = last[(module, channel)]
+            start, stop = gap, parent_stop + gap + length
+        else:
+            parent = None
+            start = max(last.get((module, channel), ("", 0))[1], 0) + gap
+            stop = start + length
+        last[(module, channel)] = (label, stop)
+        pulses.append(
+            dict(
+                label=label,
+                module=module,
+                channel=channel,
+                mode=mode,
+                start=start,
+                length=length,
+                param=param,
+                parent=parent,
+            )
+        )
+    return pulses
+
+
+def append_row(df, row):
+    # DataFrame.append, removed in pandas 2
+    return pd.concat([df, pd.DataFrame([row])], ignore_index=True)
+
+
+def process_sequencing_reference(rfsoc, pulses):
+    """
+    Sequence compilation of RFSoC.process_sequencing before compile_sequence,
+    without the display and the writes
+    Output:
+        (global_sequence_str, DAC_pulses_array)
+    """
+    n_rep = rfsoc.n_rep()
+    # the strings of a DataFrame were python objects before pandas 3, which kept
+    # the None parents
+    pulses_raw_df = pd.DataFrame(pulses, dtype=object)
+    pulses_raw_df.set_index("label", inplace=True)
+
+    resolve_hierarchy = True
+    while resolve_hierarchy:
+        for index, row in pulses_raw_df.iterrows():
+            if row["parent"] != None:
+                if pulses_raw_df.loc[row["parent"]]["parent"] == None:
+                    pulses_raw_df.loc[index, "start"] = (
+                        pulses_raw_df.loc[index, "start"]
+                        + pulses_raw_df.loc[row["parent"]]["start"]
+                        + pulses_raw_df.loc[row["parent"]]["length"]
+                    )
+                    pulses_raw_df.loc[index, "parent"] = None
+        resolve_hierarchy = False
+        for val in pulses_raw_df["parent"]:
+            if val != None:
+                resolve_hierarchy = True
+
+    pulses_df = pd.DataFrame()
+    time_channel = dict(ADC=[0] * 8, DAC=[0] * 8)
+    termination_time = 0
+    for module in ["ADC", "DAC"]:
+        time_ch = time_channel[module]
+        tmp_df = pulses_raw_df.loc[pulses_raw_df["module"] == module]
+        for index, row in tmp_df.iterrows():
+            ch = int(row["channel"])
+            if row["start"] > time_ch[ch - 1]:
+                wait = dict(
+                    label="wait",
+                    start=time_ch[ch - 1],
+                    stop=row["start"],
+                    time=row["start"] - time_ch[ch - 1],
+                    module=module,
+                    mode="wait",
+                    param=row["param"],
+                    ch_num=ch,
+                )
+                pulses_df = append_row(pulses_df, wait)
+            stop = row["start"] + row["length"]
+            pulse = dict(
+                label=index,
+                start=row["start"],
+                stop=stop,
+                time=row["length"],
+                module=module,
+                mode=row["mode"],
+                param=row["param"],
+                ch_num=ch,
+            )
+            pulses_df = append_row(pulses_df, pulse)
+            if module == "ADC":
+                rfsoc.channels[ch - 1].acquisition_mode(
+                    "RAW" if row["mode"] == "RAW" else "IQ"
+                )
+            time_ch[ch - 1] = stop
+            if stop > termination_time:
+                termination_time = stop
+    for module in ["ADC", "DAC"]:
+        for ch in range(1, 9):
+            if termination_time > time_channel[module][ch - 1] > 0:
+                wait = dict(
+                    label="wait",
+                    start=time_channel[module][ch - 1],
+                    stop=termination_time,
+                    time=termination_time - time_channel[module][ch - 1],
+                    module=module,
+                    mode="wait",
+                    param=None,
+                    ch_num=ch,
+                )
+                pulses_df = append_row(pulses_df, wait)
+    pulses_df["module"] = pulses_df["module"].astype(object)
+
+    event_time_list = list(dict.fromkeys(pulses_df["start"]))
+    event_time_list.sort()
+    termination_time = np.max(pulses_df["stop"])
+
+    global_sequence = np.array([])
+    event_time_prev = 0
+    DAC_pulses_array = [np.array([]) for _ in range(8)]
+    ADC_state = np.array([0, 0, 0, 0, 0, 0, 0, 0])
+    n_clock_cycles_global = 0
+
+    for event_time in event_time_list:
+        if event_time > 0:
+            global_sequence = np.append(global_sequence, 1)
+            global_sequence = np.append(
+                global_sequence, int((event_time - event_time_prev) * 250) - 1
+            )
+            n_clock_cycles_global += int((event_time - event_time_prev) * 250)
+        n_clock_cycles = 0
+        event_time_prev = event_time
+        tmp_df = pulses_df.loc[pulses_df["start"] == event_time]
+        tmp_df = tmp_df.sort_values(by="module", ascending=False)
+
+        for index, row in tmp_df.iterrows():
+            ch_num = int(row["ch_num"])
+            if row["module"] == "DAC":
+                if row["mode"] != "wait":
+                    SCPI_command = rfsoc.pulse_gen_SCPI(
+                        row["mode"], row["param"], row["time"], ch_num
+                    )
+                    pulse_addr = int(len(DAC_pulses_array[ch_num - 1]) / 11)
+                    DAC_pulses_array[ch_num - 1] = np.append(
+                        DAC_pulses_array[ch_num - 1], SCPI_command
+                    )
+                    n_clock_cycles += 1
+                    global_sequence = np.append(global_sequence, 4096 + ch_num)
+                    global_sequence = np.append(global_sequence, pulse_addr)
+                    n_clock_cycles += 1
+                    bin_trig_cmd = "".join(ADC_state.astype(str))
+                    for i in [8, 7, 6, 5, 4, 3, 2, 1]:
+                        bin_trig_cmd += "011" if i == ch_num else "000"
+                    global_sequence = np.append(global_sequence, 4096)
+                    global_sequence = np.append(global_sequence, int(bin_trig_cmd, 2))
+                else:
+                    n_clock_cycles += 1
+                    bin_trig_cmd = "".join(ADC_state.astype(str))
+                    for i in [8, 7, 6, 5, 4, 3, 2, 1]:
+                        bin_trig_cmd += "001" if i == ch_num else "000"
+                    global_sequence = np.append(global_sequence, 4096)
+                    global_sequence = np.append(global_sequence, int(bin_trig_cmd, 2))
+            if row["module"] == "ADC":
+                if row["mode"] != "wait":
+                    n_clock_cycles += 1
+                    global_sequence = np.append(global_sequence, 4106 + ch_num)
+                    global_sequence = np.append(
+                        global_sequence, int(row["time"] * 1e-6 * rfsoc.sampling_rate)
+                    )
+                    n_clock_cycles += 1
+                    ADC_state[7 - (ch_num - 1)] = 1
+                else:
+                    n_clock_cycles += 1
+                    ADC_state[7 - (ch_num - 1)] = 0
+                bin_trig_cmd = "".join(ADC_state.astype(str)) + "0" * 24
+                global_sequence = np.append(global_sequence, 4096)
+                global_sequence = np.append(global_sequence, int(bin_trig_cmd, 2))
+        n_clock_cycles_global += n_clock_cycles
+
+    global_sequence = np.append(global_sequence, 1)
+    global_sequence = np.append(
+        global_sequence, int((termination_time - event_time_prev) * 250) - 1
+    )
+    n_clock_cycles_global += int((termination_time - event_time_prev) * 250)
+    global_sequence = np.append(global_sequence, 4096)
+    global_sequence = np.append(global_sequence, 0)
+    n_clock_cycles_global += 1
+
+    acq_mode_cmd = ""
+    for channel in rfsoc.channels:
+        acq_mode_cmd = ("0000" if channel.acquisition_mode() == "RAW" else "0001") + (
+            acq_mode_cmd
+        )
+    acq_mode = int(acq_mode_cmd, 2)
+
+    period_sync = int(rfsoc.FPGA_clock / rfsoc.freq_sync())
+    wait_sync = period_sync - (n_clock_cycles_global % period_sync) - 1 - 2
+
+    global_sequence_str = (
+        "SEQ 0,1,9,4106,"
+        + str(acq_mode)
+        + ",257,"
+        + str(int(n_rep - 1))
+        + ","
+        + ",".join((global_sequence.astype(int)).astype(str))
+        + ",1,"
+        + str(wait_sync)
+        + ",513,0,0,0"
+    )
+    return global_sequence_str, DAC_pulses_array
+
+
+def best_time(function, repeat):
+    best = np.inf
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        function()
+        best = min(best, time.perf_counter() - t0)
+    return best
+
+
+def connect(address=None):
+    """
+    RFSoC connected to address, or to a local SinkServer if address is None
+    Output:
+        (rfsoc, server): server is None if address is given
+    """
+    from rfSoC_220127_cont_gen import RFSoC
+
+    server = None
+    if address is None:
+        server = SinkServer()
+        address = server.address
+    rfsoc = RFSoC("rfsoc_benchmark", address)
+    rfsoc.display_sequence = False
+    rfsoc.display_IQ_progress = False
+    rfsoc.freq_sync(1e6)
+    rfsoc.n_rep(1000)
+    return rfsoc, server
+
+
+def run_compiler(n_pulses=(10, 30, 100, 300, 1000), repeat=3):
+    """
+    Compile random pulse tables with compile_sequence and with the loop it
+    replaces, and check that both give the same SEQ command and waveforms
+    Output:
+        list of dict, one per table size, with the best time of both (s)
+    """
+    rfsoc, server = connect()
+    results = []
+    try:
+        for n in n_pulses:
+            pulses = random_pulses(n)
+            seq, waveforms, _ = rfsoc.compile_sequence(pulses)
+            seq_reference, waveforms_reference = process_sequencing_reference(
+                rfsoc, pulses
+            )
+            if seq != seq_reference:
+                raise RuntimeError("compile_sequence does not give the same SEQ")
+            for w, w_reference in zip(waveforms, waveforms_reference):
+                if not np.array_equal(w.astype(int), w_reference.astype(int)):
+                    raise RuntimeError("compile_sequence does not give the same DAC")
+
+            result = dict(
+                n_pulses=n,
+                reference=best_time(
+                    lambda: process_sequencing_reference(rfsoc, pulses),
+                    1 if n > 100 else repeat,
+                ),
+                compile_sequence=best_time(
+                    lambda: rfsoc.compile_sequence(pulses), repeat
+                ),
+            )
+            results.append(result)
+            print(
+                "{n_pulses:>5d} pulses | DataFrame loop {reference:9.2e} s | "
+                "compile_sequence {compile_sequence:9.2e} s | {speedup:.0f}x".format(
+                    speedup=result["reference"] / result["compile_sequence"], **result
+                )
+            )
+    finally:
+        rfsoc.close()
+        if server is not None:
+            server.stop()
+    return results
+
+
+def fake_stream(n_rep, packets, seed=0):
+    """
+    Words sent by the ADCs for n_rep repetitions of a sequence
+    Input:
+        packets(list): (channel, dsp_type, N) of every packet of a repetition:
+        dsp_type 0 for raw data (N points), 1 for accumulated I and Q (over N
+        points), 3 or 0x23 for continuous acquisition (N points)
+    Output:
+        int16 array
+    """
+    rng = np.random.default_rng(seed)
+    words = []
+    timestamp = 0
+    for _ in range(n_rep):
+        for channel, dsp_type, N in packets:
+            header = np.zeros(1, dtype=HEADER_DTYPE)
+            header["channel"] = channel
+            header["dsp_type"] = dsp_type
+            header["N"] = N
+            header["np_cont"] = N if dsp_type & 0x2 else 0
+            header["timestamp"] = timestamp
+            timestamp += 1000
+            words.append(header.view(np.int16))
+            if dsp_type == 1:
+                IQ = rng.integers(-(2**50), 2**50, 2, dtype=np.int64)
+                words.append(IQ.view(np.int16))
+            else:
+                words.append(rng.integers(-(2**15), 2**15, N).astype(np.int16))
+    return np.concatenate(words)
+
+
+def decode_packets_reference(data_unsorted):
+    """
+    Packet by packet decoding of get_readout_pulse before decode_packets
+    """
+    adcdataI = [[], [], [], [], [], [], [], []]
+    adcdataQ = [[], [], [], [], [], [], [], []]
+    i = 0
+    while (i + 8) <= len(data_unsorted):
+        entete = data_unsorted[i : i + 8]
+        X = entete.astype("int16").tobytes()
+        V = X[0] - 1
+        DSPTYPE = X[1]
+        N = struct.unpack("I", X[2:6])[0]
+        NpCont = X[7] * 256 + X[6]
+        iStart = i + 8
+        if (DSPTYPE & 0x2) != 2:
+            if (DSPTYPE & 0x1) == 0:
+                Np = N
+                adcdataI[V] = np.concatenate(
+                    (
+                        adcdataI[V],
+                        np.right_shift(data_unsorted[iStart : iStart + Np], 4)
+                        * 0.3838e-3,
+                    )
+                )
+            if (DSPTYPE & 0x01) == 0x1:
+                Np = 8
+                D = np.array(data_unsorted[iStart : iStart + Np])
+                X = D.astype("int16").tobytes()
+                I = struct.unpack("q", X[0:8])[0] * (0.3838e-3) / (N * 2 * 4)
+                Q = struct.unpack("q", X[8:16])[0] * (0.3838e-3) / (N * 2 * 4)
+                adcdataI[V] = np.append(adcdataI[V], I)
+                adcdataQ[V] = np.append(adcdataQ[V], Q)
+        elif (DSPTYPE & 0x3) == 0x3:
+            if (DSPTYPE & 0x20) == 0x0:
+                Np = NpCont
+                adcdataI[V] = np.concatenate(
+                    (
+                        adcdataI[V],
+                        np.right_shift(data_unsorted[iStart : iStart + Np], 4)
+                        * 0.3838e-3,
+                    )
+                )
+            elif (DSPTYPE & 0x20) == 0x20:
+                Np = NpCont
+                adcdataI[V] = np.concatenate(
+                    (
+                        adcdataI[V],
+                        np.right_shift(data_unsorted[iStart:Np:2], 4) * 0.3838e-3,
+                    )
+                )
+                adcdataQ[V] = np.concatenate(
+                    (
+                        adcdataQ[V],
+                        np.right_shift(data_unsorted[iStart + 1 : Np : 2], 4)
+                        * 0.3838e-3,
+                    )
+                )
+        i = iStart + Np
+    return adcdataI, adcdataQ
+
+
+def same_data(data, reference):
+    return all(
+        type(a) == type(b) and np.array_equal(a, b)
+        for channels, channels_reference in zip(data, reference)
+        for a, b in zip(channels, channels_reference)
+    )
+
+
+# packets of a repetition: 2 channels in IQ mode, and 2 in IQ + 1 in RAW mode
+DECODER_LAYOUTS = {
+    "IQ": [(1, 1, 1000), (2, 1, 1000)],
+    "IQ+RAW": [(1, 1, 1000), (2, 1, 1000), (3, 0, 200), (1, 1, 1000)],
+}
+
+
+def run_decoder(n_reps=(100, 1000, 10_000), repeat=3):
+    """
+    Decode fake ADC streams with decode_packets (fixed stride fast path and
+    packet walk) and with the loop it replaces, check that the I and Q arrays
+    are identical and print the times
+    Output:
+        list of dict, one per layout and n_rep, with the best times (s)
+    """
+    results = []
+    for name, packets in DECODER_LAYOUTS.items():
+        for n_rep in n_reps:
+            data = fake_stream(n_rep, packets).astype(int)
+            stride = len(data) // n_rep
+            reference = decode_packets_reference(data)
+            if not same_data(decode_packets(data, n_rep, stride), reference):
+                raise RuntimeError("decode_packets (fixed stride) differs")
+            if not same_data(decode_packets(data), reference):
+                raise RuntimeError("decode_packets (packet walk) differs")
+            result = dict(
+                layout=name,
+                n_rep=n_rep,
+                reference=best_time(
+                    lambda: decode_packets_reference(data),
+                    1 if n_rep > 1000 else repeat,
+                ),
+                fixed_stride=best_time(
+                    lambda: decode_packets(data, n_rep, stride), repeat
+                ),
+                walk=best_time(lambda: decode_packets(data), repeat),
+            )
+            results.append(result)
+            print(
+                "{layout:>7s} {n_rep:>6d} rep | loop {reference:9.2e} s | "
+                "fixed stride {fixed_stride:9.2e} s | walk {walk:9.2e} s".format(
+                    **result
+                )
+            )
+
+    # continuous acquisition packets only go through the walk
+    data = fake_stream(10, [(1, 3, 64), (2, 0x23, 64), (3, 1, 100)]).astype(int)
+    if not same_data(decode_packets(data), decode_packets_reference(data)):
+        raise RuntimeError("decode_packets (continuous acquisition) differs")
+    return results
+
+
+def run_receive_buffer(n_words=2_000_000, chunk_size=50_000):
+    """
+    Peak memory and time to gather the OUTPUT:DATA? replies of a readout:
+    replies as lists merged with functools.reduce and converted with np.array
+    (before), and replies as arrays copied in a preallocated int16 buffer
+    Output:
+        dict of the peak memory (bytes) and time (s) of both
+    """
+    words = np.random.default_rng(0).integers(-(2**15), 2**15, n_words, np.int16)
+    starts = range(0, n_words, chunk_size)
+
+    def lists():
+        data_unsorted = {}
+        for run_num, start in enumerate(starts):
+            data_unsorted["{}".format(run_num)] = words[
+                start : start + chunk_size
+            ].tolist()
+        data_unsorted = functools.reduce(
+            operator.iconcat, list(data_unsorted.values()), []
+        )
+        return np.array(data_unsorted, dtype=int)
+
+    def buffer():
+        data_buffer = np.empty(n_words, dtype=np.int16)
+        for start in starts:
+            r = words[start : start + chunk_size].copy()  # reply of the instrument
+            data_buffer[start : start + len(r)] = r
+        return data_buffer
+
+    result = {}
+    for name, gather in (("lists", lists), ("buffer", buffer)):
+        tracemalloc.start()
+        t0 = time.perf_counter()
+        data = gather()
+        result[name + "_time"] = time.perf_counter() - t0
+        result[name + "_peak"] = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        if not np.array_equal(data, words):
+            raise RuntimeError(name + " does not gather the replies")
+    print(
+        "{} words | lists {lists_peak:.2e} B, {lists_time:.2f} s | "
+        "buffer {buffer_peak:.2e} B, {buffer_time:.3f} s".format(n_words, **result)
+    )
+    return result
+
+
+def run_cache(n_pulses=12, repeat=20):
+    """
+    Time process_sequencing on a new table (compiled and written) and on a
+    table already processed (cache hit, nothing written)
+    Output:
+        dict of both times (s) and of RFSoC.sequence_stats
+    """
+    rfsoc, server = connect()
+    try:
+        pulses = random_pulses(n_pulses)
+
+        def process(new):
+            if new:
+                rfsoc.forget_sequence()
+                rfsoc.n_rep(rfsoc.n_rep() + 1)
+            rfsoc.pulses = pd.DataFrame(pulses)
+            rfsoc.process_sequencing()
+
+        result = dict(
+            miss=best_time(lambda: process(True), repeat),
+            hit=best_time(lambda: process(False), repeat),
+            stats=dict(rfsoc.sequence_stats),
+        )
+    finally:
+        rfsoc.close()
+        if server is not None:
+            server.stop()
+    print(
+        "process_sequencing {} pulses | new table {miss:9.2e} s | "
+        "same table {hit:9.2e} s | {stats}".format(n_pulses, **result)
+    )
+    return result
+
+
+# IQ on ADC1 and ADC2 and a RAW trace of 200 points on ADC3, and the settings
+# set by compile_sequence for this sequence
+READOUT_PACKETS = [(1, 1, 1000), (2, 1, 1000), (3, 0, 200)]
+READOUT_SETTINGS = dict(
+    length_vec=[[1], [1], [200], [], [], [], [], []],
+    ch_vec=[0, 1, 2],
+    ADC_ch_active=np.array([1, 1, 1, 0, 0, 0, 0, 0]),
+    adc_mode_arr=np.array([1, 1, 0, 1, 1, 1, 1, 1]),
+    acquisition_mode=["IQ", "IQ", "RAW"] + [None] * 5,
+)
+
+
+def run_readout(n_rep=2000, word_rate=2e5, chunk_size=50_000, path=None):
+    """
+    Time get_readout_pulse against a StreamServer producing word_rate words per
+    second, with OUTPUT:DATA? polled every 10 ms (the fixed interval used
+    before ReadoutPoller) and with the adaptive interval, and check that both
+    give the data of the stream
+    Input:
+        path(str): JSON file where RFSoC.readout_stats of the adaptive readout
+        is written
+    Output:
+        dict of the readout time (s) and number of queries of both
+    """
+    stream = fake_stream(n_rep, READOUT_PACKETS)
+    reference_I, _ = decode_packets(stream, n_rep, len(stream) // n_rep)
+    server = StreamServer(stream, n_rep, word_rate, chunk_size)
+    rfsoc, _ = connect(server.address)
+    result = {}
+    try:
+        rfsoc.n_rep(n_rep)
+        rfsoc.restore_readout_settings(READOUT_SETTINGS)
+        for name, interval in (("fixed", 0.01), ("adaptive", None)):
+            if interval is not None:
+                rfsoc.poll_interval_min = rfsoc.poll_interval_max = interval
+            else:
+                rfsoc.poll_interval_min, rfsoc.poll_interval_max = 1e-3, 0.1
+            queries = server.data_queries
+            t0 = time.perf_counter()
+            I, _ = rfsoc.get_readout_pulse()
+            result[name] = time.perf_counter() - t0
+            result[name + "_queries"] = server.data_queries - queries
+            if not np.array_equal(I[0], np.reshape(reference_I[0], (n_rep, 1)).T):
+                raise RuntimeError("get_readout_pulse does not give the stream data")
+        result["stats"] = rfsoc.readout_stats(path)
+    finally:
+        rfsoc.close()
+        server.stop()
+    print(
+        "readout {} rep at {:.1e} words/s | fixed 10 ms {fixed:.2f} s, "
+        "{fixed_queries} queries | adaptive {adaptive:.2f} s, {adaptive_queries} "
+        "queries".format(n_rep, word_rate, **result)
+    )
+    return result
+
+
+def run_transfer(n_queries=20, test_words=2**20, path=None):
+    """
+    RFSoC.benchmark_transfer against a StreamServer: MB/s, packets/s, latency
+    percentiles and maximum event rate per active ADC channel for the readout
+    settings of run_readout
+    Input:
+        path(str): JSON file where the results are written
+    Output:
+        dict returned by benchmark_transfer
+    """
+    server = StreamServer([], test_words=test_words)
+    rfsoc, _ = connect(server.address)
+    try:
+        rfsoc.restore_readout_settings(READOUT_SETTINGS)
+        stats = rfsoc.benchmark_transfer(n_queries, path=path)
+    finally:
+        rfsoc.close()
+        server.stop()
+    print(
+        "OUTPUT:DATATEST? x {queries} | {link_MBps:.1f} MBps | "
+        "{packets_per_s:.1f} packets/s | latency {latency_p50_ms:.1f} ms "
+        "(50%), {latency_p99_ms:.1f} ms (99%) | events/s {event_rate}".format(**stats)
+    )
+    return stats
+
+
+def run_recovery(n_rep=2000, word_rate=2e6):
+    """
+    Readouts with a glitch in the first run of the sequence: the board stops
+    sending data (timeout), or sends a repetition with a wrong header. Check
+    that get_readout_pulse keeps the repetitions received before the glitch
+    and acquires the missing ones only, or returns the valid repetitions with
+    readout_complete False when it may not retry
+    Output:
+        dict, by glitch, of the readout time (s), of the repetitions acquired
+        again and of RFSoC.recovery_stats
+    """
+    stream = fake_stream(n_rep, READOUT_PACKETS)
+    stride = len(stream) // n_rep
+    sequence = "SEQ 0,1,9,4106,0,257,{},1,0,513,0,0,0".format(n_rep - 1)
+    stall = dict(stall_after=int(0.6 * n_rep) * stride + 100)
+    corrupt = dict(corrupt_at=int(0.3 * n_rep) * stride)
+    results = {}
+    for glitch, server_kwargs, kept, retries in (
+        ("stall", stall, int(0.6 * n_rep), 5),
+        ("corrupt", corrupt, int(0.3 * n_rep), 5),
+        ("stall, no retry", stall, int(0.6 * n_rep), 0),
+    ):
+        server = StreamServer(stream, n_rep, word_rate, **server_kwargs)
+        rfsoc, _ = connect(server.address)
+        try:
+            rfsoc.n_rep(n_rep)
+            rfsoc.restore_readout_settings(READOUT_SETTINGS)
+            rfsoc.readout_timeout = 0.5
+            rfsoc.readout_retries = retries
+            rfsoc.upload("SEQ", sequence)
+            t0 = time.perf_counter()
+            I, _ = rfsoc.get_readout_pulse()
+            duration = time.perf_counter() - t0
+            if retries:
+                # the repetitions acquired again start from the first one
+                expected = np.concatenate(
+                    (stream[: kept * stride], stream[: (n_rep - kept) * stride])
+                )
+            else:
+                expected = stream[: kept * stride]
+            n_expected = len(expected) // stride
+            reference_I, _ = decode_packets(expected, n_expected, stride)
+            if rfsoc.readout_complete != bool(retries) or not np.array_equal(
+                I[0], np.reshape(reference_I[0], (n_expected, 1)).T
+            ):
+                raise RuntimeError("get_readout_pulse does not recover the data")
+            if rfsoc._uploaded["SEQ"] != sequence:
+                raise RuntimeError("the sequence of n_rep repetitions is not restored")
+            results[glitch] = dict(
+                time=duration,
+                acquired_again=n_expected - kept,
+                stats=dict(rfsoc.recovery_stats),
+            )
+        finally:
+            rfsoc.close()
+            server.stop()
+        print(
+            "{:<15s} | {time:.2f} s | {acquired_again} of {} repetitions "
+            "acquired again | {stats}".format(glitch, n_rep, **results[glitch])
+        )
+    return results
+
+
+def power_reference(I, Q):
+    """
+    RMS power of every pulse with the loops of ADC_power before Acquisition,
+    with the Q points of a pulse taken over all the repetitions like the I
+    points
+    """
+    power = [[] for v in range(8)]
+    for v in range(8):
+        for j in range(len(I[v])):
+            if len(I[v][j]) > 0:
+                if len(Q[v]) > 0:
+                    Q_pulse = np.reshape(Q[v], (-1, len(I[v])))[:, j]
+                else:
+                    Q_pulse = np.zeros(1)
+                power[v].append(
+                    (np.mean(I[v][j] ** 2) + np.mean(Q_pulse**2)) / (50 * 2)
+                )
+        power[v] = np.array(power[v])
+    return power
+
+
+def run_acquisition(n_rep=1000, repeat=5):
+    """
+    Read BUFFER_DATA, ADC_power, ADC_power_dBm and the ADC_DATA of two channels
+    in a shared_acquisition block, check that a single readout serves them all
+    and that the powers are those of the loops they replace, check that every
+    read outside of the block makes its own readout, then time both power
+    computations on 8 channels of 20 IQ pulses
+    Output:
+        dict of the number of readouts and of the power computation times (s)
+    """
+    from rfSoC_220127_cont_gen import Acquisition
+
+    stream = fake_stream(n_rep, READOUT_PACKETS)
+    server = StreamServer(stream, n_rep)
+    rfsoc, _ = connect(server.address)
+    try:
+        rfsoc.n_rep(n_rep)
+        rfsoc.restore_readout_settings(READOUT_SETTINGS)
+        rfsoc.acquisition_delay = 0
+        with rfsoc.shared_acquisition():
+            I, Q = rfsoc.BUFFER_DATA()
+            power = rfsoc.ADC_power()
+            power_dBm = rfsoc.ADC_power_dBm()
+            rfsoc.channels[0].ADC_DATA()
+            rfsoc.channels[1].ADC_DATA()
+        shared = server.runs
+        rfsoc.ADC_power()
+        rfsoc.ADC_power_dBm()
+        result = dict(shared_readouts=shared, readouts=server.runs - shared)
+    finally:
+        rfsoc.close()
+        server.stop()
+    reference = power_reference(I, Q)
+    for p, p_dBm, p_ref in zip(power, power_dBm, reference):
+        if not np.allclose(p, p_ref) or not np.allclose(p_dBm, 10 * np.log10(1e3 * p)):
+            raise RuntimeError("Acquisition.power differs from the loops")
+    if result["shared_readouts"] != 1:
+        raise RuntimeError("the readout is not shared in shared_acquisition")
+    if result["readouts"] != 2:
+        raise RuntimeError("a read outside of shared_acquisition reused a readout")
+
+    rng = np.random.default_rng(0)
+    I = [rng.standard_normal((20, 10_000)) for v in range(8)]
+    Q = [rng.standard_normal(20 * 10_000) for v in range(8)]
+    result["loops"] = best_time(lambda: power_reference(I, Q), repeat)
+    result["vectorized"] = best_time(
+        lambda: Acquisition(I, Q, np.ones(8, dtype=int)).power, repeat
+    )
+    print(
+        "5 parameters shared: {shared_readouts} readout, 2 outside: {readouts} "
+        "readouts | power of 8 x 20 "
+        "pulses x 10000 rep: loops {loops:9.2e} s, vectorized {vectorized:9.2e} "
+        "s".format(**result)
+    )
+    return result
+
+
+def iq_balance_pulses(phase_offset, acq_length=10):
+    """
+    Pulse table of the phase sweep of rfSoC_support.optimize_IQ_balance
+    """
+    param_I = dict(amp=0.05, freq=50, dc_offset=8e-3, phase_offset=0)
+    param_Q = dict(amp=0.05, freq=50, dc_offset=6e-3, phase_offset=phase_offset)
+    return [
+        dict(label="signal+pump", module="DAC", channel=1, mode="sin", start=0,
+             length=acq_length + 2, param=param_I, parent=None),
+        dict(label="record_both", module="ADC", channel=1, mode="IQ", start=1.0,
+             length=acq_length, param=None, parent=None),
+        dict(label="signal+pump2", module="DAC", channel=2, mode="sin", start=0,
+             length=acq_length + 2, param=param_Q, parent=None),
+        dict(label="record_both2", module="ADC", channel=2, mode="IQ", start=1.0,
+             length=acq_length, param=None, parent=None),
+    ]  # fmt: skip
+
+
+def run_hot_swap(n_phases=36, acq_length=10):
+    """
+    Phase sweep of optimize_IQ_balance: a pulse table compiled and processed
+    for every phase, against update_DAC_pulse on the loaded sequence. Check that
+    both leave the same commands on the instrument
+    Output:
+        dict of the time of both sweeps (s) and of the commands written
+    """
+    phases = np.pi * np.arange(0, 360, 360 / n_phases) / 180
+    rfsoc, server = connect()
+    result = {}
+    try:
+        for name in ("process_sequencing", "update_DAC_pulse"):
+            rfsoc.forget_sequence()
+            rfsoc.pulses = pd.DataFrame(iq_balance_pulses(phases[0], acq_length))
+            rfsoc.process_sequencing()
+            sent = rfsoc.sequence_stats["sent"]
+            loaded = []
+            t0 = time.perf_counter()
+            for phase in phases:
+                if name == "process_sequencing":
+                    rfsoc.pulses = pd.DataFrame(iq_balance_pulses(phase, acq_length))
+                    rfsoc.process_sequencing()
+                else:
+                    rfsoc.update_DAC_pulse("signal+pump2", phase_offset=phase)
+                loaded.append(dict(rfsoc._uploaded))
+            result[name] = time.perf_counter() - t0
+            result[name + "_sent"] = rfsoc.sequence_stats["sent"] - sent
+            result[name + "_loaded"] = loaded
+        # the updated table is found in the cache
+        hits = rfsoc.sequence_stats["hit"]
+        rfsoc.process_sequencing()
+        cached = rfsoc.sequence_stats["hit"] == hits + 1
+    finally:
+        rfsoc.close()
+        if server is not None:
+            server.stop()
+    if result.pop("process_sequencing_loaded") != result.pop("update_DAC_pulse_loaded"):
+        raise RuntimeError("update_DAC_pulse does not load the compiled waveforms")
+    if not cached:
+        raise RuntimeError("the updated sequence is not in the cache")
+    print(
+        "{} phases | process_sequencing {process_sequencing:.3f} s, "
+        "{process_sequencing_sent} commands | update_DAC_pulse "
+        "{update_DAC_pulse:.3f} s, {update_DAC_pulse_sent} commands".format(
+            n_phases, **result
+        )
+    )
+    return result
+
+
+def cancellation_power(phase, amp, phase0=137.0, amp0=0.42, leak=1e-4, floor=-90.0):
+    """
+    Power (dBm) left by a cancellation tone of amplitude amp and phase (degree)
+    on a pump leak of power leak (W), cancelled at amp0, phase0 down to the
+    noise floor (dBm)
+    """
+    residual = np.abs(1 - amp / amp0 * np.exp(1j * np.pi * (phase - phase0) / 180))
+    return 10 * np.log10(1e3 * leak * residual**2 + 10 ** (floor / 10))
+
+
+def run_optimizers(noises=(0.05, 0.3, 1.0), n_seeds=10):
+    """
+    Search of the phase and amplitude of get_pump_cancel_rfsoc on
+    cancellation_power with a gaussian noise (dB), with every optimizer of
+    rfSoC_support. The grid has the settings of pump_cancellation_cls
+    Output:
+        list of dict, one per noise and optimizer, with the mean and maximum
+        number of acquisitions and the mean and worst power left (dBm)
+    """
+    from rfSoC_support import OPTIMIZERS, minimize
+
+    results = []
+    for noise in noises:
+        for method in OPTIMIZERS:
+            options = dict(points=21, rounds=2) if method == "grid" else {}
+            n_acquisitions = []
+            power = []
+            for seed in range(n_seeds):
+                rng = np.random.default_rng(seed)
+                result = minimize(
+                    lambda x: cancellation_power(*x) + noise * rng.normal(),
+                    x0=(180, 0.55),
+                    bounds=[(0, 360), (0.1, 1)],
+                    method=method,
+                    periodic=(True, False),
+                    xtol=(1, 0.005),
+                    db=True,
+                    **options,
+                )
+                n_acquisitions.append(result["n_acquisitions"])
+                power.append(cancellation_power(*result["x"]))
+            result = dict(
+                noise=noise,
+                method=method,
+                acquisitions=np.mean(n_acquisitions),
+                max_acquisitions=np.max(n_acquisitions),
+                power=np.mean(power),
+                worst_power=np.max(power),
+            )
+            results.append(result)
+            print(
+                "noise {noise:.2f} dB | {method:<11s} | {acquisitions:5.1f} "
+                "acquisitions (max {max_acquisitions}) | {power:6.1f} dBm left "
+                "(worst {worst_power:6.1f} dBm)".format(**result)
+            )
+    return results
+
+
+def run_frequency_batches(n_freqs=21, num_rep=100, link_rates=(None, 1e8, 2.5e7)):
+    """
+    check_ADC_meas_freq_cls end to end against a realtime RFSoCSimulator, from
+    the pulse tables to the powers: every frequency in IQ mode (measure_freq)
+    against batches of RAW segments (measure_batch). The link to the board is
+    modelled at every link_rate (bytes/s, None for the local socket). Check
+    that both give the same powers on the tones looped back on the ADCs
+    Output:
+        dict, by link rate, of the times of both scans (s), the words they
+        transferred and the largest difference of their powers (dB)
+    """
+    from rfSoC_simulator import RFSoCSimulator
+    from rfSoC_support import check_ADC_meas_freq_cls, frequency_batches
+
+    freqs = 50 + 10 * np.arange(n_freqs)
+    results = {}
+    for link_rate in link_rates:
+        result = {}
+        powers = {}
+        for mode in ["IQ", "batched"]:
+            sim = RFSoCSimulator(realtime=True, link_rate=link_rate)
+            sim.start()
+            rfsoc, _ = connect(sim.address)
+            # rfSoC_support addresses the ADCs as ADC1 and ADC2
+            rfsoc.add_submodule("ADC1", rfsoc.channels[0])
+            rfsoc.add_submodule("ADC2", rfsoc.channels[1])
+            check = check_ADC_meas_freq_cls(rfsoc)
+            check.num_rep = num_rep
+            check.batch_size = n_freqs
+            try:
+                t0 = time.perf_counter()
+                if mode == "IQ":
+                    power = [check.measure_freq(f) for f in freqs]
+                    power = [[p[0][0] for p in power], [p[1][0] for p in power]]
+                else:
+                    power = [[], []]
+                    segment_length = check.batch_acq_length + check.wait_time
+                    for batch in frequency_batches(
+                        freqs, check.batch_size, segment_length
+                    ):
+                        for v, p in enumerate(check.measure_batch(batch)):
+                            power[v].extend(p)
+                result[mode] = time.perf_counter() - t0
+            finally:
+                rfsoc.close()
+                sim.stop()
+            result[mode + "_words"] = sim.words_sent
+            powers[mode] = np.array(power)
+        result["difference_dB"] = np.max(np.abs(powers["IQ"] - powers["batched"]))
+        if result["difference_dB"] > 0.5:
+            raise RuntimeError(
+                "Batched powers {:.2f} dB away from the IQ mode".format(
+                    result["difference_dB"]
+                )
+            )
+        results[link_rate] = result
+        print(
+            "{} frequencies, link {:>7s} | IQ {IQ:.2f} s, {IQ_words} words | "
+            "batched {batched:.2f} s, {batched_words} words | powers within "
+            "{difference_dB:.2f} dB".format(
+                n_freqs,
+                "local" if link_rate is None else "{:.0f}MB/s".format(link_rate / 1e6),
+                **result,
+            )
+        )
+    return results
+
+
+def loopback_pulses(acq_length=1.0):
+    """
+    Pulse table of run_simulator: a sine on DAC 1 read in IQ mode on ADC 1, and
+    a sine on DAC 2 read in RAW mode on ADC 2
+    """
+    param_1 = dict(amp=0.5, freq=50, dc_offset=0, phase_offset=0)
+    param_2 = dict(amp=0.3, freq=100, dc_offset=0, phase_offset=0)
+    return [
+        dict(label="drive1", module="DAC", channel=1, mode="sin", start=0,
+             length=acq_length + 2, param=param_1, parent=None),
+        dict(label="record1", module="ADC", channel=1, mode="IQ", start=1.0,
+             length=acq_length, param=None, parent=None),
+        dict(label="drive2", module="DAC", channel=2, mode="sin", start=0,
+             length=acq_length + 2, param=param_2, parent=None),
+        dict(label="record2", module="ADC", channel=2, mode="RAW", start=1.0,
+             length=acq_length, param=None, parent=None),
+    ]  # fmt: skip
+
+
+SIMULATOR_CASES = {
+    "ideal": dict(),
+    "latency 2 ms": dict(latency=2e-3),
+    "fragments": dict(chunk_size=5000, fragment_size=1460, fragment_delay=1e-4),
+    "ERR retried": dict(err_every=5),
+    "ERR burst": dict(err_every=20, err_burst=22, err_runs=1),
+    "realtime": dict(realtime=True),
+}
+
+
+def run_simulator(n_rep=1000, cases=None, gain=0.5):
+    """
+    process_sequencing and get_readout_pulse against an RFSoCSimulator, for
+    every case of simulator settings: check that the readout is complete and
+    that the amplitudes of the pulses looped back on the ADCs are those of the
+    DAC, and print the times
+    Input:
+        cases(dict): RFSoCSimulator arguments by name, default SIMULATOR_CASES
+    Output:
+        dict, by case, of the times (s), of the queries of OUTPUT:DATA? and of
+        RFSoC.recovery_stats
+    """
+    from rfSoC_simulator import RFSoCSimulator
+
+    results = {}
+    for name, kwargs in (cases or SIMULATOR_CASES).items():
+        sim = RFSoCSimulator(gain=gain, **kwargs)
+        sim.start()
+        rfsoc, _ = connect(sim.address)
+        try:
+            rfsoc.n_rep(n_rep)
+            rfsoc.channels[0].fmixer(50)
+            rfsoc.pulses = pd.DataFrame(loopback_pulses())
+            t0 = time.perf_counter()
+            rfsoc.process_sequencing()
+            t1 = time.perf_counter()
+            I, Q = rfsoc.get_readout_pulse()
+            t2 = time.perf_counter()
+            calib = rfsoc.DAC_amplitude_calib
+            complete = rfsoc.readout_complete
+            stats = dict(rfsoc.recovery_stats)
+        finally:
+            rfsoc.close()
+            sim.stop()
+        if sim.errors or not complete:
+            raise RuntimeError("{}: incomplete readout {}".format(name, sim.errors))
+        amplitude_IQ = np.abs(I[0] + 1j * np.reshape(Q[0], np.shape(I[0]))).mean()
+        amplitude_RAW = np.sqrt(2 * np.mean(I[1][0] ** 2))
+        for measured, expected in (
+            (amplitude_IQ, gain * 0.5 * calib[0]),
+            (amplitude_RAW, gain * 0.3 * calib[1]),
+        ):
+            if abs(measured / expected - 1) > 0.02:
+                raise RuntimeError(
+                    "{}: amplitude {:.4f} V instead of {:.4f} V".format(
+                        name, measured, expected
+                    )
+                )
+        results[name] = dict(
+            process_sequencing=t1 - t0,
+            readout=t2 - t1,
+            queries=sim.data_queries,
+            err_replies=sim.err_replies,
+            stats=stats,
+        )
+        print(
+            "{:<12s} | process_sequencing {process_sequencing:.3f} s | readout "
+            "{} rep {readout:.2f} s, {queries} queries, {err_replies} ERR | "
+            "ERR seen {}, recovered {}".format(
+                name, n_rep, stats["ERR"], stats["recovered"], **results[name]
+            )
+        )
+    return results
+
+
+def send_DAC_2D_memory_reference(pulse, table, adress=0):
+    """
+    Text command of PulseGeneration.send_DAC_2D_memory before DAC_memory_command
+    """
+    table_bit = ",".join((table.astype(int)).astype(str))
+    return (
+        "DAC:DATA:" + pulse.channel + " " + str(adress) + "," + table_bit + ","
+        "0,0,0,0,0,0,0,0,0,0,16383"
+    )
+
+
+def run_DAC_encoding(durations=(1e-6, 8e-6, 64e-6), repeat=5):
+    """
+    Encode the DAC memory of SIN pulses of every duration with the former text
+    commands and with send_DAC_2D_memory: check that both give the same
+    command and print the times
+    Output:
+        list of dict, one per duration, with the size (bytes) and the times (s)
+    """
+    import contextlib
+    import io
+
+    import SequenceGeneration_v2 as sqg
+
+    results = []
+    for duration in durations:
+        pulse = sqg.PulseGeneration(
+            0.0, duration, "CH1", "SIN", [10e6, 0.5, 0], sequence=sqg.Sequence()
+        )
+        with contextlib.redirect_stdout(io.StringIO()):
+            table = pulse.fill_2D_memory()
+        command = pulse.send_DAC_2D_memory(100, table)
+        if command != send_DAC_2D_memory_reference(pulse, table, 100):
+            raise RuntimeError("send_DAC_2D_memory differs from the text command")
+
+        result = dict(
+            duration=duration,
+            rows=len(table) // sqg.DAC_ROW_SIZE,
+            size=len(command),
+            reference=best_time(
+                lambda: send_DAC_2D_memory_reference(pulse, table, 100), repeat
+            ),
+            vectorized=best_time(lambda: pulse.send_DAC_2D_memory(100, table), repeat),
+        )
+        results.append(result)
+        print(
+            "{:>4.0f} us, {rows:>5d} rows, {size} B | text {reference:9.2e} s | "
+            "send_DAC_2D_memory {vectorized:9.2e} s".format(duration * 1e6, **result)
+        )
+    return results
+
+
+if __name__ == "__main__":
+    run_compiler()
+    run_cache()
+    run_decoder()
+    run_receive_buffer()
+    run_readout()  # slow sequence: fewer and larger replies
+    run_readout(20_000, word_rate=1e9)  # replies capped at chunk_size: no wait
+    run_transfer()
+    run_recovery()
+    run_acquisition()
+    run_hot_swap()
+    run_optimizers()
+    run_frequency_batches()
+    run_simulator()
+    run_DAC_encoding()
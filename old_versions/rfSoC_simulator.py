@@ -0,0 +1,520 @@
+# -*- coding: utf-8 -*-
+# Local stand-in for the SCPI server of the rfSoC board.
+# It runs the programs written by rfSoC_220127_cont_gen.py (SEQ and
+# DAC:DATA:CHx) on a model of the board where every ADC sees the output of a DAC
+# channel, and answers OUTPUT:DATA? with the packets of the ADCs, so that
+# process_sequencing and get_readout_pulse can be tested and benchmarked
+# without the board:
+#
+#     sim = RFSoCSimulator(latency=1e-3, fragment_size=1460)
+#     sim.start()
+#     rfsoc = RFSoC("rfsoc", sim.address)
+#
+# Not modelled: the decimation, the continuous acquisition and the latencies
+# of the DAC and ADC pipelines.
+#
+
+import socket
+import threading
+import time
+
+import numpy as np
+
+from rfSoC_220127_cont_gen import HEADER_DTYPE
+
+SAMPLING_RATE = 2e9
+FPGA_CLOCK = 250e6
+SAMPLES_PER_CYCLE = 8
+ADC_LSB = 0.3838e-3  # V per ADC code, the code is in the 12 MSB of a word
+DAC_FULL_SCALE = 2**13
+
+# DAC memory: rows of 8 samples, a marker, a spare word and the number of
+# repetitions of the row; a row repeated END_OF_MEMORY times ends the memory
+DAC_ROWS = 16384
+ROW_WORDS = 11
+END_OF_MEMORY = 16383
+
+# sequencer instructions: (opcode, value) pairs
+WAIT = 1  # wait value + 1 cycles
+LOOP = 257  # repeat the instructions up to JUMP value + 1 times
+JUMP = 513
+OUTPUT = 4096  # ADC states in bits 24 to 31, DAC states in 3 bits per channel
+DAC_ADDRESS = 4096  # + channel: row where the next output of the DAC starts
+ACQ_MODE = 4106  # 4 bits per ADC: 0 for RAW, 1 for accumulated I and Q
+ADC_POINTS = 4106  # + channel: samples of the next acquisition of the ADC
+END = 0
+
+EMPTY_REPLY = b"#12\r\n\r\n"  # read by the driver as [3338]
+ERR_REPLY = b"ERR\r\n"
+
+
+class RFSoCSimulator:
+    """
+    TCP server answering like the SCPI server of the rfSoC board
+    Input:
+        host(string), port(int): port 0 takes a free port, see address
+        chunk_size(int): maximum number of words of an OUTPUT:DATA? reply
+        realtime(bool): after SEQ:START the repetitions become available at the
+        pace of the sequence, instead of as fast as they are asked
+        latency(float): delay before every reply (s)
+        link_rate(float): bytes per second of the link to the board, the
+        replies take len/link_rate seconds more; None for the local socket
+        fragment_size(int): replies are sent in pieces of fragment_size bytes,
+        fragment_delay seconds apart, None to send them at once
+        err_every(int): after every err_every OUTPUT:DATA? queries of a run,
+        the next err_burst queries are answered ERR, 0 for never. RFSoC.ask_raw
+        asks again after an ERR: get_readout_pulse only sees ERR after 22 of
+        them in a row
+        err_runs(int): ERR is only injected in the first err_runs runs after
+        SEQ:START, None for all the runs
+        test_words(int): number of words of an OUTPUT:DATATEST? reply
+        loopback(dict): DAC channel seen by every ADC channel (1 to 8), by
+        default the same channel
+        gain(float): volts on an ADC for a DAC value of 2**13
+        noise(float): standard deviation of the noise of the ADC samples (V)
+        seed(int): seed of the noise
+    """
+
+    def __init__(
+        self,
+        host="127.0.0.1",
+        port=0,
+        chunk_size=50_000,
+        realtime=False,
+        latency=0.0,
+        link_rate=None,
+        fragment_size=None,
+        fragment_delay=0.0,
+        err_every=0,
+        err_burst=1,
+        err_runs=None,
+        test_words=2**20,
+        loopback=None,
+        gain=0.5,
+        noise=1e-3,
+        seed=0,
+    ):
+        self.host = host
+        self.port = port
+        self.chunk_size = chunk_size
+        self.realtime = realtime
+        self.latency = latency
+        self.link_rate = link_rate
+        self.fragment_size = fragment_size
+        self.fragment_delay = fragment_delay
+        self.err_every = err_every
+        self.err_burst = err_burst
+        self.err_runs = err_runs
+        self.test_words = test_words
+        self.loopback = {ch: ch for ch in range(1, 9)}
+        self.loopback.update(loopback or {})
+        self.gain = gain
+        self.noise = noise
+        self.rng = np.random.default_rng(seed)
+
+        self.settings = {}  # commands without effect on the data, last argument
+        self.mixers = np.zeros(9)  # frequency of the mixer of every ADC (MHz)
+        self.memories = np.zeros((9, DAC_ROWS * ROW_WORDS), dtype=np.int64)
+        self.sequence = None
+        self.errors = []  # programs which could not be loaded
+        self.commands = {}  # number of commands received, by header
+        self.runs = 0
+        self.data_queries = 0
+        self.err_replies = 0
+        self.words_sent = 0
+
+        self._run = None
+        self._pending = np.array([], dtype=np.int16)
+        self._generated = 0
+        self._queries = 0
+        self._err_left = 0
+        self._t_start = 0.0
+
+        self._socket = None
+        self._thread = None
+
+    # ------------------------------------------------------------------ Server
+    @property
+    def address(self):
+        return "TCPIP::{}::{}::SOCKET".format(self.host, self.port)
+
+    def start(self):
+        self._socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self._socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self._socket.bind((self.host, self.port))
+        self.port = self._socket.getsockname()[1]
+        self._socket.listen(1)
+        self._thread = threading.Thread(target=self._serve, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        if self._socket is not None:
+            self._socket.close()
+            self._socket = None
+
+    def _serve(self):
+        while self._socket is not None:
+            try:
+                connection, _ = self._socket.accept()
+            except OSError:
+                return
+            connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            threading.Thread(
+                target=self._handle, args=(connection,), daemon=True
+            ).start()
+
+    def _handle(self, connection):
+        # the DAC memories are written in lines of several MB: the newline is
+        # only searched in the bytes received since the last search
+        buffer = bytearray()
+        searched = 0
+        with connection:
+            while True:
+                newline = buffer.find(b"\n", searched)
+                if newline == -1:
+                    searched = len(buffer)
+                    try:
+                        data = connection.recv(1 << 20)
+                    except OSError:
+                        return
+                    if not data:
+                        return
+                    buffer += data
+                    continue
+                cmd = buffer[:newline].decode().strip()
+                del buffer[: newline + 1]
+                searched = 0
+                reply = self.command(cmd)
+                if reply is not None:
+                    try:
+                        self._send(connection, reply)
+                    except OSError:
+                        return
+
+    def _send(self, connection, reply):
+        if self.latency:
+            time.sleep(self.latency)
+        if self.link_rate:
+            time.sleep(len(reply) / self.link_rate)
+        if not self.fragment_size:
+            connection.sendall(reply)
+            return
+        for i in range(0, len(reply), self.fragment_size):
+            if i and self.fragment_delay:
+                time.sleep(self.fragment_delay)
+            connection.sendall(reply[i : i + self.fragment_size])
+
+    # ---------------------------------------------------------------- Commands
+    def command(self, cmd):
+        """
+        Execute a SCPI command
+        Output:
+            the reply (bytes) for a query, None otherwise
+        """
+        if not cmd:
+            return None
+        header, _, argument = cmd.partition(" ")
+        header = header.upper()
+        self.commands[header] = self.commands.get(header, 0) + 1
+
+        if header == "*IDN?":
+            return b"rfSoC,simulator,0,0\r\n"
+        if header == "OUTPUT:DATA?":
+            return self._data_reply()
+        if header == "OUTPUT:DATATEST?":
+            return self._block(np.arange(self.test_words).astype(np.int16))
+        if header == "SEQ":
+            self._load_sequence(argument)
+        elif header == "SEQ:START":
+            self._start()
+        elif header == "SEQ:STOP":
+            self._run = None
+            self._pending = self._pending[:0]
+        elif header.startswith("DAC:DATA:CH"):
+            ch = int(header[len("DAC:DATA:CH")])
+            if header.endswith(":CLEAR"):
+                self.memories[ch] = 0
+            else:
+                self._load_memory(ch, argument)
+        elif header.startswith("ADC:ADC") and header.endswith(":MIXER"):
+            self.mixers[int(header[len("ADC:ADC")])] = float(argument)
+        else:
+            # ADC status and decimation, output format, PLL and relays
+            self.settings[header] = argument.strip()
+        return None
+
+    def _load_memory(self, ch, argument):
+        words = np.array(argument.split(","), dtype=np.int64)
+        address, words = words[0], words[1:]
+        if len(words) % ROW_WORDS or address + len(words) // ROW_WORDS > DAC_ROWS:
+            self.errors.append(
+                "DAC:DATA:CH{}: {} words from row {} do not fit in the memory".format(
+                    ch, len(words), address
+                )
+            )
+            words = words[: (DAC_ROWS - address) * ROW_WORDS]
+            words = words[: len(words) - len(words) % ROW_WORDS]
+        start = address * ROW_WORDS
+        self.memories[ch, start : start + len(words)] = words
+
+    def _load_sequence(self, argument):
+        try:
+            self.sequence = run_program(np.array(argument.split(","), dtype=np.int64))
+        except ValueError as error:
+            self.errors.append("SEQ: " + str(error))
+            self.sequence = None
+
+    # -------------------------------------------------------------------- Data
+    def _start(self):
+        self.runs += 1
+        self._run = None if self.sequence is None else self._compile_run()
+        self._pending = np.array([], dtype=np.int16)
+        self._generated = 0
+        self._queries = 0
+        self._err_left = 0
+        self._t_start = time.perf_counter()
+
+    def dac_output(self, ch, n_samples):
+        """
+        Output of a DAC channel during a repetition of the loaded sequence, in
+        DAC units
+        Input:
+            ch(int): DAC channel, 1 to 8
+            n_samples(int): number of samples
+        Output:
+            float array of n_samples samples
+        """
+        output = np.zeros(n_samples)
+        rows = self.memories[ch].reshape(DAC_ROWS, ROW_WORDS)
+        for start, stop, address in self.sequence["DAC"].get(ch, []):
+            first = SAMPLES_PER_CYCLE * start
+            length = min(SAMPLES_PER_CYCLE * (stop - start), n_samples - first)
+            played = rows[address:]
+            end = np.flatnonzero(played[:, -1] >= END_OF_MEMORY)
+            if len(end):
+                played = played[: end[0]]
+            # only the rows played before the stop are repeated
+            counts = played[:, -1] + 1
+            n_rows = np.searchsorted(np.cumsum(counts) * SAMPLES_PER_CYCLE, length) + 1
+            samples = np.repeat(played[:n_rows, :8], counts[:n_rows], axis=0).ravel()
+            samples = samples[:length]
+            output[first : first + len(samples)] = samples
+        return output
+
+    def _compile_run(self):
+        """
+        Words of a repetition of the loaded sequence without the noise and the
+        timestamps, and the slots filled for every repetition
+        """
+        sequence = self.sequence
+        n_samples = SAMPLES_PER_CYCLE * sequence["period"]
+        outputs = {}
+        words = []
+        raw, iq, timestamps = [], [], []
+        offset = 0
+        for start, ch, N in sequence["ADC"]:
+            dac = self.loopback[ch]
+            if dac not in outputs:
+                outputs[dac] = (
+                    self.gain * self.dac_output(dac, n_samples) / DAC_FULL_SCALE
+                )
+            first = SAMPLES_PER_CYCLE * start
+            volts = np.zeros(N)
+            signal = outputs[dac][first : first + N]
+            volts[: len(signal)] = signal
+            dsp_type = (sequence["acq_mode"] >> 4 * (ch - 1)) & 0x1
+
+            header = np.zeros(1, dtype=HEADER_DTYPE)
+            header["channel"] = ch
+            header["dsp_type"] = dsp_type
+            header["N"] = N
+            words.append(header.view(np.int16))
+            timestamps.append((offset, start))
+            if dsp_type == 0:
+                raw.append((offset + 8, volts))
+                words.append(np.zeros(N, dtype=np.int16))
+                offset += 8 + N
+            else:
+                # demodulated from the start of the repetition, I + iQ is the
+                # complex amplitude of the signal at the mixer frequency
+                omega = 2 * np.pi * self.mixers[ch] * 1e6
+                t = (first + np.arange(N)) / SAMPLING_RATE
+                amplitude = 2 * np.mean(volts * np.exp(-1j * omega * t))
+                iq.append((offset + 8, amplitude, omega, N))
+                words.append(np.zeros(8, dtype=np.int16))
+                offset += 16
+        template = np.concatenate(words) if words else np.array([], dtype=np.int16)
+        return dict(template=template, raw=raw, iq=iq, timestamps=timestamps)
+
+    def repetitions(self, first, n):
+        """
+        Words sent by the ADCs for n repetitions of the loaded sequence
+        Input:
+            first(int): index of the first repetition since SEQ:START
+        Output:
+            int16 array
+        """
+        run = self._run
+        words = np.tile(run["template"], (n, 1))
+        cycles = self.sequence["start"] + self.sequence["period"] * (
+            first + np.arange(n)
+        )
+        for offset, start in run["timestamps"]:
+            stamps = (cycles + start).astype("<u8")
+            words[:, offset + 4 : offset + 8] = stamps[:, None].view(np.int16)
+        for offset, volts in run["raw"]:
+            noisy = volts + self.noise * self.rng.standard_normal((n, len(volts)))
+            codes = np.clip(np.round(noisy / ADC_LSB), -2048, 2047).astype(np.int16)
+            words[:, offset : offset + len(volts)] = codes << 4
+        for offset, amplitude, omega, N in run["iq"]:
+            # the mixer runs from SEQ:START: the phase of a repetition depends
+            # on its start
+            t = SAMPLES_PER_CYCLE * cycles / SAMPLING_RATE
+            value = amplitude * np.exp(-1j * omega * t)
+            value = value + self.noise * np.sqrt(2 / N) * (
+                self.rng.standard_normal(n) + 1j * self.rng.standard_normal(n)
+            )
+            # the driver divides the sums by N*2*4
+            sums = np.stack((value.real, value.imag), axis=1) * 8 * N / ADC_LSB
+            words[:, offset : offset + 8] = np.round(sums).astype("<i8").view(np.int16)
+        return words.ravel()
+
+    def _available(self):
+        """
+        Number of repetitions of the run which can be sent
+        """
+        n_rep = self.sequence["n_rep"]
+        if not self.realtime:
+            return n_rep
+        cycles = (time.perf_counter() - self._t_start) * FPGA_CLOCK
+        done = int((cycles - self.sequence["start"]) // self.sequence["period"])
+        return min(max(done, 0), n_rep)
+
+    def _data_reply(self):
+        self.data_queries += 1
+        if self._run is None:
+            return EMPTY_REPLY
+        self._queries += 1
+        injecting = self.err_runs is None or self.runs <= self.err_runs
+        if injecting and self.err_every and self._queries % self.err_every == 0:
+            self._err_left = self.err_burst
+        if self._err_left:
+            self._err_left -= 1
+            self.err_replies += 1
+            return ERR_REPLY
+
+        stride = len(self._run["template"])
+        missing = self.chunk_size - len(self._pending)
+        if missing > 0 and stride:
+            n = min(-(-missing // stride), self._available() - self._generated)
+            if n > 0:
+                self._pending = np.concatenate(
+                    (self._pending, self.repetitions(self._generated, n))
+                )
+                self._generated += n
+        words = self._pending[: self.chunk_size]
+        self._pending = self._pending[self.chunk_size :]
+        self.words_sent += len(words)
+        return self._block(words)
+
+    @staticmethod
+    def _block(words):
+        if len(words) == 0:
+            return EMPTY_REPLY
+        payload = words.astype("<i2").tobytes()
+        size = str(len(payload)).encode()
+        return b"#" + str(len(size)).encode() + size + payload + b"\r\n"
+
+
+def run_program(words):
+    """
+    Run the program of a SEQ command once, without the repetitions
+    Input:
+        words(int array): arguments of the SEQ command, the first one is the
+        address of the program
+    Output:
+        dict with the ADC mode word (acq_mode), the number of repetitions
+        (n_rep), the cycle where the first repetition starts (start) and the
+        cycles of a repetition (period); the acquisitions of a repetition
+        (ADC), as (start, channel, samples) sorted by start, and the outputs of
+        every DAC channel (DAC), as (start, stop, row) lists. The times are in
+        cycles of the FPGA clock, from the start of the repetition
+    """
+    words = words[1:]
+    if len(words) % 2:
+        raise ValueError("odd number of words after the address")
+    acq_mode = 0
+    n_rep = 1
+    loop_start = None
+    cycle = 0
+    adc_points = np.zeros(9, dtype=np.int64)
+    dac_addresses = np.zeros(9, dtype=np.int64)
+    adc_state = 0
+    playing = {}
+    acquisitions = []
+    outputs = {}
+    period = None
+    for opcode, value in zip(words[::2].tolist(), words[1::2].tolist()):
+        if opcode == END:
+            break
+        if opcode == WAIT:
+            cycle += value + 1
+            continue
+        if opcode == LOOP:
+            if loop_start is not None:
+                raise ValueError("nested loops are not supported")
+            cycle += 1
+            n_rep = value + 1
+            loop_start = cycle
+            continue
+        if opcode == JUMP:
+            cycle += 2
+            if loop_start is not None and period is None:
+                period = cycle - loop_start
+            continue
+
+        cycle += 1
+        t = cycle - (loop_start or 0)
+        if opcode == ACQ_MODE:
+            acq_mode = value
+        elif DAC_ADDRESS < opcode <= DAC_ADDRESS + 8:
+            dac_addresses[opcode - DAC_ADDRESS] = value
+        elif ADC_POINTS < opcode <= ADC_POINTS + 8:
+            adc_points[opcode - ADC_POINTS] = value
+        elif opcode == OUTPUT:
+            for ch in range(1, 9):
+                if (value >> (23 + ch)) & 1 and not (adc_state >> (ch - 1)) & 1:
+                    acquisitions.append((t, ch, int(adc_points[ch])))
+                state = (value >> 3 * (ch - 1)) & 0x7
+                if state in (1, 3) and ch in playing:
+                    start, address = playing.pop(ch)
+                    outputs.setdefault(ch, []).append((start, t, address))
+                if state == 3:
+                    playing[ch] = (t, int(dac_addresses[ch]))
+            adc_state = value >> 24
+        else:
+            raise ValueError("unknown instruction {},{}".format(opcode, value))
+
+    if loop_start is None or period is None:
+        raise ValueError("no repetition loop")
+    for ch, (start, address) in playing.items():
+        outputs.setdefault(ch, []).append((start, period, address))
+    return dict(
+        acq_mode=acq_mode,
+        n_rep=n_rep,
+        start=loop_start,
+        period=period,
+        ADC=sorted(acquisitions),
+        DAC=outputs,
+    )
+
+
+if __name__ == "__main__":
+    sim = RFSoCSimulator(port=5000, realtime=True)
+    sim.start()
+    print("rfSoC simulator listening on " + sim.address)
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        sim.stop()
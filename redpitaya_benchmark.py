@@ -0,0 +1,370 @@
+# -*- coding: utf-8 -*-
+# Benchmarks of the Redpitaya driver, without the card:
+# - run and run_LUT time the decoding of OUTPUT:DATA? replies and the encoding
+#   of the LUTs, on replies generated locally
+# - run_simulator measures the number of points per second of the driver
+#   talking to redpitaya_simulator.py, and can be used to catch regressions
+#   of the acquisition path
+# - run_shared_sweep checks that every derived parameter reads the data of its
+#   own point, and that the ones read in a shared_acquisition block share one
+#   acquisition
+# - run_background checks that the background worker only acquires a point
+#   once its setpoint is set, and times it against get_data
+# - run_drain checks that the data still in flight after stop is not read by
+#   the next acquisition
+#
+
+import contextlib
+import time
+
+import numpy as np
+from pyvisa.util import from_ieee_block, to_ieee_block
+
+from redpitaya_qcodes import decode_ascii_block, decode_binary_block, pack_LUT
+
+
+def fake_signal(nb_measure, words_per_trace=4, seed=0):
+    """
+    Data words as produced by the FPGA: the two LSB hold the tick of the trace
+    """
+    rng = np.random.default_rng(seed)
+    signal = rng.integers(-(2**20), 2**20, nb_measure * words_per_trace) * 4
+    tick = np.repeat(np.arange(nb_measure) % 4, words_per_trace)
+    return (signal + tick).astype("int32")
+
+
+def ascii_reply(signal):
+    return "{0," + ",".join(signal.astype(str)) + "}"
+
+
+def binary_reply(signal):
+    words = np.concatenate((np.zeros(1, dtype="int32"), signal))
+    return bytes(to_ieee_block(words, datatype="i", is_big_endian=True))
+
+
+def decode_ascii_eval(rep):
+    """
+    Decoding used by the driver before the BIN format was supported
+    """
+    return np.array(eval("[" + rep[3:-1] + "]"), dtype="int32")
+
+
+def decode_ascii(rep):
+    return decode_ascii_block(rep)[1]
+
+
+def decode_binary(block):
+    words = from_ieee_block(block, datatype="i", is_big_endian=True, container=np.array)
+    return decode_binary_block(words)[1]
+
+
+def time_decoder(decoder, reply, repeat=5):
+    best = np.inf
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        decoder(reply)
+        best = min(best, time.perf_counter() - t0)
+    return best
+
+
+def run(nb_measures=(10**3, 10**4, 10**5), repeat=5):
+    """
+    Decode the same IQINT data in the three formats and print the throughput
+    Output:
+        list of dict, one per nb_measure, with the best time of each decoder (s)
+    """
+    results = []
+    for nb_measure in nb_measures:
+        signal = fake_signal(nb_measure)
+        rep_ascii = ascii_reply(signal)
+        rep_bin = binary_reply(signal)
+
+        for decoder, reply in (
+            (decode_ascii_eval, rep_ascii),
+            (decode_ascii, rep_ascii),
+            (decode_binary, rep_bin),
+        ):
+            if not np.array_equal(decoder(reply), signal):
+                raise RuntimeError(decoder.__name__ + " does not decode the data")
+
+        result = dict(
+            nb_measure=nb_measure,
+            ascii_bytes=len(rep_ascii),
+            bin_bytes=len(rep_bin),
+            ascii_eval=time_decoder(decode_ascii_eval, rep_ascii, repeat),
+            ascii=time_decoder(decode_ascii, rep_ascii, repeat),
+            bin=time_decoder(decode_binary, rep_bin, repeat),
+        )
+        results.append(result)
+        print(
+            "{nb_measure:>8d} traces | ASCII eval {ascii_eval:9.2e} s | "
+            "ASCII {ascii:9.2e} s | BIN {bin:9.2e} s | "
+            "{ascii_bytes} B vs {bin_bytes} B".format(**result)
+        )
+        print(
+            "{:>8s}        | BIN is {:.0f}x faster than ASCII eval".format(
+                "", result["ascii_eval"] / result["bin"]
+            )
+        )
+    return results
+
+
+def encode_LUT_ascii(table):
+    """
+    Message sent by send_DAC_LUT with lut_format('ASCII')
+    """
+    return ("DAC:CH1 " + ", ".join(pack_LUT(table, "CH1").astype(str))).encode()
+
+
+def encode_LUT_binary(table):
+    """
+    Message sent by send_DAC_LUT with lut_format('BIN')
+    """
+    return b"DAC:CH1 " + bytes(
+        to_ieee_block(pack_LUT(table, "CH1"), datatype="i", is_big_endian=True)
+    )
+
+
+def run_LUT(repeat=20):
+    """
+    Encode a full 8192 points LUT in both formats and print the message sizes
+    and the encoding times
+    """
+    table = 0.9 * 8192 * np.sin(np.linspace(0, 200 * np.pi, 8192))
+    result = dict(
+        ascii_bytes=len(encode_LUT_ascii(table)),
+        bin_bytes=len(encode_LUT_binary(table)),
+        ascii=time_decoder(encode_LUT_ascii, table, repeat),
+        bin=time_decoder(encode_LUT_binary, table, repeat),
+    )
+    print(
+        "LUT 8192 points | ASCII {ascii:9.2e} s, {ascii_bytes} B | "
+        "BIN {bin:9.2e} s, {bin_bytes} B".format(**result)
+    )
+    return result
+
+
+def points_per_second(function, points):
+    t0 = time.perf_counter()
+    for _ in range(points):
+        function()
+    return points / (time.perf_counter() - t0)
+
+
+def run_simulator(nb_measure=1000, points=20, chunk_size=4096, **simulator_kwargs):
+    """
+    Measure the throughput of the driver connected to a local simulator
+    Input:
+        nb_measure(int): number of traces of every get_data point
+        points(int): number of points measured for every benchmark
+        chunk_size(int), simulator_kwargs: see RedpitayaSimulator
+    Output:
+        dict of the points per second of every benchmark
+    """
+    from redpitaya_qcodes import Redpitaya
+    from redpitaya_simulator import RedpitayaSimulator
+
+    sim = RedpitayaSimulator(chunk_size=chunk_size, **simulator_kwargs)
+    sim.start()
+    rp = Redpitaya("rp_benchmark", sim.address, visalib="@py")
+    results = {}
+    try:
+        rp.start_ADC(0)
+        rp.stop_ADC(1e-6)
+        rp.nb_measure(nb_measure)
+        for mode in ["IQINT", "ADC"]:
+            rp.mode_output(mode)
+            for data_format in ["ASCII", "BIN"]:
+                rp.acquisition_format(data_format)
+                key = "get_data {} {}".format(mode, data_format)
+                results[key] = points_per_second(rp.get_data, points)
+            key = "get_single_pulse " + mode
+            results[key] = points_per_second(rp.get_single_pulse, points)
+
+        # without the delay between two LUTs, to measure the transfer itself
+        rp.lut_delay = 0
+        table = rp.fill_LUT("SIN", [10e6, 0.5, 8192 * 8e-9, 0])
+        for lut_format in ["ASCII", "BIN"]:
+            rp.lut_format(lut_format)
+
+            def upload():
+                rp.forget_LUT()
+                rp.send_DAC_LUT(table, "CH1")
+
+            results["send_DAC_LUT " + lut_format] = points_per_second(upload, points)
+        results["send_DAC_LUT unchanged"] = points_per_second(
+            lambda: rp.send_DAC_LUT(table, "CH1"), points
+        )
+    finally:
+        rp.close()
+        sim.stop()
+
+    for key, value in results.items():
+        print("{:<28s} {:10.1f} points/s".format(key, value))
+    return results
+
+
+def run_shared_sweep(points=10, nb_measure=100, **simulator_kwargs):
+    """
+    Sweep of an outside instrument, stood for by the iq_values of the simulator,
+    reading a different set of derived parameters at every point, with and
+    without a shared_acquisition block around the reads of a point. Every value
+    must come from the acquisition of its own point. In the block, the
+    parameters of a point share one acquisition, without it every read takes
+    its own.
+    Output:
+        dict of the number of acquisitions with and without shared_acquisition
+    """
+    from redpitaya_qcodes import Redpitaya
+    from redpitaya_simulator import RedpitayaSimulator
+
+    sim = RedpitayaSimulator(noise=0, **simulator_kwargs)
+    sim.start()
+    rp = Redpitaya("rp_benchmark", sim.address, visalib="@py")
+    # I2_INT_AVG is only read at odd points, and read first
+    readouts = [[(rp.I1_INT_AVG, 0), (rp.Q1_INT_AVG, 1)]]
+    readouts.append([(rp.I2_INT_AVG, 2), (rp.Q1_INT_AVG, 1)])
+    results = {}
+    try:
+        rp.start_ADC(0)
+        rp.stop_ADC(1e-6)
+        rp.nb_measure(nb_measure)
+        rp.mode_output("IQINT")
+        for shared in [True, False]:
+            generation = rp.acquisition_generation
+            stale = 0
+            for k in range(points):
+                sim.iq_values = 0.01 * (k + 1) * np.array([1.0, -1.0, 2.0, 0.0])
+                with rp.shared_acquisition() if shared else contextlib.nullcontext():
+                    for parameter, index in readouts[k % 2]:
+                        value = parameter()
+                        if not np.isclose(value, sim.iq_values[index], atol=1e-4):
+                            stale += 1
+            acquisitions = rp.acquisition_generation - generation
+            expected = points if shared else 2 * points
+            if stale or acquisitions != expected:
+                raise RuntimeError(
+                    "{} stale values and {} acquisitions for {} points".format(
+                        stale, acquisitions, points
+                    )
+                )
+            key = "with" if shared else "without"
+            results[key] = acquisitions
+            print(
+                "{} shared_acquisition: {} stale values, {} acquisitions "
+                "for {} points".format(key, stale, acquisitions, points)
+            )
+    finally:
+        rp.close()
+        sim.stop()
+    return results
+
+
+def run_background(points=20, nb_measure=1000, settle_time=0.05, **simulator_kwargs):
+    """
+    Sweep of an outside instrument (the iq_values of the simulator, settling in
+    settle_time seconds), with a shared_acquisition block at every setpoint,
+    with and without the background worker. Every value must come from the
+    acquisition of its own point.
+    Output:
+        dict of the duration of both sweeps (s)
+    """
+    from redpitaya_qcodes import Redpitaya
+    from redpitaya_simulator import RedpitayaSimulator
+
+    sim = RedpitayaSimulator(noise=0, **simulator_kwargs)
+    sim.start()
+    rp = Redpitaya("rp_benchmark", sim.address, visalib="@py")
+    results = {}
+    try:
+        rp.start_ADC(0)
+        rp.stop_ADC(1e-6)
+        rp.nb_measure(nb_measure)
+        rp.mode_output("IQINT")
+        for background in [False, True]:
+            if background:
+                rp.start_background_acquisition()
+            stale = 0
+            t0 = time.perf_counter()
+            for k in range(points):
+                sim.iq_values = 0.01 * (k + 1) * np.array([1.0, -1.0, 2.0, 0.0])
+                time.sleep(settle_time)
+                with rp.shared_acquisition():
+                    values = [rp.I1_INT_AVG(), rp.Q1_INT_AVG(), rp.I2_INT_AVG()]
+                if not np.allclose(values, sim.iq_values[:3], atol=1e-4):
+                    stale += 1
+            key = "background" if background else "get_data"
+            results[key] = time.perf_counter() - t0
+            rp.stop_background_acquisition()
+            if stale:
+                raise RuntimeError(
+                    "{}: {} points with the data of another point".format(key, stale)
+                )
+    finally:
+        rp.close()
+        sim.stop()
+    print(
+        "Outside sweep {} points | get_data {get_data:.2f} s | "
+        "background {background:.2f} s".format(points, **results)
+    )
+    return results
+
+
+def run_drain(stop_latency=0.07, nb_measure=200, trace_rate=2000, **simulator_kwargs):
+    """
+    Two ADC acquisitions with different DAC LUTs, against a simulator producing
+    trace_rate traces per second, whose last traces come out stop_latency
+    seconds after 'stop'. Count the traces of the second acquisition that do
+    not hold its own LUT, with drain_time and with drain_time 0 (drain on the
+    first empty reply, the previous behaviour).
+    Output:
+        dict of the number of wrong traces, by drain_time
+    """
+    from redpitaya_qcodes import Redpitaya
+    from redpitaya_simulator import RedpitayaSimulator
+
+    sim = RedpitayaSimulator(
+        noise=0, stop_latency=stop_latency, trace_rate=trace_rate, **simulator_kwargs
+    )
+    sim.start()
+    rp = Redpitaya("rp_benchmark", sim.address, visalib="@py")
+    results = {}
+    try:
+        rp.lut_delay = 0
+        rp.start_ADC(0)
+        rp.stop_ADC(200e-9)
+        rp.nb_measure(nb_measure)
+        rp.mode_output("ADC")
+        N_single_trace = rp.get_N_single_trace()
+        for drain_time in [rp.drain_time, 0]:
+            rp.drain_time = drain_time
+            wrong = 0
+            for amplitude in [0.5, 0.25]:
+                table = rp.fill_LUT("SIN", [0, amplitude, 8192 * 8e-9, 0])
+                table[:N_single_trace] = amplitude * 8192
+                rp.send_DAC_LUT(table, "CH1")
+                traces = rp.get_data()[0].reshape(-1, N_single_trace)
+                wrong = np.sum(~np.isclose(traces, amplitude, atol=1e-3).all(axis=1))
+            # let the last traces in flight come out before the next case
+            time.sleep(stop_latency)
+            rp.drain_output()
+            results[drain_time] = int(wrong)
+            if drain_time and wrong:
+                raise RuntimeError("Data of the previous acquisition was read")
+            print(
+                "drain_time {:.2f} s: {} of {} traces from the previous "
+                "acquisition".format(drain_time, wrong, nb_measure)
+            )
+    finally:
+        rp.close()
+        sim.stop()
+    return results
+
+
+if __name__ == "__main__":
+    run()
+    run_LUT()
+    run_simulator()
+    run_shared_sweep()
+    run_background()
+    run_drain()
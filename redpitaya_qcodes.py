@@ -3,17 +3,134 @@
 # written by Martina Esposito and Arpit Ranadive, 2019/2020
 #
 
+import contextlib
+import functools
+import queue
+import threading
 import time
+from collections import deque
 
 import numpy as np
+from pyvisa.constants import StatusCode
+from pyvisa.errors import VisaIOError
 
 # import qt
 # import ctypes  # only for DLL-based instrument
 from qcodes import VisaInstrument
 from qcodes import validators as vals
-from qcodes.parameters import Parameter, ParameterWithSetpoints
+from qcodes.parameters import ManualParameter, Parameter, ParameterWithSetpoints
 from qcodes.validators import Arrays
 
+# --------------------------------------------------------------- OUTPUT:DATA? decoding
+
+
+def decode_ascii_block(rep):
+    """
+    Decode an ASCII OUTPUT:DATA? reply of the form '{status,d0,d1,...}'
+    Input:
+        rep(string): reply of the server
+    Output:
+        (status, data): status is None for the fast polling marker '{}',
+        data is an int32 array (empty unless status is 0)
+    """
+    if rep[1] == "}":
+        return None, np.array([], dtype="int32")
+    if rep[1] != "0" or len(rep) <= 2:
+        return rep[1], np.array([], dtype="int32")
+    body = rep[3:-1]
+    if not body:
+        return None, np.array([], dtype="int32")
+    return 0, np.array(body.split(","), dtype="int32")
+
+
+def decode_binary_block(words):
+    """
+    Split a BIN OUTPUT:DATA? reply (big endian int32 words) in the same way
+    as decode_ascii_block: the first word is the status, the rest is data.
+    The data is a view on the received buffer, no copy is made.
+    """
+    if len(words) == 0:
+        return None, words
+    status = int(words[0])
+    if status != 0:
+        return status, words[:0]
+    if len(words) == 1:
+        return None, words[:0]
+    return 0, words[1:]
+
+
+# The two LSB of every LUT word hold the trigger outputs
+LUT_TRIGGER_BITS = {"NONE": 0, "CH1": 1, "CH2": 2, "BOTH": 3}
+
+
+def pack_LUT(table, trigger="NONE"):
+    """
+    Convert a table in DAC units to the int32 words of a LUT: the value is
+    shifted by two bits and the two LSB hold the trigger bits
+    """
+    return np.asarray(table).astype("int32") * 4 + LUT_TRIGGER_BITS[trigger]
+
+
+def trace_starts(data, last_tick=None):
+    """
+    Find the words starting a new trace in a chunk of data: the two LSB of every
+    word hold the tick of the acquisition, which changes at every trace.
+    Input:
+        data(int32 array): chunk of data
+        last_tick(int): tick of the last word of the previous chunk, None if the
+        chunk starts a new acquisition
+    Output:
+        (starts, last_tick): index of the first word of every trace started in
+        the chunk, and the tick to pass along with the next chunk
+    """
+    tick = np.bitwise_and(data, 3)
+    starts = np.flatnonzero(tick[1:] != tick[:-1]) + 1
+    if last_tick is None or tick[0] != last_tick:
+        starts = np.concatenate((np.zeros(1, dtype=starts.dtype), starts))
+    return starts, int(tick[-1])
+
+
+class RunningAverage:
+    """
+    Running mean and variance of the quadratures returned by get_data, updated
+    chunk by chunk (pairwise update of Chan et al.), in constant memory.
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.mean = None
+        self.m2 = None
+
+    def update(self, data):
+        """
+        Add a chunk of data: a tuple of arrays of the same length
+        """
+        n_chunk = len(data[0])
+        if n_chunk == 0:
+            return
+        data = np.asarray(data, dtype=float)
+        mean_chunk = data.mean(axis=1)
+        m2_chunk = ((data - mean_chunk[:, None]) ** 2).sum(axis=1)
+        if self.count == 0:
+            self.count, self.mean, self.m2 = n_chunk, mean_chunk, m2_chunk
+            return
+        count = self.count + n_chunk
+        delta = mean_chunk - self.mean
+        self.mean = self.mean + delta * n_chunk / count
+        self.m2 = self.m2 + m2_chunk + delta**2 * self.count * n_chunk / count
+        self.count = count
+
+    @property
+    def variance(self):
+        return self.m2 / self.count
+
+    @property
+    def second_moment(self):
+        """
+        Mean of the square of every quadrature
+        """
+        return self.variance + self.mean**2
+
 
 class GeneratedSetPoints(Parameter):
     """
@@ -39,8 +156,7 @@ class IQ_INT(ParameterWithSetpoints):
         self._channel = channel
 
     def get_raw(self):
-        time.sleep(0.2)
-        data = self._instrument.get_data()
+        data = self._instrument.get_shared_data(self)
         if self._channel == "I1":
             data_ret = data[0]
         elif self._channel == "Q1":
@@ -58,8 +174,7 @@ class IQ_INT_all(Parameter):
         self._channel = channel
 
     def get_raw(self):
-        # time.sleep(0.2) ### test
-        data = self._instrument.get_data()
+        data = self._instrument.get_shared_data(self)
         data_ret_I1 = np.array([data[0]])
         data_ret_Q1 = np.array([data[1]])
         data_ret_I2 = np.array([data[2]])
@@ -76,8 +191,10 @@ class IQ_INT_AVG(Parameter):
         self._channel = channel
 
     def get_raw(self):
-        time.sleep(0.2)
-        data = self._instrument.get_data()
+        if self._instrument.running_average():
+            data = self._instrument.get_shared_data(self, average=True).mean
+        else:
+            data = self._instrument.get_shared_data(self)
         if self._channel == "I1":
             data_ret = np.mean(data[0])
         elif self._channel == "Q1":
@@ -95,8 +212,10 @@ class IQ_INT_AVG_all(Parameter):
         self._channel = channel
 
     def get_raw(self):
-        time.sleep(0.2)
-        data = self._instrument.get_data()
+        if self._instrument.running_average():
+            data = self._instrument.get_shared_data(self, average=True).mean
+        else:
+            data = self._instrument.get_shared_data(self)
         data_ret_I1 = np.mean(data[0])
         data_ret_Q1 = np.mean(data[1])
         data_ret_I2 = np.mean(data[2])
@@ -110,8 +229,10 @@ class ADC_power(ParameterWithSetpoints):
         self._channel = channel
 
     def get_raw(self):
-        time.sleep(0.2)
-        data = self._instrument.get_data()
+        if self._instrument.running_average():
+            m2 = self._instrument.get_shared_data(self, average=True).second_moment
+            return np.array([m2[0] + m2[1], m2[2] + m2[3]]) / 50
+        data = self._instrument.get_shared_data(self)
         # data_ret_I1 = (np.mean(data[0]**2)-np.mean(data[0])**2)/50
         # data_ret_Q1 = (np.mean(data[1]**2)-np.mean(data[1])**2)/50
         # data_ret_I2 = (np.mean(data[2]**2)-np.mean(data[2])**2)/50
@@ -128,8 +249,7 @@ class IQ_CH1(ParameterWithSetpoints):
         self._channel = channel
 
     def get_raw(self):
-        time.sleep(0.2)
-        data = self._instrument.get_data()
+        data = self._instrument.get_shared_data(self)
         if self._channel == "I1":
             data_ret = data[0]
         elif self._channel == "Q1":
@@ -145,8 +265,7 @@ class IQ_CH2(ParameterWithSetpoints):
         self._channel = channel
 
     def get_raw(self):
-        time.sleep(0.2)
-        data = self._instrument.get_data()
+        data = self._instrument.get_shared_data(self)
         if self._channel == "I2":
             data_ret = data[0]
         elif self._channel == "Q2":
@@ -156,14 +275,13 @@ class IQ_CH2(ParameterWithSetpoints):
         return data_ret
 
 
-class ADC(Parameter):
+class ADC(ParameterWithSetpoints):
     def __init__(self, channel, *args, **kwargs):
         super().__init__(*args, **kwargs)
         self._channel = channel
 
     def get_raw(self):
-        time.sleep(0.2)
-        data = self._instrument.get_data()
+        data = self._instrument.get_shared_data(self)
         if self._channel == "CH1":
             data_ret = data[0]
         elif self._channel == "CH2":
@@ -176,6 +294,19 @@ class ADC(Parameter):
 class Redpitaya(VisaInstrument):
     """
     QCoDeS driver for the Redpitaya
+
+    Every read of a derived parameter (I1_INT_AVG, ADC_power...) takes a new
+    acquisition. The parameters read inside a shared_acquisition block share
+    one acquisition instead, e.g. at every point of a Measurement loop
+
+        for f in np.linspace(4e9, 5e9, 101):
+            source.frequency(f)
+            with rp.shared_acquisition():
+                datasaver.add_result((source.frequency, f),
+                                     (rp.I1_INT_AVG, rp.I1_INT_AVG()),
+                                     (rp.Q1_INT_AVG, rp.Q1_INT_AVG()))
+
+    In dond, IQ_INT_AVG_all gives the four averages of one acquisition.
     """
 
     # all instrument constructors should accept **kwargs and pass them on to
@@ -188,6 +319,51 @@ class Redpitaya(VisaInstrument):
         self.dummy_array_size_2 = 2
         self.dummy_array_size_4 = 4
 
+        # Result of get_data shared by the derived parameters read inside a
+        # shared_acquisition block. It is dropped at every write to the card
+        # (setting or LUT change).
+        self._acquisition = {}
+        self._shared_depth = 0
+        self.acquisition_generation = 0
+
+        # Polling of the card instead of fixed sleeps: the interval between two
+        # empty OUTPUT:DATA? replies grows from poll_interval_min to
+        # poll_interval_max. Every wait is logged as (label, duration (s), polls).
+        self.poll_interval_min = 1e-3
+        self.poll_interval_max = 50e-3
+        self.poll_timeout = 10.0
+        self.wait_log = deque(maxlen=1000)
+        # After stop, the data still in flight can come after an empty reply:
+        # the output is drained until no data has come for drain_time seconds.
+        self.drain_time = 0.1
+        # The server does not acknowledge the LUT uploads, a short delay is kept
+        # between two tables.
+        self.lut_delay = 0.1
+        # Table held by every LUT of the card ('DAC:CH1', 'I:CH2'...): a table
+        # identical to the one already loaded is not sent again. With
+        # lut_prefix_upload, only the samples up to the last changed one are sent
+        # (only for firmware keeping the end of a LUT on a shorter upload).
+        self._lut_state = {}
+        self.lut_prefix_upload = False
+        self.lut_stats = {"sent": 0, "skipped": 0}
+
+        # Optional background acquisition (start_background_acquisition): a
+        # worker thread acquires a point when it is asked for (_arm), hands the
+        # data over and stops and drains the card while the point is decoded.
+        # The raw data is tagged with (_settings_generation, _point): the
+        # generation is incremented at every write that does not come from the
+        # worker and _point at every request, so that data taken with old
+        # settings or for an older point is dropped. _io_lock serializes the
+        # exchanges with the card between the two threads.
+        self._io_lock = threading.RLock()
+        self._worker = None
+        self._worker_queue = None
+        self._arm = threading.Event()
+        self._armed_tag = None
+        self._cancel_acquisition = threading.Event()
+        self._settings_generation = 0
+        self._point = 0
+
         self.add_parameter(
             name="freq_filter",
             # frequency of the low pass filter
@@ -291,6 +467,37 @@ class Redpitaya(VisaInstrument):
             get_parser=str,
         )
 
+        # Format used by get_data: 'BIN' is decoded with np.frombuffer,
+        # 'ASCII' is kept for old firmware.
+        self.add_parameter(
+            name="acquisition_format",
+            label="Acquisition format",
+            vals=vals.Enum("ASCII", "BIN"),
+            initial_value="BIN",
+            parameter_class=ManualParameter,
+        )
+
+        # Format of the LUT uploads: 'ASCII' sends a list of integers, as every
+        # firmware expects. 'BIN' sends an IEEE 488.2 block of big endian int32,
+        # opt-in for a firmware parsing binary blocks after DAC:CHx and I:CHx.
+        self.add_parameter(
+            name="lut_format",
+            label="LUT upload format",
+            vals=vals.Enum("ASCII", "BIN"),
+            initial_value="ASCII",
+            parameter_class=ManualParameter,
+        )
+
+        # The averaged parameters (I1_INT_AVG..., IQ_INT_AVG_all, ADC_power) can
+        # average the traces on the fly instead of keeping them all in memory.
+        self.add_parameter(
+            name="running_average",
+            label="Running average of the traces",
+            vals=vals.Bool(),
+            initial_value=False,
+            parameter_class=ManualParameter,
+        )
+
         self.add_parameter(
             "nb_measure",
             set_cmd="{}",
@@ -564,17 +771,151 @@ class Redpitaya(VisaInstrument):
     def get_samples_from_sec(self, sec):
         samples = sec / 8.0e-9
         samples = int(round(samples))
-        time.sleep(0.1)
         return samples
 
     def get_sec_from_samples(self, samples):
         sec = float(samples) * 8.0e-9
-        time.sleep(0.1)
         return sec
 
+    # -------------------------------------------------------------Shared acquisition
+    def write_raw(self, cmd):
+        if threading.current_thread() is not self._worker:
+            self._settings_generation += 1
+            self._drop_acquisition()
+        with self._io_lock:
+            super().write_raw(cmd)
+
+    def ask_raw(self, cmd):
+        with self._io_lock:
+            return super().ask_raw(cmd)
+
+    @contextlib.contextmanager
+    def shared_acquisition(self):
+        """
+        The derived parameters read inside the block share one acquisition,
+        taken by the first of them. It is meant to span one setpoint: the block
+        is entered once the outside instruments are set. Outside of the block,
+        every read takes a new acquisition. With start_background_acquisition,
+        entering the block starts the acquisition of the point.
+        """
+        if self._shared_depth == 0:
+            self.invalidate_acquisition()
+        self._shared_depth += 1
+        try:
+            yield self
+        finally:
+            self._shared_depth -= 1
+            if self._shared_depth == 0:
+                self._drop_acquisition()
+
+    def invalidate_acquisition(self):
+        """
+        Drop the acquisition shared inside a shared_acquisition block: the next
+        derived parameter does a new one. With start_background_acquisition, it
+        also starts the acquisition of the new point.
+        """
+        self._drop_acquisition()
+        if self._worker is not None:
+            self._arm_worker()
+
+    def _drop_acquisition(self):
+        # also called at every write to the card
+        self._acquisition = {}
+
+    def get_shared_data(self, parameter, average=False):
+        """
+        Return the output of get_data to a derived parameter (I1_INT, ADC_power...)
+        Inside a shared_acquisition block, the first parameter takes the
+        acquisition and the others read it. Outside, a new one is taken.
+        Input:
+            parameter: the derived parameter asking for the data
+            average(bool): ask for the running average (get_average) instead
+        Output:
+            the tuple returned by get_data, or the RunningAverage
+        """
+        key = "average" if average else "data"
+        if key in self._acquisition and self._shared_depth:
+            return self._acquisition[key]
+        if average:
+            result = self.get_average()
+        else:
+            result = self.get_data()
+        self.acquisition_generation += 1
+        if self._shared_depth:
+            self._acquisition[key] = result
+        return result
+
+    # -------------------------------------------------------------Readiness of the card
+    def wait_for(self, label, condition, timeout=None):
+        """
+        Poll condition() with an exponential backoff until it returns something
+        that is not None or False
+        Input:
+            label(string): name of the wait in wait_log
+            condition: function polling the card
+            timeout(float): in seconds, default is poll_timeout
+        Output:
+            the last value returned by condition
+        """
+        if timeout is None:
+            timeout = self.poll_timeout
+        interval = self.poll_interval_min
+        polls = 0
+        t0 = time.perf_counter()
+        while True:
+            result = condition()
+            polls += 1
+            if result is not None and result is not False:
+                break
+            if time.perf_counter() - t0 > timeout:
+                self.wait_log.append((label, time.perf_counter() - t0, polls))
+                raise TimeoutError(
+                    "Redpitaya not ready after %s s (%s)" % (timeout, label)
+                )
+            time.sleep(interval)
+            interval = min(2 * interval, self.poll_interval_max)
+        self.wait_log.append((label, time.perf_counter() - t0, polls))
+        return result
+
+    def drain_output(self, data_format=None):
+        """
+        Read OUTPUT:DATA? until no data has come for drain_time seconds
+        (poll_timeout at most): data still in flight after status('stop') would
+        otherwise be read by the next acquisition
+        Output:
+            number of words discarded
+        """
+        discarded = 0
+        polls = 0
+        interval = self.poll_interval_min
+        t0 = last_data = time.perf_counter()
+        while True:
+            status, rep = self.read_data_block(data_format)
+            polls += 1
+            now = time.perf_counter()
+            if now - t0 > self.poll_timeout:
+                self.wait_log.append(("drain", now - t0, polls))
+                raise TimeoutError(
+                    "Redpitaya still sending data after %s s (drain)"
+                    % self.poll_timeout
+                )
+            if status == 0:
+                discarded += len(rep)
+                last_data = now
+                interval = self.poll_interval_min
+                continue
+            if now - last_data >= self.drain_time:
+                break
+            time.sleep(min(interval, self.drain_time - (now - last_data)))
+            interval = min(2 * interval, self.poll_interval_max)
+        self.wait_log.append(("drain", now - t0, polls))
+        return discarded
+
     # -------------------------------------------------------------Setting parameters
     def set_mode(self, mode):
-        time.sleep(0.2)
+        # status('stop') also cancels the background acquisition
+        if mode == "stop" and threading.current_thread() is not self._worker:
+            self.stop_background_acquisition()
         return mode
 
     # ------------------------------------------------------------Reset data output
@@ -592,7 +933,13 @@ class Redpitaya(VisaInstrument):
                 freq (Hz), Amplitude (from 0 to 1), pulse_duration (s), delay (s)
         Output:
                 the table (int)
+        The tables are memoized on (function, parameters): a copy is returned.
         """
+        return self._compute_LUT(function, tuple(parameters)).copy()
+
+    @staticmethod
+    @functools.lru_cache(maxsize=256)
+    def _compute_LUT(function, parameters):
         if function == "SIN":
             freq, Amplitude, pulse_duration, delay = parameters
             if (
@@ -712,25 +1059,12 @@ class Redpitaya(VisaInstrument):
         Output:
             None
         """
-        self.log.info(__name__ + " Send the DAC LUT \n")
-        if trigger == "NONE":
-            table_bit = table.astype(int) * 4
-        elif trigger == "CH1":
-            table_bit = table.astype(int) * 4 + 1
-        elif trigger == "CH2":
-            table_bit = table.astype(int) * 4 + 2
-        elif trigger == "BOTH":
-            table_bit = table.astype(int) * 4 + 3
-        else:
+        if trigger not in LUT_TRIGGER_BITS:
             raise ValueError("Wrong trigger value")
+        table_bit = pack_LUT(table, trigger)
 
-        table_bit = table_bit.astype(str)
-        separator = ", "
-        table_bit = separator.join(table_bit)
         if channel in ["CH1", "CH2"]:
-            time.sleep(0.1)
-            # print(table_bit)
-            self.write("DAC:" + channel + " " + table_bit)
+            self.upload_LUT("DAC:" + channel, table_bit)
         else:
             raise ValueError("Wrong channel value")
 
@@ -743,17 +1077,54 @@ class Redpitaya(VisaInstrument):
             - trigger(string): send a trigger in channels or not
 
         """
-        self.log.info(__name__ + " Send the IQ LUT \n")
-        table_bit = table.astype(int) * 4
-        table_bit = table_bit.astype(str)
-        separator = ", "
-        table_bit = separator.join(table_bit)
+        table_bit = pack_LUT(table)
         if quadrature in ["I", "Q"] and channel in ["CH1", "CH2"]:
-            time.sleep(0.1)
-            self.write(quadrature + ":" + channel + " " + table_bit)
+            self.upload_LUT(quadrature + ":" + channel, table_bit)
         else:
             raise ValueError("Wrong quadrature or channel")
 
+    def upload_LUT(self, target, table_bit):
+        """
+        Send a table to a LUT of the card, unless the LUT already holds it
+        Input:
+            - target(string): SCPI header of the LUT, 'DAC:CH1', 'I:CH2'...
+            - table_bit(int): table with the trigger bits
+        Output:
+            True if the table was sent
+        """
+        current = self._lut_state.get(target)
+        if current is not None and np.array_equal(current, table_bit):
+            self.log.info(__name__ + " " + target + " LUT unchanged \n")
+            self.lut_stats["skipped"] += 1
+            return False
+
+        self.log.info(__name__ + " Send the " + target + " LUT \n")
+        values = table_bit
+        if self.lut_prefix_upload and current is not None:
+            if len(current) == len(table_bit):
+                values = table_bit[: np.flatnonzero(current != table_bit)[-1] + 1]
+        time.sleep(self.lut_delay)
+        if self.lut_format() == "BIN":
+            # IEEE 488.2 definite length block of big endian int32
+            self._settings_generation += 1
+            self._drop_acquisition()
+            with self._io_lock:
+                self.visa_handle.write_binary_values(
+                    target + " ", values, datatype="i", is_big_endian=True
+                )
+        else:
+            self.write(target + " " + ", ".join(values.astype(str)))
+        self._lut_state[target] = np.array(table_bit, dtype="int32")
+        self.lut_stats["sent"] += 1
+        return True
+
+    def forget_LUT(self):
+        """
+        Forget the tables held by the card (e.g. after a reboot): the next
+        uploads are all sent
+        """
+        self._lut_state = {}
+
     def reset_LUT(self, time=8192 * 8e-9):
         """
         Reset all the LUT
@@ -776,73 +1147,131 @@ class Redpitaya(VisaInstrument):
 
     # --------------------------------------------------------------------------Output Data----
 
-    def get_data(self):
-        time.sleep(0.2)
-        t = 0
-        nb_measure = self.nb_measure()
-        mode = self.mode_output()
-        N_single_trace = int(round(self.stop_ADC() / 8e-9)) - int(
-            round(self.start_ADC() / 8e-9)
-        )
-        # print(1,t)
-        # print(nb_measure, 'traces.', 'Mode:',mode)
-        self.format_output("ASCII")
-        self.status("start")
-        time.sleep(0.2)  # Timer to change if no time to start ; changed from 2
-        signal = np.array([], dtype="int32")
-        t0 = time.time()
+    def read_data_block(self, data_format=None):
+        """
+        Ask for one chunk of output data
+        Input:
+            data_format(string): 'BIN' or 'ASCII', default is acquisition_format
+        Output:
+            (status, data) as returned by decode_binary_block/decode_ascii_block
+        """
+        if data_format is None:
+            data_format = self.acquisition_format()
+        if data_format == "BIN":
+            with self._io_lock:
+                words = self.visa_handle.query_binary_values(
+                    "OUTPUT:DATA?",
+                    datatype="i",
+                    is_big_endian=True,
+                    container=np.array,
+                )
+            return decode_binary_block(words)
+        return decode_ascii_block(self.ask("OUTPUT:DATA?"))
 
-        while t < nb_measure:
-            try:
-                # time.sleep(0.0) ***testing
-                rep = self.ask("OUTPUT:DATA?")
-                # print(rep)
-                # rep = self.data_output_raw()
-                if rep[1] == "}":
-                    print("Warning: fast polling")
-                elif rep[1] != "0" or len(rep) <= 2:
-                    print("Memory problem %s" % rep[1])
-                    # print(2,t)
-                    # time.sleep(0.2)
+    def words_per_trace(self, mode, N_single_trace):
+        """
+        Number of int32 words sent by the card for a single trace
+        """
+        if mode in ["ADC", "IQCH1", "IQCH2"]:
+            return 2 * N_single_trace
+        return 4
+
+    def stream_raw(
+        self, nb_measure=None, data_format=None, trace_size=None, on_complete=None
+    ):
+        """
+        Acquire nb_measure traces and yield the raw int32 words chunk by chunk, as
+        they are received. Only complete traces are yielded: the trace in
+        progress is kept until its end is known, and dropped on a memory problem.
+        The card is stopped when the generator is exhausted or closed.
+        Input:
+            nb_measure(int): number of traces, default is nb_measure()
+            data_format(string): 'BIN' or 'ASCII', default is acquisition_format()
+            trace_size(int): expected number of words per trace, to stop as soon as
+            the last trace is complete instead of waiting for the next one
+            on_complete: called once the last trace has been yielded, before the
+            card is stopped and drained
+        Raises TimeoutError when no data has come for poll_timeout seconds.
+        """
+        if nb_measure is None:
+            nb_measure = self.nb_measure()
+        if data_format is None:
+            data_format = self.acquisition_format()
+        self.format_output(data_format)
+        self.status("start")
+        t = 0
+        pending = np.array([], dtype="int32")  # trace in progress
+        last_tick = None
+        done = False
+        # no data yet ('{}' or a VISA timeout): the polling interval grows up to
+        # poll_interval_max, until poll_timeout without any data
+        interval = self.poll_interval_min
+        waited = 0.0
+        polls = 0
+        last_data = time.perf_counter()
+
+        try:
+            while not done:
+                if self._cancel_acquisition.is_set():
+                    return
+                chunk = None
+                try:
+                    status, rep = self.read_data_block(data_format)
+                except VisaIOError as error:
+                    if error.error_code != StatusCode.error_timeout:
+                        raise
+                    status = None
+                polls += 1
+                if status != 0 and time.perf_counter() - last_data > self.poll_timeout:
+                    raise TimeoutError(
+                        "No data from the Redpitaya for %s s" % self.poll_timeout
+                    )
+                if status is None:
+                    time.sleep(interval)
+                    waited += interval
+                    interval = min(2 * interval, self.poll_interval_max)
+                elif status != 0:
+                    print("Memory problem %s" % status)
                     self.status("stop")
-                    # print(3,t)
-                    # time.sleep(0.2)
                     self.status("start")
+                    pending = pending[:0]
+                    last_tick = None
                 else:
-                    # signal.append( rep[3:-1] + ',')
-                    rep = eval(
-                        "[" + rep[3:-1] + "]"
-                    )  ### it creates an array of the data removing just the first one
-                    signal = np.concatenate((signal, rep))
-                    tick = np.bitwise_and(
-                        rep, 3
-                    )  # extraction du debut de l'aquisition: LSB = 3
-                    t += len(np.where(tick[1:] - tick[:-1])[0]) + 1  # idex of the tick
-                    # print(t)
-                    t1 = time.time()
-                    # print (t1 - t0, t)
-                    t0 = t1
-            except:
-                t = t
-        time.sleep(0.1)
-        self.status("stop")
-        # time.sleep(1)
-        time.sleep(0.1)
-        trash = self.ask("OUTPUT:DATA?")
-        # time.sleep(1)
-        # print(mode)
-        if t > nb_measure:
-            # print(t, nb_measure)
-            # print(tick)
-            jump_tick = np.where(tick[1:] - tick[:-1])[0]
-            # print(jump_tick)
-            if len(jump_tick) == 1:
-                len_data_block = jump_tick[0] + 1
-            else:
-                len_data_block = jump_tick[1] - jump_tick[0]
-
-            signal = signal[: nb_measure * len_data_block]
+                    interval = self.poll_interval_min
+                    last_data = time.perf_counter()
+                    starts, chunk_tick = trace_starts(rep, last_tick)
+                    if len(pending):
+                        rep = np.concatenate((pending, rep))
+                        starts = np.concatenate(([0], starts + len(pending)))
+                    # the last start is the trace in progress
+                    missing = nb_measure - t
+                    if len(starts) > missing:
+                        chunk, pending = rep[: starts[missing]], rep[:0]
+                        t, done = nb_measure, True
+                    elif len(starts) == missing and len(rep) - starts[-1] == trace_size:
+                        # the last trace is complete, no need for the next one
+                        chunk, pending = rep, rep[:0]
+                        t, done = nb_measure, True
+                    else:
+                        chunk, pending = rep[: starts[-1]], rep[starts[-1] :]
+                        t += len(starts) - 1
+                    last_tick = chunk_tick
+                if chunk is not None and len(chunk):
+                    yield chunk
+            if on_complete is not None:
+                on_complete()
+        finally:
+            self.wait_log.append(("acquisition", waited, polls))
+            self.status("stop")
+            self.drain_output(data_format)
 
+    def decode_signal(self, signal, mode, N_single_trace):
+        """
+        Convert the raw words of the card in volts
+        Output:
+            (data_1, data_2) in the ADC, IQCH1 and IQCH2 modes,
+            (ICH1, QCH1, ICH2, QCH2) in the IQINT and IQLP1 modes
+        """
         if mode == "ADC" or mode == "IQCH1" or mode == "IQCH2":
             # print(12)
             data_1 = signal[::2] / (4 * 8192.0)
@@ -863,29 +1292,213 @@ class Redpitaya(VisaInstrument):
             )  # (self.length_time()/self.nb_measure())
             return ICH1, QCH1, ICH2, QCH2
 
+    def get_N_single_trace(self):
+        return int(round(self.stop_ADC() / 8e-9)) - int(round(self.start_ADC() / 8e-9))
+
+    def acquire_raw(self, ready=None):
+        """
+        Acquire nb_measure traces
+        Input:
+            ready: called with the output as soon as the last trace has
+            arrived, before the card is stopped and drained
+        Output:
+            (signal, mode, N_single_trace): raw words of the traces and what is
+            needed to decode them with decode_signal. signal is None if the
+            acquisition was cancelled.
+        """
+        nb_measure = self.nb_measure()
+        mode = self.mode_output()
+        N_single_trace = self.get_N_single_trace()
+        trace_size = self.words_per_trace(mode, N_single_trace)
+        # The output buffer is allocated once and the chunks are copied in place
+        signal = np.empty(nb_measure * trace_size, dtype="int32")
+        filled = 0
+
+        def complete():
+            if ready is not None:
+                ready((signal[:filled], mode, N_single_trace))
+
+        for rep in self.stream_raw(
+            nb_measure, trace_size=trace_size, on_complete=complete
+        ):
+            if filled + len(rep) > len(signal):
+                # more words per trace than expected from the mode
+                new_size = max(2 * len(signal), filled + len(rep))
+                signal = np.concatenate(
+                    (signal[:filled], np.empty(new_size - filled, "int32"))
+                )
+            signal[filled : filled + len(rep)] = rep
+            filled += len(rep)
+        if self._cancel_acquisition.is_set():
+            return None, mode, N_single_trace
+        return signal[:filled], mode, N_single_trace
+
+    def get_data(self):
+        if self._worker is not None:
+            signal, mode, N_single_trace = self.next_background_acquisition()
+        else:
+            signal, mode, N_single_trace = self.acquire_raw()
+        return self.decode_signal(signal, mode, N_single_trace)
+
+    # -------------------------------------------------------------Background acquisition
+    def start_background_acquisition(self, queue_size=2):
+        """
+        Start a worker thread taking the acquisitions. A point is acquired when
+        a shared_acquisition block is entered after setting it, or else when
+        get_data asks for it, never before: data taken before an outside setpoint
+        change cannot be returned. The worker hands the data over as soon as the
+        last trace has arrived, then stops and drains the card while get_data
+        decodes the point and the sweep moves to the next setpoint. Any setting
+        written to the card drops the data acquired before.
+        Input:
+            queue_size(int): number of acquisitions kept until get_data reads them
+        """
+        if self._worker is not None:
+            return
+        self._cancel_acquisition.clear()
+        self._arm.clear()
+        self._armed_tag = None
+        self._worker_queue = queue.Queue(maxsize=queue_size)
+        self._worker = threading.Thread(
+            target=self._background_loop, name=self.name + "_acquisition", daemon=True
+        )
+        self._worker.start()
+
+    def stop_background_acquisition(self):
+        """
+        Cancel the acquisition in progress and stop the worker thread
+        """
+        if self._worker is None:
+            return
+        self._cancel_acquisition.set()
+        self._worker.join()
+        self._worker = None
+        self._worker_queue = None
+        self._cancel_acquisition.clear()
+
+    def _acquisition_tag(self):
+        return self._settings_generation, self._point
+
+    def _arm_worker(self):
+        # every request is a new point: the data of the previous ones is dropped
+        self._point += 1
+        self._armed_tag = self._acquisition_tag()
+        self._arm.set()
+
+    def _background_loop(self):
+        while not self._cancel_acquisition.is_set():
+            if not self._arm.wait(timeout=0.1):
+                continue
+            self._arm.clear()
+            tag = self._acquisition_tag()
+            try:
+                self.acquire_raw(lambda result: self._hand_over(tag, result))
+            except Exception as exception:
+                self._hand_over(tag, exception)
+                return
+
+    def _hand_over(self, tag, result):
+        # the queue is bounded: the oldest point is dropped, it is stale anyway
+        while True:
+            try:
+                self._worker_queue.put_nowait((tag, result))
+                return
+            except queue.Full:
+                try:
+                    self._worker_queue.get_nowait()
+                except queue.Empty:
+                    pass
+
+    def close(self):
+        self.stop_background_acquisition()
+        super().close()
+
+    def next_background_acquisition(self):
+        """
+        Wait for the acquisition of the current point taken by the worker with
+        the current settings. It is asked for here if no shared_acquisition
+        block or invalidate_acquisition did since the last one was read.
+        Output:
+            (signal, mode, N_single_trace) as returned by acquire_raw
+        """
+        worker_queue = self._worker_queue
+        if self._armed_tag != self._acquisition_tag():
+            self._arm_worker()
+        while True:
+            try:
+                tag, result = worker_queue.get(timeout=0.1)
+            except queue.Empty:
+                if not self._worker.is_alive():
+                    raise RuntimeError("Background acquisition stopped")
+                continue
+            if isinstance(result, Exception):
+                self.stop_background_acquisition()
+                raise result
+            if tag == self._acquisition_tag():
+                # the next get_data asks for a new point
+                self._armed_tag = None
+                return result
+            if self._armed_tag != self._acquisition_tag():
+                # a setting was written while the point was acquired
+                self._arm_worker()
+
+    def iter_data(self, nb_measure=None):
+        """
+        Acquire nb_measure traces and yield the decoded data chunk by chunk: every
+        chunk is a tuple as returned by get_data, holding a part of the traces.
+        Only the current chunk is kept in memory.
+        """
+        mode = self.mode_output()
+        N_single_trace = self.get_N_single_trace()
+        record_size = 2 if mode in ["ADC", "IQCH1", "IQCH2"] else 4
+        carry = np.array([], dtype="int32")
+        for rep in self.stream_raw(
+            nb_measure, trace_size=self.words_per_trace(mode, N_single_trace)
+        ):
+            if len(carry):
+                rep = np.concatenate((carry, rep))
+            n_words = len(rep) - len(rep) % record_size
+            carry = rep[n_words:]
+            if n_words:
+                yield self.decode_signal(rep[:n_words], mode, N_single_trace)
+
+    def get_average(self, nb_measure=None):
+        """
+        Acquire nb_measure traces and average them on the fly, in constant memory
+        Output:
+            RunningAverage of the quadratures returned by get_data
+        """
+        average = RunningAverage()
+        for data in self.iter_data(nb_measure):
+            average.update(data)
+        return average
+
     def get_single_pulse(self):
         # self.mode_output(mode)
-        self.format_output("ASCII")
+        data_format = self.acquisition_format()
+        self.format_output(data_format)
         self.status("start")
-        signal = np.array([], dtype="int32")
-
-        # Some sleep needed otherwise the data acquisition is too fast.
-        time.sleep(0.8)
-        rep = self.ask("OUTPUT:DATA?")
-        if rep[1] != "0" or len(rep) <= 2:
-            print("Memory problem %s" % rep[1])
-            # print(2,t)
-            self.status("stop")
-            # print(3,t)
-            self.status("start")
-        else:
-            # signal.append( rep[3:-1] + ',')
-            rep = eval("[" + rep[3:-1] + "]")
-            signal = np.concatenate((signal, rep))
+
+        # Wait for the first chunk containing a complete trace (two ticks)
+        def complete_trace():
+            status, rep = self.read_data_block(data_format)
+            if status is None:
+                return None
+            if status != 0:
+                print("Memory problem %s" % status)
+                self.status("stop")
+                self.status("start")
+                return None
             tick = np.bitwise_and(
                 rep, 3
             )  # extraction du debut de l'aquisition: LSB = 3
+            if np.count_nonzero(tick[1:] != tick[:-1]) < 2:
+                return None
+            return rep, tick
+
+        signal, tick = self.wait_for("get_single_pulse", complete_trace)
         self.status("stop")
+        self.drain_output(data_format)
         jump_tick = np.where(tick[1:] - tick[:-1])[0]
         len_data_block = jump_tick[1] - jump_tick[0]
         signal = signal[:len_data_block]
@@ -905,45 +1518,13 @@ class Redpitaya(VisaInstrument):
             return ICH1, QCH1, ICH2, QCH2
 
     def get_data_binary(self, mode, nb_measure):
-        t = 0
-        self.set_mode_output(mode)
-        self.set_format_output("BIN")
-        self.start()
-        signal = np.array([], dtype="int32")
-        t0 = time.time()
-        while t < nb_measure:
-            try:
-                rep = self.data_output_bin()
-                if rep[0] != 0:
-                    print("Memory problem %s" % rep[0])
-                    self.stop()
-                    self.start()
-                else:
-                    signal = np.concatenate((signal, rep[1:]))
-                    if mode == ("ADC" or "IQCH1" or "IQCH2"):
-                        t = len(signal) / 2
-                    else:
-                        t = len(signal) / 4
-                t1 = time.time()
-                print(t1 - t0, t)
-                t0 = t1
-            except:
-                t = t
-
-        self.stop()
-        trash = self.data_output()
-
-        if mode == ("ADC" or "IQCH1" or "IQCH2"):
-            data_1 = signal[::2][:nb_measure] / (4 * 8192.0)
-            data_2 = signal[1::2][:nb_measure] / (4 * 8192.0)
-            return data_1, data_2
-
-        else:
-            ICH1 = signal[::4][:nb_measure] / (4 * 8192.0)
-            QCH1 = signal[1::4][:nb_measure] / (4 * 8192.0)
-            ICH2 = signal[2::4][:nb_measure] / (4 * 8192.0)
-            QCH2 = signal[3::4][:nb_measure] / (4 * 8192.0)
-            return ICH1, QCH1, ICH2, QCH2
+        """
+        Acquire nb_measure traces in the given mode with the BIN output format
+        """
+        self.mode_output(mode)
+        self.nb_measure(nb_measure)
+        self.acquisition_format("BIN")
+        return self.get_data()
 
     def int_0(self):
         return 0
@@ -0,0 +1,315 @@
+# -*- coding: utf-8 -*-
+# Local stand-in for the SCPI IQ server of the Redpitaya card.
+# It implements the subset of commands used by redpitaya_qcodes.py, so that the
+# driver can be tested and benchmarked without the card:
+#
+#     sim = RedpitayaSimulator(chunk_size=1024)
+#     sim.start()
+#     rp = Redpitaya("rp", sim.address, visalib="@py")
+#
+
+import re
+import socket
+import threading
+import time
+
+import numpy as np
+from pyvisa.util import to_ieee_block
+
+# settings that are simply stored and sent back
+SETTINGS = {
+    "FILTER:FREQ": "10000000",
+    "FILTER:DEC": "500",
+    "ADC:STARTPOS": "0",
+    "ADC:STOPPOS": "125",
+    "DAC:STOPPOS": "8192",
+    "PERIOD": "12500",
+    "OUTPUT:SELECT": "IQINT",
+    "OUTPUT:FORMAT": "ASCII",
+}
+
+LUTS = ["DAC:CH1", "DAC:CH2", "I:CH1", "Q:CH1", "I:CH2", "Q:CH2"]
+
+
+class RedpitayaSimulator:
+    """
+    TCP server answering like the Redpitaya SCPI IQ server
+    Input:
+        host(string), port(int): port 0 takes a free port, see address
+        chunk_size(int): maximum number of data words in an OUTPUT:DATA? reply
+        trace_rate(float): traces produced per second after 'start',
+        None to produce them as fast as they are asked
+        memory_problem_every(int): every n-th OUTPUT:DATA? reply during an
+        acquisition is a memory problem '{1}', 0 for never
+        latency(float): delay before every reply, in seconds
+        stop_latency(float): the traces still in flight at 'stop' come out
+        stop_latency seconds later, the replies are empty until then; 0 drops them
+        in_flight_traces(int): number of traces in flight at 'stop'
+        noise(float): standard deviation of the noise added to the data, in volts
+        seed(int): seed of the noise
+    The values of the IQINT and IQLP1 quadratures (I1, Q1, I2, Q2 in volts) are
+    held in iq_values: a benchmark changes them to stand for an outside
+    instrument swept between two points.
+    """
+
+    def __init__(
+        self,
+        host="127.0.0.1",
+        port=0,
+        chunk_size=4096,
+        trace_rate=None,
+        memory_problem_every=0,
+        latency=0.0,
+        stop_latency=0.0,
+        in_flight_traces=4,
+        noise=1e-3,
+        seed=0,
+    ):
+        self.host = host
+        self.port = port
+        self.chunk_size = chunk_size
+        self.trace_rate = trace_rate
+        self.memory_problem_every = memory_problem_every
+        self.latency = latency
+        self.stop_latency = stop_latency
+        self.in_flight_traces = in_flight_traces
+        self.noise = noise
+        self.rng = np.random.default_rng(seed)
+
+        self.iq_values = np.array([0.1, -0.05, 0.02, 0.0])
+        self.settings = dict(SETTINGS)
+        self.luts = {lut: np.zeros(8192, dtype="int32") for lut in LUTS}
+        self.commands = {}  # number of commands received, by header
+        self.running = False
+        self.data_replies = 0
+        self._pending = np.array([], dtype="int32")
+        self._in_flight = np.array([], dtype="int32")
+        self._release_time = 0.0
+        self._traces = 0
+        self._t_start = 0.0
+
+        self._socket = None
+        self._thread = None
+
+    # ------------------------------------------------------------------ Server
+    @property
+    def address(self):
+        return "TCPIP::{}::{}::SOCKET".format(self.host, self.port)
+
+    def start(self):
+        self._socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self._socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self._socket.bind((self.host, self.port))
+        self.port = self._socket.getsockname()[1]
+        self._socket.listen(1)
+        self._thread = threading.Thread(target=self._serve, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        if self._socket is not None:
+            self._socket.close()
+            self._socket = None
+
+    def _serve(self):
+        while self._socket is not None:
+            try:
+                connection, _ = self._socket.accept()
+            except OSError:
+                return
+            connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            threading.Thread(
+                target=self._handle, args=(connection,), daemon=True
+            ).start()
+
+    def _handle(self, connection):
+        buffer = b""
+        with connection:
+            while True:
+                message = self._split_message(buffer)
+                if message is None:
+                    try:
+                        data = connection.recv(1 << 16)
+                    except OSError:
+                        return
+                    if not data:
+                        return
+                    buffer += data
+                    continue
+                cmd, block, buffer = message
+                reply = self.command(cmd, block)
+                if reply is not None:
+                    if self.latency:
+                        time.sleep(self.latency)
+                    connection.sendall(reply + b"\r\n")
+
+    @staticmethod
+    def _split_message(buffer):
+        """
+        Cut the first message out of the received bytes
+        Output:
+            (command, binary block or None, rest of the buffer), or None if the
+            message is not complete
+        """
+        newline = buffer.find(b"\n")
+        header = re.match(rb"\s*[^\s#]+ #(\d)", buffer)
+        if header is not None and (newline == -1 or header.end() <= newline):
+            n_digits = int(header.group(1))
+            start = header.end() + n_digits
+            if len(buffer) < start:
+                return None
+            end = start + int(buffer[header.end() : start])
+            if len(buffer) < end:
+                return None
+            rest = buffer[end:]
+            if rest.startswith(b"\r\n"):
+                rest = rest[2:]
+            elif rest.startswith(b"\n"):
+                rest = rest[1:]
+            cmd = buffer[: header.start(1) - 2].decode().strip()
+            return cmd, buffer[start:end], rest
+        if newline == -1:
+            return None
+        return buffer[:newline].decode().strip(), None, buffer[newline + 1 :]
+
+    # ---------------------------------------------------------------- Commands
+    def command(self, cmd, block=None):
+        """
+        Execute a SCPI command
+        Output:
+            the reply (bytes) for a query, None otherwise
+        """
+        if not cmd:
+            return None
+        header, _, argument = cmd.partition(" ")
+        header = header.upper()
+        self.commands[header] = self.commands.get(header, 0) + 1
+
+        if header == "*IDN?":
+            return b"Redpitaya,simulator,0,0"
+        if header == "OUTPUT:DATA?":
+            return self._data_reply()
+        if header == "OUTPUT:DATASIZE?":
+            return str(len(self._pending)).encode()
+        if header.endswith("?") and header[:-1] in self.settings:
+            return self.settings[header[:-1]].encode()
+        if header in self.settings:
+            self.settings[header] = argument.strip()
+        elif header in LUTS:
+            self._load_lut(header, argument, block)
+        elif header == "START":
+            self._start()
+        elif header == "STOP":
+            if self.running and self.stop_latency:
+                self._in_flight = self._traces_words(self.in_flight_traces)
+                self._release_time = time.perf_counter() + self.stop_latency
+            self.running = False
+            self._pending = np.array([], dtype="int32")
+        # the driver also writes the values of its local parameters (nb_measure,
+        # pulse_zero...) as bare numbers: they are ignored like on the card
+        return None
+
+    def _load_lut(self, header, argument, block):
+        if block is not None:
+            table = np.frombuffer(block, dtype=">i4")
+        else:
+            table = np.array(argument.split(","), dtype="int32")
+        lut = self.luts[header]
+        lut[: len(table)] = table[:8192]
+
+    def _start(self):
+        self.running = True
+        self._pending = np.array([], dtype="int32")
+        self._traces = 0
+        self._t_start = time.perf_counter()
+
+    # -------------------------------------------------------------------- Data
+    def _samples(self, setting):
+        # the driver sends some positions as '125.000000000000'
+        return int(round(float(self.settings[setting])))
+
+    def trace_size(self):
+        """
+        Number of words of a trace in the current mode
+        """
+        n_samples = self._samples("ADC:STOPPOS") - self._samples("ADC:STARTPOS")
+        if self.settings["OUTPUT:SELECT"] in ["ADC", "IQCH1", "IQCH2"]:
+            return 2 * n_samples
+        return 4
+
+    def _traces_words(self, n_traces):
+        """
+        Data of n_traces traces: the value shifted by two bits, and the tick of
+        the trace in the two LSB
+        """
+        mode = self.settings["OUTPUT:SELECT"]
+        start = self._samples("ADC:STARTPOS")
+        stop = self._samples("ADC:STOPPOS")
+        n_samples = stop - start
+        if mode in ["ADC", "IQCH1", "IQCH2"]:
+            # the DAC LUTs looped back on the ADC
+            trace = np.empty(2 * n_samples)
+            trace[::2] = self.luts["DAC:CH1"][start:stop] // 4 / 8192.0
+            trace[1::2] = self.luts["DAC:CH2"][start:stop] // 4 / 8192.0
+            scale = 8192.0
+        else:
+            trace = np.array(self.iq_values, dtype=float)
+            scale = 8192.0 * n_samples
+        volts = np.tile(trace, n_traces)
+        volts += self.noise * self.rng.standard_normal(len(volts))
+        values = np.round(volts * scale).astype("int32")
+        tick = np.repeat((self._traces + np.arange(n_traces)) % 4, len(trace))
+        self._traces += n_traces
+        return values * 4 + tick.astype("int32")
+
+    def _data_reply(self):
+        if len(self._in_flight) and time.perf_counter() >= self._release_time:
+            # not cleared by 'start': read by the next acquisition if not drained
+            self._pending = np.concatenate((self._in_flight, self._pending))
+            self._in_flight = self._in_flight[:0]
+        if self.running:
+            self.data_replies += 1
+            if (
+                self.memory_problem_every
+                and self.data_replies % self.memory_problem_every == 0
+            ):
+                return self._format_reply(1, [])
+
+            trace_size = self.trace_size()
+            missing = self.chunk_size - len(self._pending)
+            if missing > 0:
+                n_traces = -(-missing // trace_size)
+                if self.trace_rate is not None:
+                    produced = int(
+                        (time.perf_counter() - self._t_start) * self.trace_rate
+                    )
+                    n_traces = min(n_traces, produced - self._traces)
+                if n_traces > 0:
+                    self._pending = np.concatenate(
+                        (self._pending, self._traces_words(n_traces))
+                    )
+        words = self._pending[: self.chunk_size]
+        self._pending = self._pending[self.chunk_size :]
+        return self._format_reply(0, words)
+
+    def _format_reply(self, status, words):
+        if self.settings["OUTPUT:FORMAT"].upper() == "BIN":
+            if status == 0 and len(words) == 0:
+                return b"#10"
+            block = np.concatenate(([status], words)).astype("int32")
+            return bytes(to_ieee_block(block, datatype="i", is_big_endian=True))
+        if status == 0 and len(words) == 0:
+            return b"{}"
+        if status != 0:
+            return ("{%d}" % status).encode()
+        return ("{0," + ",".join(words.astype(str)) + "}").encode()
+
+
+if __name__ == "__main__":
+    sim = RedpitayaSimulator(port=5000)
+    sim.start()
+    print("Redpitaya simulator listening on " + sim.address)
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        sim.stop()
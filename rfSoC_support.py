@@ -1,4 +1,9 @@
+import json
+import sqlite3
 import sys
+import time
+from datetime import datetime
+from functools import partial
 
 import numpy as np
 
@@ -17,6 +22,555 @@ import pandas as pd
 from general_functions import find_nearest
 from progress_barV2 import bar
 
+# golden-section ratio of the line searches
+GOLDEN = (3 - np.sqrt(5)) / 2
+
+
+class _Acquisitions:
+    """
+    Measure function seen by the optimizers: it counts the acquisitions, keeps
+    their history, wraps the periodic coordinates and clips the others into
+    their bounds
+    """
+
+    def __init__(
+        self, measure, bounds, periodic, sign=1, max_acquisitions=100, db=False
+    ):
+        self.measure = measure
+        self.bounds = bounds
+        self.periodic = periodic
+        self.sign = sign
+        self.max_acquisitions = max_acquisitions
+        self.db = db
+        self.history = []
+
+    def clip(self, x):
+        lo, hi = self.bounds[:, 0], self.bounds[:, 1]
+        return np.where(self.periodic, x, np.clip(x, lo, hi))
+
+    def wrap(self, x):
+        lo, hi = self.bounds[:, 0], self.bounds[:, 1]
+        return np.where(self.periodic, lo + np.mod(x - lo, hi - lo), np.clip(x, lo, hi))
+
+    def remaining(self):
+        return self.max_acquisitions - len(self.history)
+
+    def __call__(self, x):
+        x = self.wrap(np.array(x, dtype=float))
+        value = float(self.measure(x))
+        self.history.append((x, value))
+        return self.sign * value
+
+
+def _scan(f, lo, hi, points, periodic):
+    """
+    Coarse scan of one coordinate
+    Output:
+        bracket (a, b, c) around the lowest point of the scan, and the values
+        at these three points
+    """
+    if periodic:
+        x = lo + (hi - lo) * np.arange(points) / points
+    else:
+        x = np.linspace(lo, hi, points)
+    y = np.array([f(v) for v in x])
+    i = int(np.argmin(y))
+    if periodic:
+        step = x[1] - x[0]
+        return (x[i] - step, x[i], x[i] + step), (y[i - 1], y[i], y[(i + 1) % points])
+    i = min(max(i, 1), points - 2)
+    return tuple(x[i - 1 : i + 2]), tuple(y[i - 1 : i + 2])
+
+
+def _line_search(
+    f, bracket, values, bounds, periodic, xtol, threshold, n_max, parabolic, db
+):
+    """
+    Minimize one coordinate from a bracket (a, b, c)
+    Input:
+        threshold(float): the search stops when the values at the ends of the
+        bracket are within threshold of the middle one
+        n_max(int): maximum number of acquisitions
+        parabolic(bool): try the minimum of the parabola through the bracket
+        before the golden-section point
+        db(bool): the values are in dB, the parabola is fitted on the powers
+    Output:
+        the best point and its value
+    """
+    (a, b, c), (fa, fb, fc) = bracket, values
+    lo, hi = bounds
+    n = 0
+    while n < n_max:
+        if fa < fb and fa <= fc:
+            if periodic or a > lo:
+                # the minimum is beyond a: extend the bracket
+                x = a - (c - a) if periodic else max(lo, a - (c - a))
+                (a, b, c), (fa, fb, fc) = (x, a, b), (f(x), fa, fb)
+            else:
+                x = a + GOLDEN * (b - a)
+                (b, c), (fb, fc) = (x, b), (f(x), fb)
+            n += 1
+            continue
+        if fc < fb:
+            if periodic or c < hi:
+                x = c + (c - a) if periodic else min(hi, c + (c - a))
+                (a, b, c), (fa, fb, fc) = (b, c, x), (fb, fc, f(x))
+            else:
+                x = c - GOLDEN * (c - b)
+                (a, b), (fa, fb) = (b, x), (fb, f(x))
+            n += 1
+            continue
+
+        if c - a <= xtol or max(fa, fc) - fb <= threshold:
+            break
+        x = None
+        if parabolic:
+            # a cancellation dip is a parabola in power, not in dB
+            ya, yb, yc = 10 ** (np.array([fa, fb, fc]) / 10) if db else (fa, fb, fc)
+            p = (b - a) ** 2 * (yb - yc) - (b - c) ** 2 * (yb - ya)
+            q = (b - a) * (yb - yc) - (b - c) * (yb - ya)
+            if q != 0:
+                x = b - 0.5 * p / q
+                if abs(x - b) < xtol / 2:
+                    # the model puts the minimum on b
+                    break
+                if not a + xtol / 2 < x < c - xtol / 2:
+                    x = None
+        if x is None:
+            x = b + GOLDEN * (c - b) if c - b > b - a else b - GOLDEN * (b - a)
+        fx = f(x)
+        n += 1
+        if fx < fb:
+            if x > b:
+                a, fa = b, fb
+            else:
+                c, fc = b, fb
+            b, fb = x, fx
+        elif x > b:
+            c, fc = x, fx
+        else:
+            a, fa = x, fx
+    return min((fb, b), (fa, a), (fc, c))[::-1]
+
+
+def coordinate_descent(
+    f,
+    x0,
+    bounds,
+    periodic,
+    points,
+    xtol,
+    threshold,
+    rounds=2,
+    window=0.2,
+    parabolic=False,
+):
+    """
+    Line searches along every coordinate in turn. The first round brackets
+    each coordinate with a coarse scan of its bounds, the round n searches
+    window**n times the bounds around the current point. The rounds stop when
+    one of them improves the value by less than the threshold
+    """
+    x = np.array(x0, dtype=float)
+    fx = np.inf
+    for n_round in range(rounds):
+        f_start = fx
+        for i, (lo, hi) in enumerate(bounds):
+            if f.remaining() <= 0:
+                return x, fx
+
+            def f_line(v, i=i):
+                y = x.copy()
+                y[i] = v
+                return f(y)
+
+            if n_round == 0:
+                bracket, values = _scan(f_line, lo, hi, points[i], periodic[i])
+            else:
+                w = max(window**n_round * (hi - lo), xtol[i])
+                a, c = x[i] - w, x[i] + w
+                if not periodic[i]:
+                    a, c = max(a, lo), min(c, hi)
+                fa = fx if a == x[i] else f_line(a)
+                fc = fx if c == x[i] else f_line(c)
+                bracket, values = (a, x[i], c), (fa, fx, fc)
+            x[i], fx = _line_search(
+                f_line,
+                bracket,
+                values,
+                (lo, hi),
+                periodic[i],
+                xtol[i],
+                threshold,
+                f.remaining(),
+                parabolic,
+                f.db,
+            )
+            x = f.wrap(x)
+        if f_start - fx <= threshold:
+            break
+    return x, fx
+
+
+def nelder_mead(f, x0, bounds, periodic, points, xtol, threshold):
+    """
+    Nelder-Mead simplex, started on the best point of a coarse scan of every
+    coordinate in turn, with steps of the scans. It stops when the values on the
+    simplex are within the threshold, or when the simplex is smaller than xtol.
+    A single noisy value can stop it or keep a bad vertex: it is meant for
+    measurements with a noise well below the depth of the minimum, not for
+    the cancellation powers (see run_optimizers in rfSoC_benchmark.py)
+    """
+    x0 = np.array(x0, dtype=float)
+    steps = np.empty(len(x0))
+    for i, (lo, hi) in enumerate(bounds):
+
+        def f_line(v, i=i):
+            y = x0.copy()
+            y[i] = v
+            return f(y)
+
+        bracket, _ = _scan(f_line, lo, hi, points[i], periodic[i])
+        x0[i] = bracket[1]
+        steps[i] = bracket[1] - bracket[0]
+    simplex = [x0] + [f.clip(x0 + step) for step in np.diag(steps)]
+    values = [f(x) for x in simplex]
+    while f.remaining() > 0:
+        order = np.argsort(values)
+        simplex = [simplex[i] for i in order]
+        values = [values[i] for i in order]
+        if values[-1] - values[0] <= threshold:
+            break
+        if np.all(np.ptp(simplex, axis=0) <= xtol):
+            break
+
+        centroid = np.mean(simplex[:-1], axis=0)
+        x_r = f.clip(2 * centroid - simplex[-1])
+        f_r = f(x_r)
+        if f_r < values[0]:
+            x_e = f.clip(3 * centroid - 2 * simplex[-1])
+            f_e = f(x_e)
+            simplex[-1], values[-1] = (x_e, f_e) if f_e < f_r else (x_r, f_r)
+        elif f_r < values[-2]:
+            simplex[-1], values[-1] = x_r, f_r
+        else:
+            worst = x_r if f_r < values[-1] else simplex[-1]
+            x_c = (centroid + worst) / 2
+            f_c = f(x_c)
+            if f_c < min(f_r, values[-1]):
+                simplex[-1], values[-1] = x_c, f_c
+            else:
+                # shrink towards the best point
+                for i in range(1, len(simplex)):
+                    simplex[i] = (simplex[0] + simplex[i]) / 2
+                    values[i] = f(simplex[i])
+    best = int(np.argmin(values))
+    return f.wrap(simplex[best]), values[best]
+
+
+def grid_search(f, x0, bounds, periodic, points, xtol, threshold, rounds=2, window=0.2):
+    """
+    Scans of points values of every coordinate in turn, the window of each
+    scan narrowed to window times the previous one around the best point: the
+    search of the pump_cancellation_cls methods
+    """
+    x = np.array(x0, dtype=float)
+    fx = np.inf
+    ranges = np.array(bounds, dtype=float)
+    for _ in range(rounds):
+        for i, (lo, hi) in enumerate(bounds):
+            grid = np.linspace(*ranges[i], points[i])
+            values = []
+            for v in grid:
+                x[i] = v
+                values.append(f(x))
+            x[i], fx = grid[np.argmin(values)], np.min(values)
+            w = window * (ranges[i][1] - ranges[i][0]) / 2
+            ranges[i] = (x[i] - w, x[i] + w)
+            if not periodic[i]:
+                ranges[i] = np.clip(ranges[i], lo, hi)
+        x = f.wrap(x)
+    return x, fx
+
+
+# optimizers of minimize: golden and parabolic run line searches along each
+# coordinate in turn, the plain line search of one dimensional problems.
+# nelder-mead is for measurements with a low noise only, see nelder_mead
+OPTIMIZERS = {
+    "grid": grid_search,
+    "golden": coordinate_descent,
+    "parabolic": partial(coordinate_descent, parabolic=True),
+    "nelder-mead": nelder_mead,
+}
+
+
+def minimize(
+    measure,
+    x0,
+    bounds,
+    method="golden",
+    periodic=False,
+    points=5,
+    xtol=0.0,
+    noise=None,
+    noise_samples=8,
+    noise_factor=2.0,
+    max_acquisitions=100,
+    maximize=False,
+    db=False,
+    **options,
+):
+    """
+    Minimize a measured quantity, like the power left by a cancellation, with
+    as few acquisitions as possible
+    Input:
+        measure(function): takes the array of the coordinates, returns the
+        measured value
+        x0(list): starting point of nelder-mead and of the noise estimation
+        bounds(list of (min, max)): range of every coordinate
+        method(string): key of OPTIMIZERS
+        periodic(bool or list of bool): coordinates wrapping around their
+        bounds, like phases
+        points(int or list): points of the first coarse scan of each coordinate
+        xtol(float or list): resolution of each coordinate
+        noise(float): standard deviation of one measurement, None to estimate
+        it from noise_samples acquisitions at x0. The threshold follows this
+        estimate: it is below half the noise in 22 % of the searches with 3
+        samples, and the search then stops on noise, 3 % with 8 samples
+        noise_factor(float): the search stops when the values it compares are
+        within noise_factor * noise
+        max_acquisitions(int): maximum number of calls to measure
+        maximize(bool): look for the maximum instead
+        db(bool): the values are powers in dB, see _line_search
+        options: passed to the method, e.g. rounds or window
+    Output:
+        dict with the best point x, its measured value fun, n_acquisitions,
+        the noise, the method and the history of (x, value)
+    """
+    bounds = np.array(bounds, dtype=float).reshape(-1, 2)
+    n_dim = len(bounds)
+    periodic = np.broadcast_to(periodic, n_dim)
+    points = np.broadcast_to(points, n_dim)
+    xtol = np.broadcast_to(xtol, n_dim)
+    f = _Acquisitions(
+        measure, bounds, periodic, -1 if maximize else 1, max_acquisitions, db
+    )
+
+    if noise is None and method == "grid":
+        # the grid does not stop on the noise: no acquisition is spent on it
+        noise = np.nan
+    elif noise is None:
+        samples = [f(x0) for _ in range(noise_samples)]
+        noise = float(np.std(samples, ddof=1)) if noise_samples > 1 else 0.0
+
+    x, fx = OPTIMIZERS[method](
+        f, x0, bounds, periodic, points, xtol, noise_factor * noise, **options
+    )
+    return dict(
+        x=x,
+        fun=f.sign * fx,
+        n_acquisitions=len(f.history),
+        noise=noise,
+        method=method,
+        history=f.history,
+    )
+
+
+def plot_optimization(result, label):
+    history = np.array([value for _, value in result["history"]])
+    fig = plt.figure(figsize=(16, 12))
+    ax3 = fig.add_subplot(221)
+    ax3.plot(history, marker=".", color="orange")
+    ax3.axhline(result["fun"], color="blue")
+    plt.title("{}: {} acquisitions".format(result["method"], result["n_acquisitions"]))
+    plt.xlabel("Acquisition", fontsize=14)
+    plt.ylabel(label, fontsize=14)
+    plt.grid()
+    plt.show()
+
+
+class calibration_store_cls:
+    """
+    Calibrations (IQ balance, pump cancellation...) kept in a SQLite file,
+    keyed by kind of calibration, frequency (MHz), channels and date. The
+    settings a calibration was measured with (amplitude, dc offsets...) are
+    stored with it, and a lookup only uses the calibrations made with the
+    settings asked for.
+    Input:
+        database_name(string): path of the SQLite file, created if needed
+    """
+
+    def __init__(self, database_name):
+        self.database_name = database_name
+
+        self.fresh_age = 12  # hours, a calibration younger is used as it is
+        self.max_age = 24 * 7  # hours, an older calibration is ignored
+        self.freq_tol = 1e-3  # MHz, frequencies closer are the same one
+        self.max_distance = 10  # MHz, to interpolate or use a neighbour
+        self.angle_keys = ("phase",)  # degrees, interpolated on the circle
+        self.settings_tol = 1e-9  # relative, settings closer are the same
+
+        conn = sqlite3.connect(self.database_name)
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS calibration ("
+            "id INTEGER PRIMARY KEY, kind TEXT, channels TEXT, freq REAL, "
+            "timestamp REAL, date TEXT, parameters TEXT, n_acquisitions INTEGER, "
+            "settings TEXT)"
+        )
+        columns = [row[1] for row in conn.execute("PRAGMA table_info(calibration)")]
+        if "settings" not in columns:
+            # file written before the settings were stored: its calibrations
+            # match no settings and are only kept in the history
+            conn.execute("ALTER TABLE calibration ADD COLUMN settings TEXT")
+        conn.commit()
+        conn.close()
+
+    @staticmethod
+    def channels_key(channels):
+        return ",".join(str(int(ch)) for ch in channels)
+
+    @staticmethod
+    def settings_value(value):
+        # numbers are stored as floats, anything else as a string
+        if isinstance(value, (bool, str)):
+            return str(value)
+        try:
+            return float(value)
+        except (TypeError, ValueError):
+            return str(value)
+
+    def match_settings(self, stored, settings):
+        """
+        True if every setting asked for has the same value in the stored ones
+        """
+        for key, value in settings.items():
+            value = self.settings_value(value)
+            if key not in stored:
+                return False
+            if isinstance(value, float) and isinstance(stored[key], float):
+                if not np.isclose(stored[key], value, rtol=self.settings_tol, atol=0):
+                    return False
+            elif stored[key] != value:
+                return False
+        return True
+
+    def store(self, kind, freq, channels, values, n_acquisitions=None, settings=None):
+        """
+        Add a calibration
+        Input:
+            kind(string): e.g. 'IQ_balance' or 'pump_cancel'
+            freq(float): frequency of the calibration (MHz)
+            channels(list of int): channels calibrated together
+            values(dict): calibrated parameters, numbers
+            n_acquisitions(int): cost of the calibration
+            settings(dict): settings the calibration was measured with
+        """
+        now = time.time()
+        conn = sqlite3.connect(self.database_name)
+        conn.execute(
+            "INSERT INTO calibration (kind, channels, freq, timestamp, date, "
+            "parameters, n_acquisitions, settings) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+            (
+                kind,
+                self.channels_key(channels),
+                float(freq),
+                now,
+                datetime.fromtimestamp(now).isoformat(timespec="seconds"),
+                json.dumps({key: float(value) for key, value in values.items()}),
+                None if n_acquisitions is None else int(n_acquisitions),
+                json.dumps(
+                    {
+                        key: self.settings_value(value)
+                        for key, value in (settings or {}).items()
+                    }
+                ),
+            ),
+        )
+        conn.commit()
+        conn.close()
+
+    def history(self, kind, channels=None):
+        """
+        All the calibrations of a kind, oldest first, as a DataFrame
+        """
+        query = "SELECT * FROM calibration WHERE kind = ?"
+        args = [kind]
+        if channels is not None:
+            query += " AND channels = ?"
+            args.append(self.channels_key(channels))
+        conn = sqlite3.connect(self.database_name)
+        table = pd.read_sql_query(query + " ORDER BY timestamp", conn, params=args)
+        conn.close()
+        return table
+
+    def lookup(self, kind, freq, channels, settings=None):
+        """
+        Calibration at freq, from the latest calibration of every frequency
+        younger than max_age: the one at freq, else the interpolation between
+        the neighbours within max_distance, else the nearest of them
+        Input:
+            settings(dict): only the calibrations stored with the same values
+            of these settings are used (see match_settings)
+        Output:
+            None if there is no usable calibration, else dict of the values,
+            the age (hours) of the oldest calibration used, interpolated and
+            status: 'fresh' if the calibration at freq is younger than
+            fresh_age and can be used without calibrating, 'warm' otherwise
+        """
+        now = time.time()
+        conn = sqlite3.connect(self.database_name)
+        rows = conn.execute(
+            "SELECT freq, timestamp, parameters, settings FROM calibration "
+            "WHERE kind = ? AND channels = ? AND timestamp >= ? "
+            "ORDER BY timestamp",
+            (kind, self.channels_key(channels), now - 3600 * self.max_age),
+        ).fetchall()
+        conn.close()
+
+        latest = {}
+        for f, timestamp, parameters, stored in rows:
+            stored = json.loads(stored) if stored else {}
+            if self.match_settings(stored, settings or {}):
+                latest[round(f / self.freq_tol)] = (
+                    f,
+                    timestamp,
+                    json.loads(parameters),
+                )
+        below = [r for r in latest.values() if freq - self.max_distance <= r[0] < freq]
+        above = [r for r in latest.values() if freq < r[0] <= freq + self.max_distance]
+        exact = latest.get(round(freq / self.freq_tol))
+
+        if exact is not None:
+            used = [exact]
+            values = exact[2]
+        elif below and above:
+            low = max(below, key=lambda r: r[0])
+            high = min(above, key=lambda r: r[0])
+            used = [low, high]
+            weight = (freq - low[0]) / (high[0] - low[0])
+            values = {}
+            for key in low[2].keys() & high[2].keys():
+                v0, v1 = low[2][key], high[2][key]
+                if key in self.angle_keys:
+                    v1 = v0 + (v1 - v0 + 180) % 360 - 180
+                    values[key] = (v0 + weight * (v1 - v0)) % 360
+                else:
+                    values[key] = v0 + weight * (v1 - v0)
+        elif below or above:
+            used = [min(below + above, key=lambda r: abs(r[0] - freq))]
+            values = used[0][2]
+        else:
+            return None
+
+        age = (now - min(r[1] for r in used)) / 3600
+        fresh = exact is not None and age <= self.fresh_age
+        return dict(
+            values=values,
+            age=age,
+            interpolated=len(used) == 2,
+            status="fresh" if fresh else "warm",
+        )
+
 
 def optimize_IQ_balance(
     rfsoc_device,
@@ -25,100 +579,198 @@ def optimize_IQ_balance(
     display_plots=False,
     pump_sig_ch=[1, 2],
     amp=0.05,
-    dc_offset_I=8,
-    dc_offset_Q=6,
+    dc_offset_I=None,
+    dc_offset_Q=None,
     active_mode="lower",
     acq_length=10,
     adc_start=1.0,
+    optimizer="grid",
+    optimizer_options=None,
+    full_output=False,
+    calibration=None,
 ):
+    # calibration: calibration_store_cls. A fresh calibration at nu is returned
+    # without measuring, an older or interpolated one replaces the coarse scan.
+    # Only the calibrations made with the same amp, active_mode and, when they
+    # are given, dc offsets are used. The result is stored in it with these
+    # settings. The dc offsets (mV) default to the calibrated ones, or to 8 and 6
+    calibrated = None
+    if calibration is not None:
+        settings = dict(amp=amp, active_mode=active_mode)
+        if dc_offset_I is not None:
+            settings["dc_offset_I"] = dc_offset_I
+        if dc_offset_Q is not None:
+            settings["dc_offset_Q"] = dc_offset_Q
+        calibrated = calibration.lookup("IQ_balance", nu, pump_sig_ch, settings)
+    calibrated_values = {} if calibrated is None else calibrated["values"]
+    if dc_offset_I is None:
+        dc_offset_I = calibrated_values.get("dc_offset_I", 8)
+    if dc_offset_Q is None:
+        dc_offset_Q = calibrated_values.get("dc_offset_Q", 6)
+
+    if calibrated is not None and calibrated["status"] == "fresh":
+        optimal_phase = calibrated_values["phase"]
+        result = dict(
+            x=np.array([optimal_phase]),
+            fun=calibrated_values.get("pow"),
+            n_acquisitions=0,
+            noise=None,
+            method="calibration",
+            history=None,
+        )
+        return (optimal_phase, result) if full_output else optimal_phase
+
+    def store(result):
+        if calibration is not None:
+            values = dict(
+                phase=result["x"][0],
+                pow=result["fun"],
+                dc_offset_I=dc_offset_I,
+                dc_offset_Q=dc_offset_Q,
+            )
+            settings = dict(
+                amp=amp,
+                active_mode=active_mode,
+                dc_offset_I=dc_offset_I,
+                dc_offset_Q=dc_offset_Q,
+            )
+            calibration.store(
+                "IQ_balance",
+                nu,
+                pump_sig_ch,
+                values,
+                result["n_acquisitions"],
+                settings,
+            )
+
     mem_seq_display = rfsoc_device.display_sequence
     rfsoc_device.display_sequence = False
 
     phase_vec = np.arange(0, 360, 10)
+    if calibrated is not None:
+        # warm start: the coarse scan is replaced by the calibrated phase
+        phase_vec = np.array([np.round(calibrated_values["phase"])])
     data_down = np.array([])
     data_up = np.array([])
     num_repetitions = 10_000
 
     [ch_1, ch_2] = pump_sig_ch
 
-    for phase_offset in phase_vec:
-        param_sin_I = {
-            "amp": amp,
-            "freq": nu,
-            "dc_offset": dc_offset_I * 1e-3,
-            "phase_offset": 0,
-        }
-
-        param_sin_Q = {
-            "amp": amp,
-            "freq": nu,
-            "dc_offset": dc_offset_Q * 1e-3,
-            "phase_offset": np.pi * phase_offset / 180,
-        }
-
-        pulse_sin = dict(
-            label="signal+pump",
-            module="DAC",
-            channel=ch_1,
-            mode="sin",
-            start=0,
-            length=acq_length + 2,
-            param=param_sin_I,
-            parent=None,
+    phase_offset = phase_vec[0]
+    param_sin_I = {
+        "amp": amp,
+        "freq": nu,
+        "dc_offset": dc_offset_I * 1e-3,
+        "phase_offset": 0,
+    }
+
+    param_sin_Q = {
+        "amp": amp,
+        "freq": nu,
+        "dc_offset": dc_offset_Q * 1e-3,
+        "phase_offset": np.pi * phase_offset / 180,
+    }
+
+    pulse_sin = dict(
+        label="signal+pump",
+        module="DAC",
+        channel=ch_1,
+        mode="sin",
+        start=0,
+        length=acq_length + 2,
+        param=param_sin_I,
+        parent=None,
+    )
+
+    record_sin = dict(
+        label="record_both",
+        module="ADC",
+        channel=1,
+        mode="raw",
+        start=adc_start,
+        length=acq_length,
+        param=None,
+        parent=None,
+    )
+
+    pulse_sin2 = dict(
+        label="signal+pump2",
+        module="DAC",
+        channel=ch_2,
+        mode="sin",
+        start=0,
+        length=acq_length + 2,
+        param=param_sin_Q,
+        parent=None,
+    )
+
+    record_sin2 = dict(
+        label="record_both2",
+        module="ADC",
+        channel=2,
+        mode="raw",
+        start=adc_start,
+        length=acq_length,
+        param=None,
+        parent=None,
+    )
+
+    pulses = pd.DataFrame([pulse_sin, record_sin, pulse_sin2, record_sin2])
+
+    rfsoc_device.pulses = pulses
+
+    rfsoc_device.acquisition_mode("IQ")
+    rfsoc_device.ADC1.fmixer(nu - nu_det_offset)  # MHz
+    rfsoc_device.ADC2.fmixer(nu + nu_det_offset)  # MHz
+    rfsoc_device.freq_sync(1e6)
+    rfsoc_device.ADC1.status("ON")
+    rfsoc_device.ADC2.status("ON")
+    rfsoc_device.output_format("BIN")
+    rfsoc_device.n_rep(num_repetitions)
+
+    rfsoc_device.process_sequencing()
+
+    if optimizer != "grid":
+        # one search over the whole period instead of the two scans
+
+        def measure(x):
+            rfsoc_device.update_DAC_pulse(
+                "signal+pump2", phase_offset=np.pi * x[0] / 180
+            )
+            return rfsoc_device.ADC_power_dBm()[1][0]
+
+        x0, bounds, periodic = (180,), [(0, 360)], True
+        if calibrated is not None:
+            # warm start around the calibrated phase
+            phase = calibrated_values["phase"]
+            x0, bounds, periodic = (phase,), [(phase - 20, phase + 20)], False
+        result = minimize(
+            measure,
+            x0=x0,
+            bounds=bounds,
+            method=optimizer,
+            periodic=periodic,
+            xtol=1,
+            db=True,
+            **(optimizer_options or {}),
         )
+        result["x"] = result["x"] % 360
+        if display_plots:
+            plot_optimization(result, "PSD (dBm)")
 
-        record_sin = dict(
-            label="record_both",
-            module="ADC",
-            channel=1,
-            mode="raw",
-            start=adc_start,
-            length=acq_length,
-            param=None,
-            parent=None,
-        )
+        rfsoc_device.display_sequence = mem_seq_display
 
-        pulse_sin2 = dict(
-            label="signal+pump2",
-            module="DAC",
-            channel=ch_2,
-            mode="sin",
-            start=0,
-            length=acq_length + 2,
-            param=param_sin_Q,
-            parent=None,
-        )
+        store(result)
+        optimal_phase = result["x"][0]
+        return (optimal_phase, result) if full_output else optimal_phase
 
-        record_sin2 = dict(
-            label="record_both2",
-            module="ADC",
-            channel=2,
-            mode="raw",
-            start=adc_start,
-            length=acq_length,
-            param=None,
-            parent=None,
+    for phase_offset in phase_vec:
+        # the timing does not change: only the waveform of the Q channel is
+        # written again
+        rfsoc_device.update_DAC_pulse(
+            "signal+pump2", phase_offset=np.pi * phase_offset / 180
         )
 
-        pulses = pd.DataFrame()
-        pulses = pulses.append(pulse_sin, ignore_index=True)
-        pulses = pulses.append(record_sin, ignore_index=True)
-        pulses = pulses.append(pulse_sin2, ignore_index=True)
-        pulses = pulses.append(record_sin2, ignore_index=True)
-
-        rfsoc_device.pulses = pulses
-
-        rfsoc_device.acquisition_mode("IQ")
-        rfsoc_device.ADC1.fmixer(nu - nu_det_offset)  # MHz
-        rfsoc_device.ADC2.fmixer(nu + nu_det_offset)  # MHz
-        rfsoc_device.freq_sync(1e6)
-        rfsoc_device.ADC1.status("ON")
-        rfsoc_device.ADC2.status("ON")
-        rfsoc_device.output_format("BIN")
-        rfsoc_device.n_rep(num_repetitions)
-
-        rfsoc_device.process_sequencing()
-
         data_raw = rfsoc_device.ADC_power_dBm()[:2]
 
         data_down = np.append(data_down, data_raw[0])
@@ -155,89 +807,93 @@ def optimize_IQ_balance(
         # plt.show()
 
     optimal_phase_1 = phase_vec[find_nearest(data_up, np.min(data_up))]
+    n_acquisitions = len(phase_vec)
 
     phase_vec = np.arange(optimal_phase_1 - 5, optimal_phase_1 + 5, 1)
     data_down = np.array([])
     data_up = np.array([])
 
-    for phase_offset in phase_vec:
-        param_sin_I = {
-            "amp": amp,
-            "freq": nu,
-            "dc_offset": dc_offset_I * 1e-3,
-            "phase_offset": 0,
-        }
-
-        param_sin_Q = {
-            "amp": amp,
-            "freq": nu,
-            "dc_offset": dc_offset_Q * 1e-3,
-            "phase_offset": np.pi * phase_offset / 180,
-        }
-
-        pulse_sin = dict(
-            label="signal+pump",
-            module="DAC",
-            channel=1,
-            mode="sin",
-            start=0,
-            length=acq_length + 2,
-            param=param_sin_I,
-            parent=None,
-        )
-
-        record_sin = dict(
-            label="record_both",
-            module="ADC",
-            channel=1,
-            mode="raw",
-            start=adc_start,
-            length=acq_length,
-            param=None,
-            parent=None,
-        )
-
-        pulse_sin2 = dict(
-            label="signal+pump2",
-            module="DAC",
-            channel=2,
-            mode="sin",
-            start=0,
-            length=acq_length + 2,
-            param=param_sin_Q,
-            parent=None,
-        )
+    phase_offset = phase_vec[0]
+    param_sin_I = {
+        "amp": amp,
+        "freq": nu,
+        "dc_offset": dc_offset_I * 1e-3,
+        "phase_offset": 0,
+    }
+
+    param_sin_Q = {
+        "amp": amp,
+        "freq": nu,
+        "dc_offset": dc_offset_Q * 1e-3,
+        "phase_offset": np.pi * phase_offset / 180,
+    }
+
+    pulse_sin = dict(
+        label="signal+pump",
+        module="DAC",
+        channel=1,
+        mode="sin",
+        start=0,
+        length=acq_length + 2,
+        param=param_sin_I,
+        parent=None,
+    )
+
+    record_sin = dict(
+        label="record_both",
+        module="ADC",
+        channel=1,
+        mode="raw",
+        start=adc_start,
+        length=acq_length,
+        param=None,
+        parent=None,
+    )
+
+    pulse_sin2 = dict(
+        label="signal+pump2",
+        module="DAC",
+        channel=2,
+        mode="sin",
+        start=0,
+        length=acq_length + 2,
+        param=param_sin_Q,
+        parent=None,
+    )
+
+    record_sin2 = dict(
+        label="record_both2",
+        module="ADC",
+        channel=2,
+        mode="raw",
+        start=adc_start,
+        length=acq_length,
+        param=None,
+        parent=None,
+    )
+
+    pulses = pd.DataFrame([pulse_sin, record_sin, pulse_sin2, record_sin2])
+
+    rfsoc_device.pulses = pulses
+
+    rfsoc_device.acquisition_mode("IQ")
+    rfsoc_device.ADC1.fmixer(nu - nu_det_offset)  # MHz
+    rfsoc_device.ADC2.fmixer(nu + nu_det_offset)  # MHz
+    rfsoc_device.freq_sync(1e6)
+    rfsoc_device.ADC1.status("ON")
+    rfsoc_device.ADC2.status("ON")
+    rfsoc_device.output_format("BIN")
+    rfsoc_device.n_rep(num_repetitions)
+
+    rfsoc_device.process_sequencing()
 
-        record_sin2 = dict(
-            label="record_both2",
-            module="ADC",
-            channel=2,
-            mode="raw",
-            start=adc_start,
-            length=acq_length,
-            param=None,
-            parent=None,
+    for phase_offset in phase_vec:
+        # the timing does not change: only the waveform of the Q channel is
+        # written again
+        rfsoc_device.update_DAC_pulse(
+            "signal+pump2", phase_offset=np.pi * phase_offset / 180
         )
 
-        pulses = pd.DataFrame()
-        pulses = pulses.append(pulse_sin, ignore_index=True)
-        pulses = pulses.append(record_sin, ignore_index=True)
-        pulses = pulses.append(pulse_sin2, ignore_index=True)
-        pulses = pulses.append(record_sin2, ignore_index=True)
-
-        rfsoc_device.pulses = pulses
-
-        rfsoc_device.acquisition_mode("IQ")
-        rfsoc_device.ADC1.fmixer(nu - nu_det_offset)  # MHz
-        rfsoc_device.ADC2.fmixer(nu + nu_det_offset)  # MHz
-        rfsoc_device.freq_sync(1e6)
-        rfsoc_device.ADC1.status("ON")
-        rfsoc_device.ADC2.status("ON")
-        rfsoc_device.output_format("BIN")
-        rfsoc_device.n_rep(num_repetitions)
-
-        rfsoc_device.process_sequencing()
-
         data_raw = rfsoc_device.ADC_power_dBm()[:2]
 
         data_down = np.append(data_down, data_raw[0])
@@ -275,7 +931,17 @@ def optimize_IQ_balance(
 
     rfsoc_device.display_sequence = mem_seq_display
 
-    return phase_vec[find_nearest(data_up, np.min(data_up))]
+    optimal_phase = phase_vec[find_nearest(data_up, np.min(data_up))]
+    result = dict(
+        x=np.array([optimal_phase]),
+        fun=np.min(data_up),
+        n_acquisitions=n_acquisitions + len(phase_vec),
+        noise=None,
+        method="grid",
+        history=None,
+    )
+    store(result)
+    return (optimal_phase, result) if full_output else optimal_phase
 
 
 class gain_signal_idler_cls:
@@ -532,19 +1198,22 @@ class gain_signal_idler_cls:
                 parent="pumpI",
             )
 
-            pulses = pd.DataFrame()
-            pulses = pulses.append(pulse_pump_I, ignore_index=True)
-            pulses = pulses.append(pulse_pump_Q, ignore_index=True)
-            pulses = pulses.append(pulse_weak_I, ignore_index=True)
-            pulses = pulses.append(pulse_weak_Q, ignore_index=True)
-            pulses = pulses.append(record_both, ignore_index=True)
-            pulses = pulses.append(record_both2, ignore_index=True)
-            pulses = pulses.append(pulse_pump_I2, ignore_index=True)
-            pulses = pulses.append(pulse_pump_Q2, ignore_index=True)
-            pulses = pulses.append(pulse_weak_I2, ignore_index=True)
-            pulses = pulses.append(pulse_weak_Q2, ignore_index=True)
-            pulses = pulses.append(record_weak, ignore_index=True)
-            pulses = pulses.append(record_weak2, ignore_index=True)
+            pulses = pd.DataFrame(
+                [
+                    pulse_pump_I,
+                    pulse_pump_Q,
+                    pulse_weak_I,
+                    pulse_weak_Q,
+                    record_both,
+                    record_both2,
+                    pulse_pump_I2,
+                    pulse_pump_Q2,
+                    pulse_weak_I2,
+                    pulse_weak_Q2,
+                    record_weak,
+                    record_weak2,
+                ]
+            )
 
             rfsoc_device.pulses = pulses
 
@@ -847,21 +1516,24 @@ class gain_signal_idler_cls:
                 parent="pumpI",
             )
 
-            pulses = pd.DataFrame()
-            pulses = pulses.append(pulse_pump_I, ignore_index=True)
-            pulses = pulses.append(pulse_pump_Q, ignore_index=True)
-            # pulses = pulses.append(pulse_cancel_pump, ignore_index=True)
-            pulses = pulses.append(pulse_weak_I, ignore_index=True)
-            pulses = pulses.append(pulse_weak_Q, ignore_index=True)
-            pulses = pulses.append(record_both, ignore_index=True)
-            pulses = pulses.append(record_both2, ignore_index=True)
-            pulses = pulses.append(pulse_pump_I2, ignore_index=True)
-            pulses = pulses.append(pulse_pump_Q2, ignore_index=True)
-            # pulses = pulses.append(pulse_cancel_pump2, ignore_index=True)
-            pulses = pulses.append(pulse_weak_I2, ignore_index=True)
-            pulses = pulses.append(pulse_weak_Q2, ignore_index=True)
-            pulses = pulses.append(record_weak, ignore_index=True)
-            pulses = pulses.append(record_weak2, ignore_index=True)
+            pulses = pd.DataFrame(
+                [
+                    pulse_pump_I,
+                    pulse_pump_Q,
+                    # pulse_cancel_pump,
+                    pulse_weak_I,
+                    pulse_weak_Q,
+                    record_both,
+                    record_both2,
+                    pulse_pump_I2,
+                    pulse_pump_Q2,
+                    # pulse_cancel_pump2,
+                    pulse_weak_I2,
+                    pulse_weak_Q2,
+                    record_weak,
+                    record_weak2,
+                ]
+            )
 
             rfsoc_device.pulses = pulses
 
@@ -948,6 +1620,18 @@ class pump_cancellation_cls:
         self.dac_weak_Q = 4
         self.dac_pump_cancel = 5
 
+        # "grid" keeps the scans with window narrowing above, the other
+        # OPTIMIZERS search with fewer acquisitions
+        self.optimizer = "grid"
+        self.optimizer_noise = None  # dB, None to estimate it at every search
+        self.optimizer_options = {}
+        # result of the last search, with its number of acquisitions
+        self.last_result = None
+        # calibration_store_cls: the optima are stored in it at nu_if with the
+        # pump settings (calibration_settings), and one stored with the same
+        # settings skips (fresh) or narrows (warm) the next search
+        self.calibration = None
+
     def get_optimal_attn_phase(self):
         rfsoc_device = self.rfsoc_device
         Vaunix_Att_device = self.Vaunix_Att_device
@@ -980,6 +1664,28 @@ class pump_cancellation_cls:
         wait_time = self.wait_time
         num_rep = self.num_rep
 
+        channels = [self.dac_pump_I, self.dac_pump_Q]
+        calibrated = self.calibrated("attn_phase", channels)
+        if calibrated is not None:
+            phase, attn = calibrated["values"]["phase"], calibrated["values"]["attn"]
+            if calibrated["status"] == "fresh":
+                Vaunix_FS_device.phase_shift(phase)
+                Vaunix_Att_device.attn(attn)
+                self.last_result = self.calibration_result(calibrated, [phase, attn])
+                return (phase, attn)
+            # warm start: the windows of the second round around the calibration
+            phase_sweep_mag = (
+                (phase_range[1] - phase_range[0]) * phase_window_narrowing / 100
+            )
+            phase_range = (phase - 0.5 * phase_sweep_mag, phase + 0.5 * phase_sweep_mag)
+            attn_sweep_mag = (
+                (attn_range[1] - attn_range[0]) * attn_window_narrowing / 100
+            )
+            attn_range = (
+                max(attn - 0.5 * attn_sweep_mag, 0),
+                min(attn + 0.5 * attn_sweep_mag, 50),
+            )
+
         mem_display_sequence = rfsoc_device.display_sequence
         mem_display_IQ_progress = rfsoc_device.display_IQ_progress
         rfsoc_device.display_sequence = False
@@ -1081,13 +1787,16 @@ class pump_cancellation_cls:
             parent=None,
         )
 
-        pulses = pd.DataFrame()
-        pulses = pulses.append(pulse_pump_I, ignore_index=True)
-        pulses = pulses.append(pulse_pump_Q, ignore_index=True)
-        pulses = pulses.append(pulse_weak_I, ignore_index=True)
-        pulses = pulses.append(pulse_weak_Q, ignore_index=True)
-        pulses = pulses.append(record_both, ignore_index=True)
-        pulses = pulses.append(record_both2, ignore_index=True)
+        pulses = pd.DataFrame(
+            [
+                pulse_pump_I,
+                pulse_pump_Q,
+                pulse_weak_I,
+                pulse_weak_Q,
+                record_both,
+                record_both2,
+            ]
+        )
 
         rfsoc_device.pulses = pulses
 
@@ -1105,6 +1814,34 @@ class pump_cancellation_cls:
 
         rfsoc_device.process_sequencing()
 
+        if self.optimizer != "grid":
+
+            def measure(x):
+                Vaunix_FS_device.phase_shift(self.process_phase(x[:1])[0])
+                Vaunix_Att_device.attn(x[1])
+                return rfsoc_device.ADC_power_dBm()[0][0]
+
+            result = self.optimize(
+                measure,
+                x0=(np.mean(phase_range), np.mean(attn_range)),
+                bounds=(phase_range, attn_range),
+                periodic=(phase_range[1] - phase_range[0] >= 360, False),
+                xtol=(1, 0.5),
+                db=True,
+            )
+            phase_min = self.process_phase(result["x"][:1])[0]
+            attn_min = result["x"][1]
+            Vaunix_FS_device.phase_shift(phase_min)
+            Vaunix_Att_device.attn(attn_min)
+            self.store_calibration(
+                "attn_phase", channels, phase=phase_min, attn=attn_min
+            )
+
+            rfsoc_device.display_sequence = mem_display_sequence
+            rfsoc_device.display_IQ_progress = mem_display_IQ_progress
+
+            return (phase_min, attn_min)
+
         for iter_n in range(iter_depth):
             # optimize phase
 
@@ -1210,6 +1947,15 @@ class pump_cancellation_cls:
                 )
 
         pow_min = pow_vec_0[np.argmin(pow_vec_0)]
+        self.last_result = dict(
+            x=np.array([phase_min, attn_min]),
+            fun=pow_min,
+            n_acquisitions=iter_depth * (phase_points + attn_points),
+            noise=None,
+            method="grid",
+            history=None,
+        )
+        self.store_calibration("attn_phase", channels, phase=phase_min, attn=attn_min)
 
         rfsoc_device.display_sequence = mem_display_sequence
         rfsoc_device.display_IQ_progress = mem_display_IQ_progress
@@ -1348,13 +2094,16 @@ class pump_cancellation_cls:
             parent=None,
         )
 
-        pulses = pd.DataFrame()
-        pulses = pulses.append(pulse_pump_I, ignore_index=True)
-        pulses = pulses.append(pulse_pump_Q, ignore_index=True)
-        pulses = pulses.append(pulse_weak_I, ignore_index=True)
-        pulses = pulses.append(pulse_weak_Q, ignore_index=True)
-        pulses = pulses.append(record_both, ignore_index=True)
-        pulses = pulses.append(record_both2, ignore_index=True)
+        pulses = pd.DataFrame(
+            [
+                pulse_pump_I,
+                pulse_pump_Q,
+                pulse_weak_I,
+                pulse_weak_Q,
+                record_both,
+                record_both2,
+            ]
+        )
 
         rfsoc_device.pulses = pulses
 
@@ -1508,6 +2257,29 @@ class pump_cancellation_cls:
         wait_time = self.wait_time
         num_rep = self.num_rep
 
+        channels = [self.dac_pump_I, self.dac_pump_Q, self.dac_pump_cancel]
+        calibrated = self.calibrated("pump_cancel", channels)
+        if calibrated is not None:
+            phase, amp = calibrated["values"]["phase"], calibrated["values"]["amp"]
+            if calibrated["status"] == "fresh":
+                self.load_pump_cancel(amp, phase)
+                self.last_result = self.calibration_result(calibrated, [phase, amp])
+                return (phase, amp)
+            # warm start: the windows of the second round around the calibration
+            phase_sweep_mag = (
+                (phase_range[1] - phase_range[0]) * phase_window_narrowing / 100
+            )
+            phase_range = (phase - 0.5 * phase_sweep_mag, phase + 0.5 * phase_sweep_mag)
+            amp_if_cancel_sweep_mag = (
+                (amp_if_cancel_range[1] - amp_if_cancel_range[0])
+                * amp_if_cancel_window_narrowing
+                / 100
+            )
+            amp_if_cancel_range = (
+                max(amp - 0.5 * amp_if_cancel_sweep_mag, 0),
+                amp + 0.5 * amp_if_cancel_sweep_mag,
+            )
+
         mem_display_sequence = rfsoc_device.display_sequence
         mem_display_IQ_progress = rfsoc_device.display_IQ_progress
         rfsoc_device.display_sequence = False
@@ -1525,7 +2297,39 @@ class pump_cancellation_cls:
         # 			 'dc_offset':self.dc_offset_Q_pump*1e-3,
         # 			 'phase_offset':np.pi*phase_offset_if/180}
 
-        amp_min = amp_if_cancel_range[0]
+        if self.optimizer != "grid":
+            # the sequence is loaded once, the phase and amplitude of the
+            # cancellation are then written in the DAC memory
+            self.load_pump_cancel(np.mean(amp_if_cancel_range), np.mean(phase_range))
+
+            def measure(x):
+                rfsoc_device.update_DAC_pulse(
+                    "cancel_pump", phase_offset=np.pi * x[0] / 180, amp=x[1]
+                )
+                return rfsoc_device.ADC_power_dBm()[0][0]
+
+            result = self.optimize(
+                measure,
+                x0=(np.mean(phase_range), np.mean(amp_if_cancel_range)),
+                bounds=(phase_range, amp_if_cancel_range),
+                periodic=(phase_range[1] - phase_range[0] >= 360, False),
+                xtol=(1, 0.005),
+                db=True,
+            )
+            phase_min, amp_min = result["x"]
+            rfsoc_device.update_DAC_pulse(
+                "cancel_pump", phase_offset=np.pi * phase_min / 180, amp=amp_min
+            )
+            self.store_calibration(
+                "pump_cancel", channels, phase=phase_min, amp=amp_min
+            )
+
+            rfsoc_device.display_sequence = mem_display_sequence
+            rfsoc_device.display_IQ_progress = mem_display_IQ_progress
+
+            return (phase_min, amp_min)
+
+        amp_min = amp_if_cancel_range[0] if calibrated is None else amp
 
         for iter_n in range(iter_depth):
             # optimize phase
@@ -1537,106 +2341,15 @@ class pump_cancellation_cls:
 
             print("Optimal DAC voltage = " + str(amp_min))
 
-            for phase in bar(phase_vec):
-                param_sin_I_pump = {
-                    "amp": amp_if,
-                    "freq": nu_if,
-                    "dc_offset": self.dc_offset_I_pump * 1e-3,
-                    "phase_offset": 0,
-                }
-
-                param_sin_Q_pump = {
-                    "amp": amp_if,
-                    "freq": nu_if,
-                    "dc_offset": self.dc_offset_Q_pump * 1e-3,
-                    "phase_offset": np.pi * phase_offset_if / 180,
-                }
-
-                param_sin_cancel = {
-                    "amp": amp_min,
-                    "freq": nu_if,
-                    "dc_offset": 0,
-                    "phase_offset": np.pi * phase / 180,
-                }
-
-                pulse_pump_I = dict(
-                    label="pumpI",
-                    module="DAC",
-                    channel=self.dac_pump_I,
-                    mode="sin",
-                    start=0,
-                    length=acq_length + wait_time,
-                    param=param_sin_I_pump,
-                    parent=None,
-                )
-
-                pulse_pump_Q = dict(
-                    label="pumpQ",
-                    module="DAC",
-                    channel=self.dac_pump_Q,
-                    mode="sin",
-                    start=0,
-                    length=acq_length + wait_time,
-                    param=param_sin_Q_pump,
-                    parent=None,
-                )
-
-                pulse_cancel_pump = dict(
-                    label="cancel_pump",
-                    module="DAC",
-                    channel=self.dac_pump_cancel,
-                    mode="sin",
-                    start=0,
-                    length=acq_length + wait_time,
-                    param=param_sin_cancel,
-                    parent=None,
-                )
-
-                record_both = dict(
-                    label="record_both",
-                    module="ADC",
-                    channel=1,
-                    mode="raw",
-                    start=adc_start,
-                    length=acq_length,
-                    param=None,
-                    parent=None,
-                )
+            self.load_pump_cancel(amp_min, phase_vec[0])
 
-                record_both2 = dict(
-                    label="record_both2",
-                    module="ADC",
-                    channel=2,
-                    mode="raw",
-                    start=adc_start,
-                    length=acq_length,
-                    param=None,
-                    parent=None,
+            for phase in bar(phase_vec):
+                # the timing does not change: only the waveform of the
+                # cancellation channel is written again
+                rfsoc_device.update_DAC_pulse(
+                    "cancel_pump", phase_offset=np.pi * phase / 180
                 )
 
-                pulses = pd.DataFrame()
-                pulses = pulses.append(pulse_pump_I, ignore_index=True)
-                pulses = pulses.append(pulse_pump_Q, ignore_index=True)
-                pulses = pulses.append(pulse_cancel_pump, ignore_index=True)
-                pulses = pulses.append(record_both, ignore_index=True)
-                pulses = pulses.append(record_both2, ignore_index=True)
-
-                rfsoc_device.pulses = pulses
-
-                rfsoc_device.acquisition_mode("IQ")
-
-                rfsoc_device.ADC1.fmixer(nu_if)
-                rfsoc_device.ADC2.fmixer(nu_if)
-                rfsoc_device.ADC1.decfact(1)
-                rfsoc_device.ADC2.decfact(1)
-                rfsoc_device.freq_sync(1e6)
-                rfsoc_device.ADC1.status("ON")
-                rfsoc_device.ADC2.status("ON")
-                rfsoc_device.output_format("BIN")
-                rfsoc_device.n_rep(num_rep)
-
-                rfsoc_device.process_sequencing()
-
                 pow_tmp = rfsoc_device.ADC_power_dBm()
                 pow_vec_0 = np.append(pow_vec_0, pow_tmp[0][0])
                 pow_vec_1 = np.append(pow_vec_1, pow_tmp[1][0])
@@ -1696,105 +2409,10 @@ class pump_cancellation_cls:
 
             print("Optimal phase = " + str(phase_min))
 
-            for amp in bar(dac_v_vec):
-                param_sin_I_pump = {
-                    "amp": amp_if,
-                    "freq": nu_if,
-                    "dc_offset": self.dc_offset_I_pump * 1e-3,
-                    "phase_offset": 0,
-                }
-
-                param_sin_Q_pump = {
-                    "amp": amp_if,
-                    "freq": nu_if,
-                    "dc_offset": self.dc_offset_Q_pump * 1e-3,
-                    "phase_offset": np.pi * phase_offset_if / 180,
-                }
-
-                param_sin_cancel = {
-                    "amp": amp,
-                    "freq": nu_if,
-                    "dc_offset": 0,
-                    "phase_offset": np.pi * phase_min / 180,
-                }
-
-                pulse_pump_I = dict(
-                    label="pumpI",
-                    module="DAC",
-                    channel=self.dac_pump_I,
-                    mode="sin",
-                    start=0,
-                    length=acq_length + wait_time,
-                    param=param_sin_I_pump,
-                    parent=None,
-                )
-
-                pulse_pump_Q = dict(
-                    label="pumpQ",
-                    module="DAC",
-                    channel=self.dac_pump_Q,
-                    mode="sin",
-                    start=0,
-                    length=acq_length + wait_time,
-                    param=param_sin_Q_pump,
-                    parent=None,
-                )
-
-                pulse_cancel_pump = dict(
-                    label="cancel_pump",
-                    module="DAC",
-                    channel=self.dac_pump_cancel,
-                    mode="sin",
-                    start=0,
-                    length=acq_length + wait_time,
-                    param=param_sin_cancel,
-                    parent=None,
-                )
-
-                record_both = dict(
-                    label="record_both",
-                    module="ADC",
-                    channel=1,
-                    mode="raw",
-                    start=adc_start,
-                    length=acq_length,
-                    param=None,
-                    parent=None,
-                )
-
-                record_both2 = dict(
-                    label="record_both2",
-                    module="ADC",
-                    channel=2,
-                    mode="raw",
-                    start=adc_start,
-                    length=acq_length,
-                    param=None,
-                    parent=None,
-                )
-
-                pulses = pd.DataFrame()
-                pulses = pulses.append(pulse_pump_I, ignore_index=True)
-                pulses = pulses.append(pulse_pump_Q, ignore_index=True)
-                pulses = pulses.append(pulse_cancel_pump, ignore_index=True)
-                pulses = pulses.append(record_both, ignore_index=True)
-                pulses = pulses.append(record_both2, ignore_index=True)
-
-                rfsoc_device.pulses = pulses
-
-                rfsoc_device.acquisition_mode("IQ")
+            self.load_pump_cancel(dac_v_vec[0], phase_min)
 
-                rfsoc_device.ADC1.fmixer(nu_if)
-                rfsoc_device.ADC2.fmixer(nu_if)
-                rfsoc_device.ADC1.decfact(1)
-                rfsoc_device.ADC2.decfact(1)
-                rfsoc_device.freq_sync(1e6)
-                rfsoc_device.ADC1.status("ON")
-                rfsoc_device.ADC2.status("ON")
-                rfsoc_device.output_format("BIN")
-                rfsoc_device.n_rep(num_rep)
-
-                rfsoc_device.process_sequencing()
+            for amp in bar(dac_v_vec):
+                rfsoc_device.update_DAC_pulse("cancel_pump", amp=amp)
 
                 pow_tmp = rfsoc_device.ADC_power_dBm()
                 pow_vec_0 = np.append(pow_vec_0, pow_tmp[0][0])
@@ -1824,6 +2442,15 @@ class pump_cancellation_cls:
             )
 
         pow_min = pow_vec_0[np.argmin(pow_vec_0)]
+        self.last_result = dict(
+            x=np.array([phase_min, amp_min]),
+            fun=pow_min,
+            n_acquisitions=iter_depth * (phase_points + amp_if_cancel_points),
+            noise=None,
+            method="grid",
+            history=None,
+        )
+        self.store_calibration("pump_cancel", channels, phase=phase_min, amp=amp_min)
 
         rfsoc_device.display_sequence = mem_display_sequence
         rfsoc_device.display_IQ_progress = mem_display_IQ_progress
@@ -1962,13 +2589,16 @@ class pump_cancellation_cls:
             parent=None,
         )
 
-        pulses = pd.DataFrame()
-        pulses = pulses.append(pulse_pump_I, ignore_index=True)
-        pulses = pulses.append(pulse_pump_Q, ignore_index=True)
-        pulses = pulses.append(pulse_weak_I, ignore_index=True)
-        pulses = pulses.append(pulse_weak_Q, ignore_index=True)
-        pulses = pulses.append(record_both, ignore_index=True)
-        pulses = pulses.append(record_both2, ignore_index=True)
+        pulses = pd.DataFrame(
+            [
+                pulse_pump_I,
+                pulse_pump_Q,
+                pulse_weak_I,
+                pulse_weak_Q,
+                record_both,
+                record_both2,
+            ]
+        )
 
         rfsoc_device.pulses = pulses
 
@@ -1986,8 +2616,32 @@ class pump_cancellation_cls:
 
         rfsoc_device.process_sequencing()
 
-        for iter_n in range(iter_depth):
-            # optimize phase
+        if self.optimizer != "grid":
+            # only the phase is searched, at the current attenuation
+
+            def measure(x):
+                Vaunix_FS_device.phase_shift(self.process_phase(x)[0])
+                return rfsoc_device.ADC_power_dBm()[0][0]
+
+            result = self.optimize(
+                measure,
+                x0=(np.mean(phase_range),),
+                bounds=(phase_range,),
+                periodic=phase_range[1] - phase_range[0] >= 360,
+                xtol=1,
+                maximize=True,
+            )
+            phase_max = self.process_phase(result["x"])[0]
+            pow_phase_max = result["fun"]
+            Vaunix_FS_device.phase_shift(phase_max)
+
+            rfsoc_device.display_sequence = mem_display_sequence
+            rfsoc_device.display_IQ_progress = mem_display_IQ_progress
+
+            return (phase_max, pow_phase_max)
+
+        for iter_n in range(iter_depth):
+            # optimize phase
 
             phase_vec_org = np.linspace(phase_range[0], phase_range[1], phase_points)
             phase_vec = self.process_phase(phase_vec_org)
@@ -2077,11 +2731,187 @@ class pump_cancellation_cls:
             # 	attn_sweep_mag = attn_points*0.1
             # attn_range = (attn_min-0.5*attn_sweep_mag,attn_min+0.5*attn_sweep_mag)
 
+        self.last_result = dict(
+            x=np.array([phase_max]),
+            fun=pow_phase_max,
+            n_acquisitions=iter_depth * (phase_points + attn_points),
+            noise=None,
+            method="grid",
+            history=None,
+        )
+
         rfsoc_device.display_sequence = mem_display_sequence
         rfsoc_device.display_IQ_progress = mem_display_IQ_progress
 
         return (phase_max, pow_phase_max)
 
+    def optimize(self, measure, x0, bounds, **options):
+        # see minimize, self.optimizer_options overrides the options
+        options.update(self.optimizer_options)
+        result = minimize(
+            measure,
+            x0,
+            bounds,
+            method=self.optimizer,
+            noise=self.optimizer_noise,
+            **options,
+        )
+        self.last_result = result
+        if self.display_plots:
+            plot_optimization(result, "Power (dBm)")
+        return result
+
+    def calibration_settings(self):
+        # settings of the pump the optima depend on
+        return dict(
+            amp_if=self.amp_if,
+            angle_amp_if=self.angle_amp_if,
+            phase_offset_if=self.phase_offset_if,
+            dc_offset_I_pump=self.dc_offset_I_pump,
+            dc_offset_Q_pump=self.dc_offset_Q_pump,
+        )
+
+    def calibrated(self, kind, channels):
+        # see calibration_store_cls.lookup, None without calibration store
+        if self.calibration is None:
+            return None
+        return self.calibration.lookup(
+            kind, self.nu_if, channels, self.calibration_settings()
+        )
+
+    def calibration_result(self, calibrated, x):
+        # last_result of a search skipped for a fresh calibration
+        return dict(
+            x=np.array(x),
+            fun=calibrated["values"].get("pow"),
+            n_acquisitions=0,
+            noise=None,
+            method="calibration",
+            history=None,
+        )
+
+    def store_calibration(self, kind, channels, **values):
+        # store the optimum values of the last search at nu_if
+        if self.calibration is not None:
+            values["pow"] = self.last_result["fun"]
+            self.calibration.store(
+                kind,
+                self.nu_if,
+                channels,
+                values,
+                self.last_result["n_acquisitions"],
+                self.calibration_settings(),
+            )
+
+    def load_pump_cancel(self, amp, phase):
+        # load the sequence of get_pump_cancel_rfsoc, with the cancellation
+        # pulse at amplitude amp and phase phase (degrees)
+        rfsoc_device = self.rfsoc_device
+
+        amp_if = self.amp_if
+        nu_if = self.nu_if
+        phase_offset_if = self.phase_offset_if
+        acq_length = self.acq_length
+        wait_time = self.wait_time
+        num_rep = self.num_rep
+        adc_start = wait_time / 2
+
+        param_sin_I_pump = {
+            "amp": amp_if,
+            "freq": nu_if,
+            "dc_offset": self.dc_offset_I_pump * 1e-3,
+            "phase_offset": 0,
+        }
+
+        param_sin_Q_pump = {
+            "amp": amp_if,
+            "freq": nu_if,
+            "dc_offset": self.dc_offset_Q_pump * 1e-3,
+            "phase_offset": np.pi * phase_offset_if / 180,
+        }
+
+        param_sin_cancel = {
+            "amp": amp,
+            "freq": nu_if,
+            "dc_offset": 0,
+            "phase_offset": np.pi * phase / 180,
+        }
+
+        pulse_pump_I = dict(
+            label="pumpI",
+            module="DAC",
+            channel=self.dac_pump_I,
+            mode="sin",
+            start=0,
+            length=acq_length + wait_time,
+            param=param_sin_I_pump,
+            parent=None,
+        )
+
+        pulse_pump_Q = dict(
+            label="pumpQ",
+            module="DAC",
+            channel=self.dac_pump_Q,
+            mode="sin",
+            start=0,
+            length=acq_length + wait_time,
+            param=param_sin_Q_pump,
+            parent=None,
+        )
+
+        pulse_cancel_pump = dict(
+            label="cancel_pump",
+            module="DAC",
+            channel=self.dac_pump_cancel,
+            mode="sin",
+            start=0,
+            length=acq_length + wait_time,
+            param=param_sin_cancel,
+            parent=None,
+        )
+
+        record_both = dict(
+            label="record_both",
+            module="ADC",
+            channel=1,
+            mode="raw",
+            start=adc_start,
+            length=acq_length,
+            param=None,
+            parent=None,
+        )
+
+        record_both2 = dict(
+            label="record_both2",
+            module="ADC",
+            channel=2,
+            mode="raw",
+            start=adc_start,
+            length=acq_length,
+            param=None,
+            parent=None,
+        )
+
+        pulses = pd.DataFrame(
+            [pulse_pump_I, pulse_pump_Q, pulse_cancel_pump, record_both, record_both2]
+        )
+
+        rfsoc_device.pulses = pulses
+
+        rfsoc_device.acquisition_mode("IQ")
+
+        rfsoc_device.ADC1.fmixer(nu_if)
+        rfsoc_device.ADC2.fmixer(nu_if)
+        rfsoc_device.ADC1.decfact(1)
+        rfsoc_device.ADC2.decfact(1)
+        rfsoc_device.freq_sync(1e6)
+        rfsoc_device.ADC1.status("ON")
+        rfsoc_device.ADC2.status("ON")
+        rfsoc_device.output_format("BIN")
+        rfsoc_device.n_rep(num_rep)
+
+        rfsoc_device.process_sequencing()
+
     def process_phase(self, phase_arr):
         phase_arr_out = np.array([])
 
@@ -2095,7 +2925,105 @@ class pump_cancellation_cls:
         return phase_arr_out
 
 
+# waveform memory of a DAC channel: 16384 rows of 8 samples at 2 GS/s (us)
+DAC_MEMORY_LENGTH = 16384 * 8 / 2e9 * 1e6
+
+
+def frequency_batches(freq_list, batch_size, segment_length):
+    """
+    Split a frequency scan in batches of at most batch_size frequencies, and
+    at most as many segments of segment_length (us) as the DAC memory holds
+    """
+    batch_size = min(batch_size, int(DAC_MEMORY_LENGTH // segment_length))
+    if batch_size < 1:
+        raise ValueError(
+            "Segments of {} us do not fit in the DAC memory".format(segment_length)
+        )
+    return [freq_list[i : i + batch_size] for i in range(0, len(freq_list), batch_size)]
+
+
+def frequency_segments(
+    freqs, segment_length, adc_start, acq_length, dac_param, adc_channels=(1, 2)
+):
+    """
+    Pulse table of a batched frequency scan: one segment per frequency, back to
+    back, with a sin pulse at this frequency on every DAC channel and a RAW
+    window on every ADC channel
+    Input:
+        freqs(list): frequencies of the segments (MHz)
+        segment_length(float): length of a segment and of its DAC pulses (us)
+        adc_start, acq_length(float): ADC window in every segment (us)
+        dac_param(dict): parameters of the sin pulse of every DAC channel,
+        without the frequency
+        adc_channels(list): ADC channels recorded
+    Output:
+        list of the pulses
+    """
+    pulses = []
+    for k, freq in enumerate(freqs):
+        start = k * segment_length
+        for ch, param in dac_param.items():
+            pulses.append(
+                dict(
+                    label="seg{}_DAC{}".format(k, ch),
+                    module="DAC",
+                    channel=ch,
+                    mode="sin",
+                    start=start,
+                    length=segment_length,
+                    param=dict(param, freq=freq),
+                    parent=None,
+                )
+            )
+        for ch in adc_channels:
+            pulses.append(
+                dict(
+                    label="seg{}_ADC{}".format(k, ch),
+                    module="ADC",
+                    channel=ch,
+                    mode="RAW",
+                    start=start + adc_start,
+                    length=acq_length,
+                    param=None,
+                    parent=None,
+                )
+            )
+    return pulses
+
+
+def segment_power_dBm(traces, freqs, sampling_rate):
+    """
+    Demultiplex the RAW traces of a batched scan: power (dBm) of the tone at
+    freqs[k] (MHz) in traces[k]. A trace of every repetition (RFSoC.average_RAW
+    False), shape (repetitions, points), gives (I**2 + Q**2)/(2*50) averaged
+    over the repetitions like the IQ mode; an averaged trace gives the power of
+    the coherent average, without the noise of the repetitions.
+    """
+    power = []
+    for trace, freq in zip(traces, freqs):
+        t = np.arange(np.shape(trace)[-1]) / sampling_rate
+        reference = np.exp(-2j * np.pi * freq * 1e6 * t)
+        amplitude = 2 * np.mean(trace * reference, axis=-1)
+        square = np.mean(np.abs(amplitude) ** 2)
+        power.append(10 * np.log10(1e3 * square / (2 * 50)))
+    return power
+
+
 class check_ADC_meas_freq_cls:
+    """
+    Power measured on ADC1 and ADC2 at every frequency of a scan, to find the
+    corrupted bins (below -60 dBm).
+    With batch_size 1 (default), every frequency is a sequence measured in IQ
+    mode with the ADC mixers at this frequency: the hardware demodulation is
+    tested. With batch_size > 1, a sequence holds a segment per frequency, read
+    in RAW mode and demodulated in software (segment_power_dBm), with the mixers
+    at 0: only the sampling of the ADCs is tested, not the mixers and the IQ
+    path. The power is still averaged over the repetitions like in IQ mode, but
+    every repetition of every RAW window is transferred: about 2 * 2000 *
+    num_rep words per segment, against 16 words per repetition of a pulse in IQ
+    mode. rfSoC_benchmark.run_frequency_batches times both modes end to end.
+    """
+
     def __init__(self, rfsoc_device):
         self.rfsoc_device = rfsoc_device
 
@@ -2114,6 +3042,12 @@ class check_ADC_meas_freq_cls:
         self.wait_time = 2.0
         self.num_rep = 100
 
+        # frequencies measured in one sequence, 1 for a sequence per frequency
+        # in IQ mode. Batched segments are read in RAW mode (see the class
+        # docstring) and are shorter: batch_acq_length + wait_time
+        self.batch_size = 1
+        self.batch_acq_length = 1.0
+
     def check_freq(self, freq_list):
         rfsoc_device = self.rfsoc_device
 
@@ -2150,91 +3084,19 @@ class check_ADC_meas_freq_cls:
             corrupted_bins_ch1[iter_n] = []
             corrupted_bins_ch2[iter_n] = []
 
-            for nu_if in bar(freq_list):
-                param_sin_I = {
-                    "amp": amp_if,
-                    "freq": nu_if,
-                    "dc_offset": dc_offset_I * 1e-3,
-                    "phase_offset": 0,
-                }
-
-                param_sin_Q = {
-                    "amp": amp_if,
-                    "freq": nu_if,
-                    "dc_offset": dc_offset_Q * 1e-3,
-                    "phase_offset": np.pi * phase_offset_if / 180,
-                }
-
-                pulse_sin = dict(
-                    label="pump",
-                    module="DAC",
-                    channel=1,
-                    mode="sin",
-                    start=0,
-                    length=acq_length + wait_time,
-                    param=param_sin_I,
-                    parent=None,
-                )
-
-                record_sin = dict(
-                    label="record_signal",
-                    module="ADC",
-                    channel=1,
-                    mode="IQ",
-                    start=adc_start,
-                    length=acq_length,
-                    param=None,
-                    parent=None,
-                )
-
-                pulse_sin2 = dict(
-                    label="pump2",
-                    module="DAC",
-                    channel=2,
-                    mode="sin",
-                    start=0,
-                    length=acq_length + wait_time,
-                    param=param_sin_Q,
-                    parent=None,
-                )
-
-                record_sin2 = dict(
-                    label="record_signal2",
-                    module="ADC",
-                    channel=2,
-                    mode="IQ",
-                    start=adc_start,
-                    length=acq_length,
-                    param=None,
-                    parent=None,
-                )
-
-                pulses = pd.DataFrame()
-                pulses = pulses.append(pulse_sin, ignore_index=True)
-                pulses = pulses.append(record_sin, ignore_index=True)
-                pulses = pulses.append(pulse_sin2, ignore_index=True)
-                pulses = pulses.append(record_sin2, ignore_index=True)
-
-                rfsoc_device.pulses = pulses
-
-                rfsoc_device.acquisition_mode("IQ")
-
-                rfsoc_device.ADC1.fmixer(nu_if)
-                rfsoc_device.ADC2.fmixer(nu_if)
-                rfsoc_device.ADC1.decfact(1)
-                rfsoc_device.ADC2.decfact(1)
-                rfsoc_device.freq_sync(1e6)
-                rfsoc_device.ADC1.status("ON")
-                rfsoc_device.ADC2.status("ON")
-                rfsoc_device.output_format("BIN")
-                rfsoc_device.n_rep(num_rep)
-
-                rfsoc_device.process_sequencing()
-
-                pow_tmp = rfsoc_device.ADC_power_dBm()
+            if self.batch_size > 1:
+                segment_length = self.batch_acq_length + self.wait_time
+                batches = frequency_batches(freq_list, self.batch_size, segment_length)
+                for freqs in bar(batches):
+                    pow_ch1, pow_ch2 = self.measure_batch(freqs)
+                    sweep_mem_ch1[iter_n].extend(pow_ch1)
+                    sweep_mem_ch2[iter_n].extend(pow_ch2)
+            else:
+                for nu_if in bar(freq_list):
+                    pow_tmp = self.measure_freq(nu_if)
 
-                sweep_mem_ch1[iter_n].append(pow_tmp[0][0])
-                sweep_mem_ch2[iter_n].append(pow_tmp[1][0])
+                    sweep_mem_ch1[iter_n].append(pow_tmp[0][0])
+                    sweep_mem_ch2[iter_n].append(pow_tmp[1][0])
 
             if display_plots:
                 fig = plt.figure(figsize=(16, 12))
@@ -2337,3 +3199,146 @@ class check_ADC_meas_freq_cls:
                 fontsize=20,
             )
             plt.show()
+
+    def measure_freq(self, nu_if):
+        # one sequence at nu_if, measured with the ADC mixers at nu_if
+        rfsoc_device = self.rfsoc_device
+
+        amp_if = self.amp_if
+        phase_offset_if = self.phase_offset_if
+        dc_offset_I = self.dc_offset_I
+        dc_offset_Q = self.dc_offset_Q
+        acq_length = self.acq_length
+        wait_time = self.wait_time
+        num_rep = self.num_rep
+        adc_start = wait_time / 2
+
+        param_sin_I = {
+            "amp": amp_if,
+            "freq": nu_if,
+            "dc_offset": dc_offset_I * 1e-3,
+            "phase_offset": 0,
+        }
+
+        param_sin_Q = {
+            "amp": amp_if,
+            "freq": nu_if,
+            "dc_offset": dc_offset_Q * 1e-3,
+            "phase_offset": np.pi * phase_offset_if / 180,
+        }
+
+        pulse_sin = dict(
+            label="pump",
+            module="DAC",
+            channel=1,
+            mode="sin",
+            start=0,
+            length=acq_length + wait_time,
+            param=param_sin_I,
+            parent=None,
+        )
+
+        record_sin = dict(
+            label="record_signal",
+            module="ADC",
+            channel=1,
+            mode="IQ",
+            start=adc_start,
+            length=acq_length,
+            param=None,
+            parent=None,
+        )
+
+        pulse_sin2 = dict(
+            label="pump2",
+            module="DAC",
+            channel=2,
+            mode="sin",
+            start=0,
+            length=acq_length + wait_time,
+            param=param_sin_Q,
+            parent=None,
+        )
+
+        record_sin2 = dict(
+            label="record_signal2",
+            module="ADC",
+            channel=2,
+            mode="IQ",
+            start=adc_start,
+            length=acq_length,
+            param=None,
+            parent=None,
+        )
+
+        pulses = pd.DataFrame([pulse_sin, record_sin, pulse_sin2, record_sin2])
+
+        rfsoc_device.pulses = pulses
+
+        rfsoc_device.acquisition_mode("IQ")
+
+        rfsoc_device.ADC1.fmixer(nu_if)
+        rfsoc_device.ADC2.fmixer(nu_if)
+        rfsoc_device.ADC1.decfact(1)
+        rfsoc_device.ADC2.decfact(1)
+        rfsoc_device.freq_sync(1e6)
+        rfsoc_device.ADC1.status("ON")
+        rfsoc_device.ADC2.status("ON")
+        rfsoc_device.output_format("BIN")
+        rfsoc_device.n_rep(num_rep)
+
+        rfsoc_device.process_sequencing()
+
+        return rfsoc_device.ADC_power_dBm()
+
+    def measure_batch(self, freqs):
+        # one sequence with a segment per frequency, see frequency_segments.
+        # The segments are demodulated from the RAW traces of every repetition:
+        # the mixers are set to 0 rather than left at the frequency of the last
+        # measure_freq
+        rfsoc_device = self.rfsoc_device
+
+        dac_param = {
+            1: {
+                "amp": self.amp_if,
+                "dc_offset": self.dc_offset_I * 1e-3,
+                "phase_offset": 0,
+            },
+            2: {
+                "amp": self.amp_if,
+                "dc_offset": self.dc_offset_Q * 1e-3,
+                "phase_offset": np.pi * self.phase_offset_if / 180,
+            },
+        }
+        rfsoc_device.pulses = pd.DataFrame(
+            frequency_segments(
+                freqs,
+                self.batch_acq_length + self.wait_time,
+                self.wait_time / 2,
+                self.batch_acq_length,
+                dac_param,
+            )
+        )
+
+        rfsoc_device.acquisition_mode("RAW")
+        rfsoc_device.ADC1.fmixer(0)
+        rfsoc_device.ADC2.fmixer(0)
+        rfsoc_device.ADC1.decfact(1)
+        rfsoc_device.ADC2.decfact(1)
+        rfsoc_device.freq_sync(1e6)
+        rfsoc_device.ADC1.status("ON")
+        rfsoc_device.ADC2.status("ON")
+        rfsoc_device.output_format("BIN")
+        rfsoc_device.n_rep(self.num_rep)
+
+        rfsoc_device.process_sequencing()
+
+        average_RAW = rfsoc_device.average_RAW
+        rfsoc_device.average_RAW = False
+        try:
+            I, Q = rfsoc_device.BUFFER_DATA()
+        finally:
+            rfsoc_device.average_RAW = average_RAW
+        return [
+            segment_power_dBm(I[v], freqs, rfsoc_device.sampling_rate) for v in (0, 1)
+        ]